@@ -6,3 +6,5 @@ from gomatic.gocd.tasks import FetchArtifactTask, ExecTask, RakeTask
 from gomatic.gocd.artifacts import FetchArtifactFile, FetchArtifactDir, BuildArtifact, TestArtifact, ExternalArtifact, ArtifactFor
 from gomatic.gocd.security import Security
 from gomatic.fake import FakeHostRestClient, empty_config
+from gomatic.version_cache import VersionCache
+from gomatic.agents_api import AgentsApi
@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+AGENTS_API_ACCEPT = 'application/vnd.go.cd.v4+json'
+AGENTS_PATH = '/go/api/agents'
+
+
+class RateLimiter(object):
+    """
+    Lets at most requests_per_second calls through wait() per second, across threads.
+    """
+    def __init__(self, requests_per_second, clock=time.time, sleep=time.sleep):
+        self.__interval = 1.0 / requests_per_second
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__next = None
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        with self.__lock:
+            now = self.__clock()
+            slot = now if self.__next is None else max(now, self.__next)
+            self.__next = slot + self.__interval
+        if slot > now:
+            self.__sleep(slot - now)
+
+
+class AgentsApi(object):
+    """
+    Agents as GoCD's agents API sees them (which includes agents newer servers no longer keep in config.xml).
+
+    GoCD returns all agents from one request rather than in pages, so the list is fetched once and kept for ttl
+    seconds. Single agents are fetched, and agents updated one by one, on up to max_workers threads, at most
+    requests_per_second (if given) requests a second.
+    """
+    def __init__(self, host_rest_client, ttl=60, max_workers=8, requests_per_second=None, clock=time.time):
+        self.__host_rest_client = host_rest_client
+        self.__ttl = ttl
+        self.__max_workers = max_workers
+        self.__rate_limiter = RateLimiter(requests_per_second, clock) if requests_per_second else None
+        self.__clock = clock
+        self.__agents = None
+        self.__fetched = None
+
+    def __request(self, method, path, *arguments):
+        if self.__rate_limiter is not None:
+            self.__rate_limiter.wait()
+        return getattr(self.__host_rest_client, method)(path, *arguments)
+
+    def __json(self, path):
+        response = self.__request('get', path, {'Accept': AGENTS_API_ACCEPT})
+        if response.status_code != 200:
+            raise RuntimeError("Failed to get {} status {}\n:{}".format(path, response.status_code, response.text))
+        return json.loads(response.text)
+
+    def agents(self, refresh=False):
+        """
+        All agents, as the dicts GoCD returns, from the cache unless it is older than ttl seconds or refresh is set.
+        """
+        if refresh or self.__agents is None or self.__clock() - self.__fetched > self.__ttl:
+            self.__agents = self.__json(AGENTS_PATH)['_embedded']['agents']
+            self.__fetched = self.__clock()
+        return self.__agents
+
+    def agents_by_uuid(self, uuids):
+        """
+        {uuid: agent} for the given agents, fetched concurrently.
+        """
+        uuids = list(uuids)
+        return dict(zip(uuids, self.__map(lambda uuid: self.__json('%s/%s' % (AGENTS_PATH, uuid)), uuids)))
+
+    def invalidate(self):
+        self.__agents = None
+
+    def update_agents(self, uuids, add_resources=None, remove_resources=None, add_environments=None,
+                      remove_environments=None, enabled=None):
+        """
+        Makes the same change to all the given agents with a single bulk request.
+        """
+        body = {'uuids': list(uuids), 'operations': {}}
+        if add_resources or remove_resources:
+            body['operations']['resources'] = {'add': list(add_resources or []), 'remove': list(remove_resources or [])}
+        if add_environments or remove_environments:
+            body['operations']['environments'] = {'add': list(add_environments or []), 'remove': list(remove_environments or [])}
+        if enabled is not None:
+            body['agent_config_state'] = 'Enabled' if enabled else 'Disabled'
+        self.__request('patch', AGENTS_PATH, json.dumps(body), _headers())
+        self.invalidate()
+
+    def update_each(self, changes):
+        """
+        changes is {uuid: {'resources': [...], 'environments': [...], 'agent_config_state': 'Enabled'}} (each key
+        optional); each agent is updated with its own request, concurrently.
+        """
+        def update(item):
+            uuid, change = item
+            try:
+                self.__request('patch', '%s/%s' % (AGENTS_PATH, uuid), json.dumps(change), _headers())
+                return None
+            except Exception as e:
+                return '%s: %s' % (uuid, e)
+
+        errors = [e for e in self.__map(update, sorted(changes.items())) if e is not None]
+        self.invalidate()
+        if errors:
+            raise RuntimeError("Could not update %s of %s agents:\n%s" % (len(errors), len(changes), "\n".join(errors)))
+
+    def __map(self, function, items):
+        if not items:
+            return []
+        pool = ThreadPool(min(self.__max_workers, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+
+
+def _headers():
+    return {'Accept': AGENTS_API_ACCEPT, 'Content-Type': 'application/json'}
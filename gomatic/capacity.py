@@ -0,0 +1,238 @@
+import heapq
+from collections import deque
+
+from gomatic.resource_index import JobReference, is_disabled_agent
+from gomatic.xml_operations import PossiblyMissingElement
+
+DEFAULT_JOB_DURATION = 60  # seconds
+
+
+class _JobPlan(object):
+    def __init__(self, reference, resources, instances, run_on_all_agents, elastic, duration):
+        self.reference = reference
+        self.resources = resources
+        self.instances = instances
+        self.run_on_all_agents = run_on_all_agents
+        self.elastic = elastic
+        self.duration = duration
+
+
+class _StagePlan(object):
+    def __init__(self, name, manual, jobs):
+        self.name = name
+        self.manual = manual
+        self.jobs = jobs
+
+
+class _JobInstance(object):
+    def __init__(self, run, plan, queued_at, agent=None):
+        self.run = run
+        self.plan = plan
+        self.queued_at = queued_at
+        self.agent = agent
+
+
+class _PipelineRun(object):
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stage_index = 0
+        self.remaining = 0
+
+
+class SimulationReport(object):
+    def __init__(self, makespan, waits, busy, elastic_jobs, stuck, pipeline_runs):
+        self.makespan = makespan
+        self.waits = waits
+        self.busy = busy
+        self.elastic_jobs = elastic_jobs
+        self.stuck = stuck
+        self.pipeline_runs = pipeline_runs
+
+    def __repr__(self):
+        return 'SimulationReport(makespan=%s, mean_wait=%.1f, max_wait=%s, utilization=%.2f, stuck=%s)' % (
+            self.makespan, self.mean_wait, self.max_wait, self.mean_utilization, len(self.stuck))
+
+    @property
+    def mean_wait(self):
+        return float(sum(self.waits)) / len(self.waits) if self.waits else 0.0
+
+    @property
+    def max_wait(self):
+        return max(self.waits) if self.waits else 0
+
+    @property
+    def utilization(self):
+        """
+        {agent hostname: fraction of the makespan it spent running jobs}
+        """
+        return dict((hostname, float(busy) / self.makespan if self.makespan else 0.0) for hostname, busy in self.busy.items())
+
+    @property
+    def mean_utilization(self):
+        utilization = self.utilization
+        return sum(utilization.values()) / len(utilization) if utilization else 0.0
+
+
+class CapacitySimulator(object):
+    """
+    Simulates GoCD scheduling the jobs of triggered pipelines on a fleet of agents, offline.
+
+    Stages run one after the other; a stage needing manual approval (other than the first stage of a pipeline
+    triggered by the scenario) stops the run there. When a stage passes, the pipelines with a pipeline material on
+    it are triggered, once per moment however many of their materials passed then. A job runs runInstanceCount
+    times, or once on every agent with its resources if runOnAllAgents. Jobs on elastic profiles start straight
+    away on elastic agents. Waiting jobs go to the first free agent that has their resources, first come first
+    served. Jobs no agent can run are reported as stuck, and their stages never pass. Disabled agents are left out.
+
+    The config is only read when the simulator is made, so run can be called many times, e.g. with different agents.
+    """
+    def __init__(self, pipeline_elements, template_elements, agent_elements, default_duration=DEFAULT_JOB_DURATION, durations=None):
+        durations = durations or {}
+        templates = dict((e.attrib['name'], e) for e in template_elements)
+        self.__pipelines = {}
+        self.__downstream = {}
+        for pipeline_element in pipeline_elements:
+            name = pipeline_element.attrib['name']
+            stages_from = templates.get(pipeline_element.attrib.get('template'), pipeline_element)
+            self.__pipelines[name] = [self.__stage_plan(name, stage_element, default_duration, durations)
+                                      for stage_element in stages_from.findall('stage')]
+            for material in PossiblyMissingElement(pipeline_element).possibly_missing_child('materials').findall('pipeline'):
+                key = (material.attrib['pipelineName'], material.attrib['stageName'])
+                self.__downstream.setdefault(key, []).append(name)
+        self.__agents = [(e.attrib['hostname'], _resources_of(e)) for e in agent_elements if not is_disabled_agent(e)]
+
+    @staticmethod
+    def __stage_plan(pipeline_name, stage_element, default_duration, durations):
+        jobs = []
+        for job_element in PossiblyMissingElement(stage_element).possibly_missing_child('jobs').findall('job'):
+            reference = JobReference(pipeline_name, stage_element.attrib['name'], job_element.attrib['name'])
+            instances = job_element.attrib.get('runInstanceCount', '1')
+            jobs.append(_JobPlan(reference,
+                                 _resources_of(job_element),
+                                 int(instances) if instances.isdigit() else 1,
+                                 job_element.attrib.get('runOnAllAgents') == 'true',
+                                 'elasticProfileId' in job_element.attrib,
+                                 durations.get(reference, default_duration)))
+        manual = PossiblyMissingElement(stage_element).possibly_missing_child('approval').has_attribute('type', 'manual')
+        return _StagePlan(stage_element.attrib['name'], manual, jobs)
+
+    def run(self, triggers, agents=None):
+        """
+        triggers is a list of (seconds from the start, pipeline name). agents is a list of the resources of each
+        agent to simulate instead of the agents in the config, e.g. [['linux']] * 20.
+        """
+        if agents is None:
+            agents = self.__agents
+        else:
+            agents = [('agent-%s' % i, frozenset(resources)) for i, resources in enumerate(agents)]
+        simulation = _Simulation(self.__pipelines, self.__downstream, agents)
+        return simulation.run(triggers)
+
+
+def _resources_of(element):
+    return frozenset(e.text for e in PossiblyMissingElement(element).possibly_missing_child('resources').findall('resource'))
+
+
+class _Simulation(object):
+    def __init__(self, pipelines, downstream, agents):
+        self.pipelines = pipelines
+        self.downstream = downstream
+        self.agents = agents
+        self.idle = list(range(len(agents)))
+        self.queue = deque()
+        self.events = []
+        self.sequence = 0
+        self.now = 0
+        self.waits = []
+        self.busy = dict((hostname, 0) for hostname, _ in agents)
+        self.elastic_jobs = 0
+        self.stuck = []
+        self.pipeline_runs = 0
+        self.last_triggered = {}
+
+    def schedule(self, time, action, *arguments):
+        self.sequence += 1
+        heapq.heappush(self.events, (time, self.sequence, action, arguments))
+
+    def run(self, triggers):
+        for time, pipeline in triggers:
+            self.schedule(time, self.trigger, pipeline, True)
+        makespan = 0
+        while self.events:
+            self.now, _, action, arguments = heapq.heappop(self.events)
+            action(*arguments)
+            makespan = max(makespan, self.now)
+        self.stuck.extend(instance.plan.reference for instance in self.queue)
+        return SimulationReport(makespan, self.waits, self.busy, self.elastic_jobs, self.stuck, self.pipeline_runs)
+
+    def trigger(self, pipeline, forced=False):
+        if pipeline not in self.pipelines or not self.pipelines[pipeline]:
+            return
+        if not forced:
+            if self.last_triggered.get(pipeline) == self.now or self.pipelines[pipeline][0].manual:
+                return
+        self.last_triggered[pipeline] = self.now
+        self.pipeline_runs += 1
+        self.start_stage(_PipelineRun(pipeline))
+
+    def start_stage(self, run):
+        stage = self.pipelines[run.pipeline][run.stage_index]
+        for plan in stage.jobs:
+            if plan.elastic:
+                instances = [_JobInstance(run, plan, self.now) for _ in range(plan.instances)]
+            elif plan.run_on_all_agents:
+                instances = [_JobInstance(run, plan, self.now, agent) for agent, (_, resources) in enumerate(self.agents)
+                             if plan.resources <= resources]
+                if not instances:
+                    self.stuck.append(plan.reference)
+                    run.remaining += 1
+            else:
+                instances = [_JobInstance(run, plan, self.now) for _ in range(plan.instances)]
+            run.remaining += len(instances)
+            for instance in instances:
+                if plan.elastic:
+                    self.elastic_jobs += 1
+                    self.waits.append(0)
+                    self.schedule(self.now + plan.duration, self.finish, instance, None)
+                else:
+                    self.enqueue(instance)
+        if run.remaining == 0:
+            self.stage_passed(run)
+
+    def can_run(self, agent, instance):
+        return (instance.agent is None or instance.agent == agent) and instance.plan.resources <= self.agents[agent][1]
+
+    def enqueue(self, instance):
+        for agent in self.idle:
+            if self.can_run(agent, instance):
+                self.idle.remove(agent)
+                self.start(agent, instance)
+                return
+        self.queue.append(instance)
+
+    def start(self, agent, instance):
+        self.waits.append(self.now - instance.queued_at)
+        self.busy[self.agents[agent][0]] += instance.plan.duration
+        self.schedule(self.now + instance.plan.duration, self.finish, instance, agent)
+
+    def finish(self, instance, agent):
+        if agent is not None:
+            for queued in self.queue:
+                if self.can_run(agent, queued):
+                    self.queue.remove(queued)
+                    self.start(agent, queued)
+                    break
+            else:
+                self.idle.append(agent)
+        run = instance.run
+        run.remaining -= 1
+        if run.remaining == 0:
+            self.stage_passed(run)
+
+    def stage_passed(self, run):
+        stages = self.pipelines[run.pipeline]
+        for downstream in self.downstream.get((run.pipeline, stages[run.stage_index].name), []):
+            self.schedule(self.now, self.trigger, downstream)
+        run.stage_index += 1
+        if run.stage_index < len(stages) and not stages[run.stage_index].manual:
+            self.start_stage(run)
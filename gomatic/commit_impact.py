@@ -0,0 +1,143 @@
+import re
+from collections import deque
+
+from gomatic.resource_index import is_disabled_agent
+from gomatic.xml_operations import PossiblyMissingElement, ignore_patterns_in
+
+_compiled_patterns = {}
+
+
+def _ant_pattern(pattern):
+    if pattern not in _compiled_patterns:
+        segments = pattern.replace('\\', '/').lstrip('/').split('/')
+        parts = []
+        for i, segment in enumerate(segments):
+            is_last = i == len(segments) - 1
+            if segment == '**':
+                parts.append('.*' if is_last else '(?:.*/)?')
+            else:
+                part = ''.join('[^/]*' if c == '*' else '[^/]' if c == '?' else re.escape(c) for c in segment)
+                parts.append(part if is_last else part + '/')
+        _compiled_patterns[pattern] = re.compile('^' + ''.join(parts) + '$')
+    return _compiled_patterns[pattern]
+
+
+def ant_glob_matches(pattern, path):
+    """
+    Whether path matches an ant style pattern, as GoCD matches material filters: ** matches any number of
+    directories, * any part of a file or directory name and ? a single character.
+    """
+    return _ant_pattern(pattern).match(path.replace('\\', '/').lstrip('/')) is not None
+
+
+def is_triggered_by(git_material_element, changed_paths):
+    """
+    Whether a commit changing changed_paths triggers the git material: some path must not be ignored, or with
+    invertFilter, some path must be matched by the filter.
+    """
+    patterns = ignore_patterns_in(git_material_element)
+    if not patterns:
+        return len(changed_paths) > 0
+    invert_filter = git_material_element.attrib.get('invertFilter', 'false') == 'true'
+    for path in changed_paths:
+        matched = any(ant_glob_matches(pattern, path) for pattern in patterns)
+        if matched == invert_filter:
+            return True
+    return False
+
+
+def _resources_of(element):
+    return frozenset(e.text for e in PossiblyMissingElement(element).possibly_missing_child('resources').findall('resource'))
+
+
+def _needs_manual_approval(stage_element):
+    return PossiblyMissingElement(stage_element).possibly_missing_child('approval').has_attribute('type', 'manual')
+
+
+def _stages_run(stage_elements):
+    # a run goes through the stages until one (other than the first) needs manual approval
+    for i, stage_element in enumerate(stage_elements):
+        if i > 0 and _needs_manual_approval(stage_element):
+            return stage_elements[:i]
+    return stage_elements
+
+
+def _job_count(stage_elements, agent_resources):
+    count = 0
+    for stage_element in stage_elements:
+        for job_element in PossiblyMissingElement(stage_element).possibly_missing_child('jobs').findall('job'):
+            if job_element.attrib.get('runOnAllAgents') == 'true':
+                resources = _resources_of(job_element)
+                count += len([agent for agent in agent_resources if resources <= agent])
+                continue
+            instances = job_element.attrib.get('runInstanceCount', '1')
+            count += int(instances) if instances.isdigit() else 1
+    return count
+
+
+class CommitImpact(object):
+    """
+    The pipelines a commit schedules: depth 0 for those triggered by the commit's repository itself, depth n for
+    those triggered through pipeline materials by a stage of a pipeline of depth n - 1. Pipelines whose first stage
+    needs manual approval are not scheduled, so they are listed in awaiting_approval and trigger nothing further.
+    Other pipelines run up to the first later stage that needs manual approval, so only the jobs of those stages
+    are counted (runOnAllAgents jobs once per enabled agent with their resources) and only those stages trigger
+    downstream pipelines.
+    """
+    def __init__(self, depths, jobs, awaiting_approval):
+        self.depths = depths
+        self.jobs = jobs
+        self.awaiting_approval = awaiting_approval
+
+    def __repr__(self):
+        return 'CommitImpact(%s pipelines, %s jobs)' % (len(self.depths), self.total_jobs)
+
+    @property
+    def triggered(self):
+        return sorted(self.depths, key=lambda name: (self.depths[name], name))
+
+    @property
+    def total_jobs(self):
+        return sum(self.jobs.values())
+
+    @property
+    def max_depth(self):
+        return max(self.depths.values()) if self.depths else None
+
+
+def impact_of_commit(pipeline_elements, template_elements, agent_elements, material_index, url, branch, changed_paths):
+    pipelines_by_name = dict((e.attrib['name'], e) for e in pipeline_elements)
+    templates_by_name = dict((e.attrib['name'], e) for e in template_elements)
+    agent_resources = [_resources_of(e) for e in agent_elements if not is_disabled_agent(e)]
+    downstream_of_stage = {}
+    for name, element in pipelines_by_name.items():
+        for material in PossiblyMissingElement(element).possibly_missing_child('materials').findall('pipeline'):
+            key = (material.attrib['pipelineName'], material.attrib['stageName'])
+            downstream_of_stage.setdefault(key, []).append(name)
+
+    def stages_of(name):
+        element = pipelines_by_name[name]
+        if 'template' in element.attrib:
+            element = templates_by_name.get(element.attrib['template'])
+        return element.findall('stage') if element is not None else []
+
+    depths = {}
+    jobs = {}
+    awaiting_approval = set()
+    to_schedule = deque((name, 0) for name, material in material_index.git_materials(url, branch)
+                        if is_triggered_by(material, changed_paths))
+    while to_schedule:
+        name, depth = to_schedule.popleft()
+        if name in depths or name in awaiting_approval or name not in pipelines_by_name:
+            continue
+        stages = stages_of(name)
+        if stages and _needs_manual_approval(stages[0]):
+            awaiting_approval.add(name)
+            continue
+        stages = _stages_run(stages)
+        depths[name] = depth
+        jobs[name] = _job_count(stages, agent_resources)
+        for stage_element in stages:
+            to_schedule.extend((downstream, depth + 1)
+                               for downstream in sorted(downstream_of_stage.get((name, stage_element.attrib['name']), [])))
+    return CommitImpact(depths, jobs, sorted(awaiting_approval))
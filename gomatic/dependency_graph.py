@@ -0,0 +1,170 @@
+from collections import deque
+
+from gomatic.xml_operations import PossiblyMissingElement
+
+
+class PipelineDependencyGraph(object):
+    """
+    Which pipelines depend on which through pipeline materials, read in one pass over the config.
+
+    Pipeline names are interned as ints and each pipeline's upstream and downstream pipelines are kept as sets of
+    those ints, so queries never go back to the XML. Pipelines and pipeline groups keep it up to date as pipelines
+    are added and pipeline materials change; the configurator builds it again after a pipeline is removed.
+    Pipelines that are only referred to by a pipeline material (e.g. because they were removed) are still nodes.
+    """
+    def __init__(self, pipeline_elements):
+        self.__names = []
+        self.__ids = {}
+        self.__upstream = []
+        self.__downstream = []
+        for element in pipeline_elements:
+            pipeline = self.__intern(element.attrib['name'])
+            for material in PossiblyMissingElement(element).possibly_missing_child('materials').findall('pipeline'):
+                self.__add_edge(self.__intern(material.attrib['pipelineName']), pipeline)
+
+    def __intern(self, name):
+        if name not in self.__ids:
+            self.__ids[name] = len(self.__names)
+            self.__names.append(name)
+            self.__upstream.append(set())
+            self.__downstream.append(set())
+        return self.__ids[name]
+
+    def __add_edge(self, upstream, downstream):
+        self.__upstream[downstream].add(upstream)
+        self.__downstream[upstream].add(downstream)
+
+    def __named(self, ids):
+        return [self.__names[i] for i in sorted(ids)]
+
+    def add_pipeline(self, pipeline_name):
+        self.__intern(pipeline_name)
+
+    def add_dependency(self, pipeline_name, upstream_pipeline_name):
+        self.__add_edge(self.__intern(upstream_pipeline_name), self.__intern(pipeline_name))
+
+    def remove_dependencies(self, pipeline_name):
+        if pipeline_name in self.__ids:
+            pipeline = self.__ids[pipeline_name]
+            for upstream in self.__upstream[pipeline]:
+                self.__downstream[upstream].discard(pipeline)
+            self.__upstream[pipeline] = set()
+
+    def __closure(self, name, edges, transitive):
+        if name not in self.__ids:
+            return []
+        start = self.__ids[name]
+        if not transitive:
+            return self.__named(edges[start])
+        seen = set()
+        to_visit = deque(edges[start])
+        while to_visit:
+            pipeline = to_visit.popleft()
+            if pipeline not in seen:
+                seen.add(pipeline)
+                to_visit.extend(edges[pipeline])
+        return self.__named(seen)
+
+    def upstream_of(self, name, transitive=True):
+        return self.__closure(name, self.__upstream, transitive)
+
+    def downstream_of(self, name, transitive=True):
+        return self.__closure(name, self.__downstream, transitive)
+
+    def __topological_ids(self):
+        waiting_for = [len(upstream) for upstream in self.__upstream]
+        ready = deque(i for i, count in enumerate(waiting_for) if count == 0)
+        order = []
+        while ready:
+            pipeline = ready.popleft()
+            order.append(pipeline)
+            for downstream in sorted(self.__downstream[pipeline]):
+                waiting_for[downstream] -= 1
+                if waiting_for[downstream] == 0:
+                    ready.append(downstream)
+        if len(order) != len(self.__names):
+            raise RuntimeError("Pipelines depend on each other in cycles: %s" % self.cycles())
+        return order
+
+    def topological_order(self):
+        """
+        All pipelines, each after every pipeline it depends on.
+        """
+        return [self.__names[i] for i in self.__topological_ids()]
+
+    def cycles(self):
+        """
+        Each group of pipelines that (directly or indirectly) depend on each other, found with Tarjan's algorithm.
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        result = []
+        for start in range(len(self.__names)):
+            if start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            work = [(start, iter(self.__downstream[start]))]
+            while work:
+                pipeline, downstreams = work[-1]
+                descended = False
+                for downstream in downstreams:
+                    if downstream not in index:
+                        index[downstream] = low[downstream] = len(index)
+                        stack.append(downstream)
+                        on_stack.add(downstream)
+                        work.append((downstream, iter(self.__downstream[downstream])))
+                        descended = True
+                        break
+                    if downstream in on_stack:
+                        low[pipeline] = min(low[pipeline], index[downstream])
+                if descended:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[pipeline])
+                if low[pipeline] == index[pipeline]:
+                    component = set()
+                    while pipeline not in component:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                    if len(component) > 1 or pipeline in self.__downstream[pipeline]:
+                        result.append(self.__named(component))
+        return result
+
+    def __longest_chains(self):
+        depth = [0] * len(self.__names)
+        previous = [None] * len(self.__names)
+        for pipeline in self.__topological_ids():
+            for downstream in self.__downstream[pipeline]:
+                if depth[pipeline] + 1 > depth[downstream]:
+                    depth[downstream] = depth[pipeline] + 1
+                    previous[downstream] = pipeline
+        return depth, previous
+
+    def depth_of(self, name):
+        """
+        The number of pipelines in the longest chain of upstream pipelines of the named pipeline.
+        """
+        if name not in self.__ids:
+            return 0
+        return self.__longest_chains()[0][self.__ids[name]]
+
+    def longest_chain(self):
+        """
+        The longest chain of pipelines each depending on the one before (the critical path), most upstream first.
+        """
+        if not self.__names:
+            return []
+        depth, previous = self.__longest_chains()
+        pipeline = max(range(len(depth)), key=lambda i: depth[i])
+        chain = []
+        while pipeline is not None:
+            chain.append(self.__names[pipeline])
+            pipeline = previous[pipeline]
+        return list(reversed(chain))
@@ -1,6 +1,8 @@
 import codecs
 import json
 
+from gomatic.go_cd_configurator import ConfigConflictError
+
 empty_config_xml = """<?xml version="1.0" encoding="utf-8"?>
 <cruise xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="cruise-config.xsd" schemaVersion="72">
   <server artifactsdir="artifacts" commandRepositoryLocation="default" serverId="96eca4bf-210e-499f-9dc9-0cefdae38d0c" />
@@ -10,9 +12,10 @@ empty_config_xml = """<?xml version="1.0" encoding="utf-8"?>
 DEFAULT_VERSION='16.3.0'
 
 class FakeResponse(object):
-    def __init__(self, text):
+    def __init__(self, text, md5='42'):
         self.text = text
-        self.headers = {'x-cruise-config-md5': '42'}
+        self.content = text if isinstance(text, bytes) else text.encode('utf-8')
+        self.headers = {'x-cruise-config-md5': md5}
         self.status_code = 200
     def json(self):
         return json.loads(self.text)
@@ -23,6 +26,13 @@ class FakeHostRestClient(object):
         self.config_string = config_string
         self.thing_to_recreate_itself = thing_to_recreate_itself
         self.version = version
+        self.access_token = None
+        self.md5 = '42'
+        self.posts = []
+        self.api_calls = []
+        self.version_requests = 0
+        self.config_requests = 0
+        self.api_agents = []
 
     def __repr__(self):
         if self.thing_to_recreate_itself is None:
@@ -30,15 +40,72 @@ class FakeHostRestClient(object):
         else:
             return self.thing_to_recreate_itself
 
-    def get(self, path):
+    def get(self, path, headers=None):
         # sorry for the duplication/shared knowledge of code but this is easiest way to test
         # what we want in a controlled way
         if path == "/go/api/admin/config.xml":
-            return FakeResponse(self.config_string)
+            self.config_requests += 1
+            return FakeResponse(self.config_string, self.md5)
         if path == "/go/api/version":
+            self.version_requests += 1
             return FakeResponse('{{"version": "{}"}}'.format(self.version))
+        if path.startswith("/go/api/admin/pipelines/") or path.startswith("/go/api/admin/templates/"):
+            self.api_calls.append(('get', path, None, headers))
+            response = FakeResponse('{}')
+            response.headers['ETag'] = '"etag-of-%s"' % path.split('/')[-1]
+            return response
+        if path.startswith("/go/api/agents"):
+            self.api_calls.append(('get', path, None, headers))
+            if path == "/go/api/agents":
+                return FakeResponse(json.dumps({'_embedded': {'agents': self.api_agents}}))
+            response = FakeResponse(json.dumps(self.__api_agent(path.split('/')[-1])))
+            if response.text == 'null':
+                response.status_code = 404
+            return response
+        raise RuntimeError("not expecting to be asked for anything else")
+
+    def __api_agent(self, uuid):
+        return next((agent for agent in self.api_agents if agent['uuid'] == uuid), None)
+
+    def patch(self, path, data, headers=None):
+        self.api_calls.append(('patch', path, data, headers))
+        change = json.loads(data)
+        if path == "/go/api/agents":
+            for agent in [self.__api_agent(uuid) for uuid in change['uuids']]:
+                for key, operation in change['operations'].items():
+                    agent[key] = sorted(set(agent.get(key, [])).union(operation['add']).difference(operation['remove']))
+                if 'agent_config_state' in change:
+                    agent['agent_config_state'] = change['agent_config_state']
+        else:
+            self.__api_agent(path.split('/')[-1]).update(change)
+        return FakeResponse('{}')
+
+    def head(self, path, headers=None):
+        if path == "/go/api/admin/config.xml":
+            return FakeResponse('', self.md5)
         raise RuntimeError("not expecting to be asked for anything else")
 
+    def post(self, path, data, headers=None):
+        self.posts.append((path, data))
+        if path == "/go/api/admin/config.xml":
+            if data['md5'] != self.md5:
+                raise ConfigConflictError("Configuration file has been modified by someone else.")
+            self.update_config(data['xmlFile'])
+        else:
+            self.api_calls.append(('post', path, data, headers))
+
+    def put(self, path, data, headers=None):
+        self.api_calls.append(('put', path, data, headers))
+        return FakeResponse('{}')
+
+    def delete(self, path, headers=None):
+        self.api_calls.append(('delete', path, None, headers))
+        return FakeResponse('{}')
+
+    def update_config(self, config_string):
+        self.config_string = config_string
+        self.md5 = str(int(self.md5) + 1)
+
 
 def load_file(config_name):
     with codecs.open('test-data/' + config_name + '.xml', encoding='utf-8') as xml_file:
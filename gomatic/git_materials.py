@@ -0,0 +1,115 @@
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from gomatic.material_index import normalize_git_url
+from gomatic.xml_operations import PossiblyMissingElement, ignore_patterns_in
+
+DEFAULT_MATERIAL_UPDATE_INTERVAL = 60  # seconds, GoCD's default for polling materials
+
+GitFingerprint = namedtuple('GitFingerprint', ['url', 'branch', 'destination_directory', 'ignore_patterns', 'invert_filter'])
+
+
+def git_fingerprint(git_element):
+    return GitFingerprint(normalize_git_url(git_element.attrib['url']),
+                          git_element.attrib.get('branch') or 'master',
+                          git_element.attrib.get('dest'),
+                          tuple(sorted(ignore_patterns_in(git_element))),
+                          git_element.attrib.get('invertFilter', 'false') == 'true')
+
+
+def git_elements_of(pipeline_elements):
+    """
+    (pipeline element, git material element) for every git material of the pipelines.
+    """
+    for pipeline_element in pipeline_elements:
+        for git_element in PossiblyMissingElement(pipeline_element).possibly_missing_child('materials').findall('git'):
+            yield pipeline_element, git_element
+
+
+class GitPollingReport(object):
+    """
+    The git materials of all pipelines grouped by fingerprint (repository, branch, destination directory and
+    filters). GoCD polls each distinct polling fingerprint once per material update interval, however many
+    pipelines use it.
+    """
+    def __init__(self, pipeline_elements):
+        self.pipelines = {}
+        self.polling = {}
+        for pipeline_element, git_element in git_elements_of(pipeline_elements):
+            fingerprint = git_fingerprint(git_element)
+            self.pipelines.setdefault(fingerprint, []).append(pipeline_element.attrib['name'])
+            self.polling.setdefault(fingerprint, set()).add(git_element.attrib.get('autoUpdate', 'true') == 'true')
+
+    def __repr__(self):
+        return 'GitPollingReport(%s repositories, %s polling fingerprints)' % (len(self.repositories), len(self.polling_fingerprints))
+
+    @property
+    def repositories(self):
+        return sorted(set(fingerprint.url for fingerprint in self.pipelines))
+
+    @property
+    def polling_fingerprints(self):
+        return [fingerprint for fingerprint in self.pipelines if True in self.polling[fingerprint]]
+
+    @property
+    def inconsistent_fingerprints(self):
+        """
+        Fingerprints used both with and without polling, which GoCD rejects.
+        """
+        return [fingerprint for fingerprint in self.pipelines if len(self.polling[fingerprint]) > 1]
+
+    def polling_materials_by_repository(self):
+        result = {}
+        for fingerprint in self.polling_fingerprints:
+            result[fingerprint.url] = result.get(fingerprint.url, 0) + len(self.pipelines[fingerprint])
+        return result
+
+    def estimated_polls_by_repository(self, period=DEFAULT_MATERIAL_UPDATE_INTERVAL, interval=DEFAULT_MATERIAL_UPDATE_INTERVAL):
+        """
+        The estimated number of polls of each repository in period seconds, when GoCD polls every interval seconds.
+        """
+        result = {}
+        for fingerprint in self.polling_fingerprints:
+            result[fingerprint.url] = result.get(fingerprint.url, 0) + float(period) / interval
+        return result
+
+    def estimated_polls(self, period=DEFAULT_MATERIAL_UPDATE_INTERVAL, interval=DEFAULT_MATERIAL_UPDATE_INTERVAL):
+        return sum(self.estimated_polls_by_repository(period, interval).values())
+
+
+def disable_polling(pipeline_elements, urls, track):
+    """
+    Sets autoUpdate="false" on every git material of the pipelines whose repository is one of urls, so that all
+    materials with the same fingerprint agree. track is called with each pipeline element before it is changed.
+    Returns the names of the pipelines changed.
+    """
+    repositories = set(normalize_git_url(url) for url in urls)
+    changed = []
+    for pipeline_element, git_element in git_elements_of(pipeline_elements):
+        if git_element.attrib.get('autoUpdate') == 'false' or normalize_git_url(git_element.attrib['url']) not in repositories:
+            continue
+        track(pipeline_element)
+        git_element.attrib['autoUpdate'] = 'false'
+        if not changed or changed[-1] != pipeline_element.attrib['name']:
+            changed.append(pipeline_element.attrib['name'])
+    return changed
+
+
+def enable_shallow_clone(pipeline_elements, url_pattern, track, dry_run=False):
+    """
+    Sets shallowClone="true" on every git material of the pipelines whose url, as written or normalized, matches
+    the shell style url_pattern (or on all of them if it is None). track is called with each pipeline element
+    before it is changed. Returns (pipeline name, url) for each material changed, or that would be if dry_run.
+    """
+    changed = []
+    for pipeline_element, git_element in git_elements_of(pipeline_elements):
+        url = git_element.attrib['url']
+        if git_element.attrib.get('shallowClone') == 'true':
+            continue
+        if url_pattern is not None and not (fnmatchcase(url, url_pattern) or fnmatchcase(normalize_git_url(url), url_pattern)):
+            continue
+        changed.append((pipeline_element.attrib['name'], url))
+        if not dry_run:
+            track(pipeline_element)
+            git_element.attrib['shallowClone'] = 'true'
+    return changed
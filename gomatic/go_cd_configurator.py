@@ -1,40 +1,127 @@
 #!/usr/bin/env python
 import argparse
+import hashlib
 import json
 import subprocess
 import sys
 import time
+import weakref
 import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 from decimal import Decimal
+from fnmatch import fnmatchcase
 from uuid import uuid4
 
 import requests
 
+from gomatic.capacity import DEFAULT_JOB_DURATION, CapacitySimulator
+from gomatic.commit_impact import impact_of_commit
+from gomatic.dependency_graph import PipelineDependencyGraph
+from gomatic.git_materials import GitPollingReport, disable_polling, enable_shallow_clone
 from gomatic.gocd.config_repos import ConfigRepos
 from gomatic.gocd.security import Security
 from gomatic.gocd.elastic import Elastic
 from gomatic.gocd.agents import Agent
-from gomatic.gocd.pipelines import Pipeline, PipelineGroup
+from gomatic.gocd.pipelines import Job, Pipeline, PipelineGroup, Stage
+from gomatic.gocd.tasks import Task
 from gomatic.gocd.repositories import Repository
 from gomatic.gocd.artifact_stores import ArtifactStores
-from gomatic.xml_operations import Ensurance, PossiblyMissingElement, move_all_to_end, prettify
+from gomatic.gocd.capabilities import ServerCapabilities
+from gomatic.material_index import MaterialIndex, normalize_git_url
+from gomatic.merge import MergeConflictError, three_way_merge
+from gomatic.pipeline_config_api import ConfigChanges, EntityDigests, PipelineConfigApi, unrepresentable_parts
+from gomatic.resource_index import ResourceIndex
+from gomatic.savepoints import Savepoint
+from gomatic.timers import TimerHistogram, spread_timers
+from gomatic.snapshot import ConfigSnapshot
+from gomatic.xml_operations import Ensurance, PossiblyMissingElement, canonical_digest, move_all_to_end, prettify
+
+MAX_MERGE_ATTEMPTS = 3
+REFRESH_MODES = ('full', 'verify', 'adopt')
+
+
+def _current_config_md5(host_rest_client):
+    response = host_rest_client.head("/go/api/admin/config.xml")
+    if response.status_code != 200:
+        return None
+    return response.headers.get('x-cruise-config-md5')
 
 
 class GoCdConfigurator(object):
-    def __init__(self, host_rest_client):
+    def __init__(self, host_rest_client, snapshot=None, server_version=None, version_cache=None):
+        """
+        The server version is only asked for when something needs it, unless it is given as server_version
+        or found in version_cache (see VersionCache).
+        """
         self.__host_rest_client = host_rest_client
-        self.__set_initial_config_xml()
-        self.__set_server_version()
+        self.__savepoints = []
+        self.__handed_out = {}
+        self.__caches = {}
+        self.__capabilities = None
+        self.__server_version = server_version
+        self.__version_cache = version_cache
+        if snapshot is None:
+            self.__set_initial_config_xml()
+        else:
+            self.__initial_config = snapshot.config
+            self._initial_md5 = snapshot.md5
+            self.__initial_digest = snapshot.digest
+            self.__xml_root = ET.fromstring(snapshot.config)
+            if self.__server_version is None:
+                self.__server_version = snapshot.server_version
+
+    @classmethod
+    def from_snapshot(cls, path, host_rest_client, max_age=None):
+        """
+        Builds a configurator from a snapshot written by save_snapshot, only asking the server for the md5 of its
+        config. Falls back to fetching the config from the server if the snapshot is missing, invalid, for a
+        different server, older than max_age seconds or not of the config the server has now.
+        """
+        snapshot = ConfigSnapshot.load(path, repr(host_rest_client), max_age)
+        if snapshot is not None and _current_config_md5(host_rest_client) != snapshot.md5:
+            snapshot = None
+        return cls(host_rest_client, snapshot)
+
+    def save_snapshot(self, path):
+        ConfigSnapshot(self.__initial_config, self._initial_md5, self.__initial_digest, self.server_version,
+                       repr(self.__host_rest_client)).save(path)
+        return self
 
     def __set_initial_config_xml(self):
-        initial_config, self._initial_md5 = self.__current_config_response()
-        if isinstance(initial_config, bytes):
-            self.__initial_config = initial_config.decode('ascii', errors='xmlcharrefreplace')
-        else:
-            self.__initial_config = initial_config.encode('ascii', errors='xmlcharrefreplace')
-        self.__xml_root = ET.fromstring(self.__initial_config)
+        self.__replace_root(self.__adopt_as_initial_config(self.__current_config_response()))
+
+    def __replace_root(self, xml_root):
+        self.__xml_root = xml_root
+        self.__savepoints = []
+        self.__handed_out = {}
+        self.__caches = {}
+
+    def __adopt_as_initial_config(self, response, xml_root=None):
+        if xml_root is None:
+            xml_root = ET.fromstring(response.content)
+        self.__initial_config = response.content
+        self._initial_md5 = response.headers['x-cruise-config-md5']
+        self.__initial_digest = canonical_digest(xml_root)
+        return xml_root
+
+    def __rebase_on_latest_config(self):
+        # the baseline only moves to their config once the merge has succeeded, so that after a conflict a save
+        # is still rejected rather than overwriting their changes
+        base = ET.fromstring(self.__initial_config)
+        response = self.__current_config_response()
+        theirs = ET.fromstring(response.content)
+        merged, conflicts = three_way_merge(base, self.__xml_root, theirs)
+        if conflicts:
+            raise MergeConflictError(conflicts)
+        self.__adopt_as_initial_config(response, theirs)
+        self.__replace_root(merged)
 
     def __set_server_version(self):
+        host = repr(self.__host_rest_client)
+        if self.__version_cache is not None:
+            self.__server_version = self.__version_cache.get(host)
+            if self.__server_version is not None:
+                return
         version_url = "/go/api/version"
         response = self.__host_rest_client.get(version_url)
         if response.status_code == 404:
@@ -44,6 +131,8 @@ class GoCdConfigurator(object):
             self.__server_version = data['version']
         else:
             raise Exception("Failed to get {} status {}\n:{}".format(version_url, response.status_code, response.text))
+        if self.__version_cache is not None:
+            self.__version_cache.put(host, self.__server_version)
 
 
     def __repr__(self):
@@ -60,19 +149,27 @@ class GoCdConfigurator(object):
 
     @property
     def current_config(self):
-        return self.__current_config_response()[0]
+        return self.__current_config_response().text
 
     @property
     def server_version(self):
+        if self.__server_version is None:
+            self.__set_server_version()
         return self.__server_version
 
+    @property
+    def capabilities(self):
+        if self.__capabilities is None or self.__capabilities.version != self.server_version:
+            self.__capabilities = ServerCapabilities(self.server_version)
+        return self.__capabilities
+
     def __current_config_response(self):
         config_url = "/go/api/admin/config.xml"
         response = self.__host_rest_client.get(config_url)
 
         if response.status_code != 200:
             raise Exception("Failed to get {} status {}\n:{}".format(config_url, response.status_code, response.text))
-        return response.text, response.headers['x-cruise-config-md5']
+        return response
 
     def reorder_elements_to_please_go(self):
         move_all_to_end(self.__xml_root, 'pipelines')
@@ -80,12 +177,95 @@ class GoCdConfigurator(object):
         move_all_to_end(self.__xml_root, 'environments')
         move_all_to_end(self.__xml_root, 'agents')
 
-        for pipeline_group in self.pipeline_groups:
+        # wrappers are built directly so that reordering does not count as touching everything inside a transaction
+        for group_element in self.__xml_root.findall('pipelines'):
+            pipeline_group = PipelineGroup(group_element, self)
             pipeline_group.reorder_elements_to_please_go()
-        for pipeline in self.pipelines:
-            pipeline.reorder_elements_to_please_go()
-        for template in self.templates:
-            template.reorder_elements_to_please_go()
+            for pipeline_element in group_element.findall('pipeline'):
+                Pipeline(pipeline_element, pipeline_group).reorder_elements_to_please_go()
+        for template_element in PossiblyMissingElement(self.__xml_root).possibly_missing_child('templates').findall('pipeline'):
+            Pipeline(template_element, 'templates').reorder_elements_to_please_go()
+
+    def savepoint(self):
+        savepoint = Savepoint(self.__xml_root, self.__handed_out)
+        self.__savepoints.append(savepoint)
+        return savepoint
+
+    def rollback_to(self, savepoint):
+        if savepoint not in self.__savepoints:
+            raise RuntimeError("Cannot roll back to a savepoint that has been released or was taken before the config was reloaded")
+        savepoint.rollback()
+        del self.__savepoints[self.__savepoints.index(savepoint) + 1:]
+        self._invalidate_caches()
+        return self
+
+    def release(self, savepoint):
+        if savepoint in self.__savepoints:
+            del self.__savepoints[self.__savepoints.index(savepoint):]
+        return self
+
+    @contextmanager
+    def transaction(self):
+        savepoint = self.savepoint()
+        try:
+            yield savepoint
+        except:
+            if savepoint in self.__savepoints:
+                self.rollback_to(savepoint)
+            raise
+        finally:
+            self.release(savepoint)
+
+    def _cached(self, name, build):
+        if name not in self.__caches:
+            self.__caches[name] = build()
+        return self.__caches[name]
+
+    def _cache(self, name):
+        """
+        The named cache if it has been built, so that changes can be applied to it rather than building it.
+        """
+        return self.__caches.get(name)
+
+    def _element_index(self, name, element, build):
+        """
+        The named index of element, built with build() on first use and rebuilt if element has been replaced.
+        """
+        cached = self.__caches.get(name)
+        if cached is None or cached[0] is not element:
+            cached = self.__caches[name] = (element, build())
+        return cached[1]
+
+    def _invalidate_caches(self, *names):
+        if not names:
+            self.__caches = {}
+        for name in names:
+            self.__caches.pop(name, None)
+
+    def _track(self, element):
+        """
+        Records element (a pipeline, template or top level section) in the savepoints taken so far, before it is
+        changed, so that they can roll it back.
+        """
+        if element is not None:
+            for savepoint in self.__savepoints:
+                savepoint.record(element)
+        return element
+
+    def _hand_out(self, wrapper, element=None):
+        """
+        Records element (by default wrapper.element) in the savepoints taken so far, and in every savepoint taken
+        while wrapper is still in use, as it can be changed through wrapper. Returns wrapper.
+        """
+        element = wrapper.element if element is None else element
+        if element is not None:
+            self._track(element)
+            handed_out, key = self.__handed_out, id(wrapper)
+            handed_out[key] = (weakref.ref(wrapper, lambda _: handed_out.pop(key, None)), element)
+        return wrapper
+
+    def __section(self, tag):
+        return self.__xml_root.find(tag)
 
     @property
     def config(self):
@@ -164,20 +344,22 @@ class GoCdConfigurator(object):
         matching = [g for g in self.pipeline_groups if g.name == group_name]
         for group in matching:
             self.__xml_root.remove(group.element)
+        self._invalidate_caches()
         return self
 
     def remove_all_pipeline_groups(self):
         for e in self.__xml_root.findall('pipelines'):
             self.__xml_root.remove(e)
+        self._invalidate_caches()
         return self
 
     @property
     def config_repos(self):
-        return ConfigRepos(self.__xml_root.find('config-repos'), self)
+        return self._hand_out(ConfigRepos(self.__section('config-repos'), self))
 
     def ensure_config_repos(self):
         config_repos = Ensurance(self.__xml_root).ensure_child("config-repos")
-        return ConfigRepos(config_repos.element, self)
+        return self._hand_out(ConfigRepos(config_repos.element, self))
 
     def ensure_replacement_of_config_repos(self):
         config_repos = self.ensure_config_repos()
@@ -199,39 +381,250 @@ class GoCdConfigurator(object):
 
     @property
     def repositories(self):
-        return [Repository(e) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('repositories').findall('repository')]
+        section = self.__section('repositories')
+        return [self._hand_out(Repository(e, self), section) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('repositories').findall('repository')]
+
+    def __repositories_by(self, attribute):
+        return self._cached('repositories_by_' + attribute, lambda: dict(
+            (e.attrib.get(attribute), e) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('repositories').findall('repository')))
+
+    def find_repository(self, name=None, repository_id=None):
+        """
+        The repository with the given name or id, or None, looked up in an index built on first use.
+        """
+        if name is not None:
+            element = self.__repositories_by('name').get(name)
+        else:
+            element = self.__repositories_by('id').get(repository_id)
+        return self._hand_out(Repository(element, self), self.__section('repositories')) if element is not None else None
 
     def ensure_repository(self, repository_name):
-        ensured_repository_element = Ensurance(self.__xml_root).ensure_child('repositories').ensure_child_with_attribute('repository', 'name', repository_name)
-        if not ensured_repository_element.has_attribute('id'):
-            ensured_repository_element.set('id', str(uuid4()))
-        return Repository(ensured_repository_element.element)
+        repositories_element = self._track(Ensurance(self.__xml_root).ensure_child('repositories').element)
+        element = self.__repositories_by('name').get(repository_name)
+        if element is None:
+            element = ET.SubElement(repositories_element, 'repository', {'name': repository_name})
+            self.__repositories_by('name')[repository_name] = element
+        if 'id' not in element.attrib:
+            element.set('id', str(uuid4()))
+            self.__repositories_by('id')[element.attrib['id']] = element
+        return self._hand_out(Repository(element, self), repositories_element)
+
+    def package_usage(self):
+        """
+        {package id: names of the pipelines with a package material on it} for every package of every repository,
+        read from the material index.
+        """
+        return dict((package.id, self.material_index.pipelines_using_package(package.id))
+                    for repository in self.repositories for package in repository.packages)
 
     @property
     def agents(self):
-        return [Agent(e) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('agents').findall('agent')]
+        section = self.__section('agents')
+        return [self._hand_out(Agent(e), section) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('agents').findall('agent')]
 
     def ensure_removal_of_agent(self, hostname):
-        matching = [agent for agent in self.agents if agent.hostname == hostname]
-        for agent in matching:
-            Ensurance(self.__xml_root).ensure_child('agents').element.remove(agent.element)
+        return self.ensure_removal_of_agents([hostname])
+
+    def ensure_removal_of_agents(self, hostnames):
+        hostnames = set(hostnames)
+        agents_element = self._track(self.__section('agents'))
+        if agents_element is not None:
+            agents_element[:] = [e for e in agents_element if e.attrib.get('hostname') not in hostnames]
+            self._invalidate_caches('agents_by_hostname', 'agents_by_uuid')
         return self
 
+    def __agents_by(self, attribute):
+        return self._cached('agents_by_' + attribute, lambda: dict(
+            (e.attrib.get(attribute), e) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('agents').findall('agent')))
+
+    def find_agent(self, hostname=None, uuid=None):
+        """
+        The agent with the given hostname or uuid, or None, looked up in an index built on first use.
+        """
+        element = self.__agents_by('hostname').get(hostname) if uuid is None else self.__agents_by('uuid').get(uuid)
+        return self._hand_out(Agent(element), self.__section('agents')) if element is not None else None
+
+    def sync_agent_resources(self, resources_by_hostname):
+        """
+        Makes the resources of each agent named in resources_by_hostname exactly the given ones, leaving other
+        agents alone. Returns the hostnames of the agents changed.
+        """
+        changed = []
+        for hostname, resources in sorted(resources_by_hostname.items()):
+            element = self.__agents_by('hostname').get(hostname)
+            if element is not None and Agent(element).resources != set(resources):
+                self._track(self.__section('agents'))
+                Agent(element).set_resources(resources)
+                changed.append(hostname)
+        return changed
+
     @property
     def pipelines(self):
-        result = []
-        groups = self.pipeline_groups
-        for group in groups:
-            result.extend(group.pipelines)
-        return result
+        return list(self.iter_pipelines())
+
+    def iter_pipelines(self, group=None, name=None, template=None, material_url=None):
+        """
+        Yields the pipelines in the given group, whose name matches the shell style pattern name, that are based on
+        the given template or that have a git material with the given url. Filters are checked before any wrappers
+        are built, so stopping early (e.g. with next()) only costs what was looked at.
+        """
+        pipeline_group = None
+        for group_element, pipeline_element in self.__iter_pipeline_elements(group, name, template, material_url):
+            if pipeline_group is None or pipeline_group.element is not group_element:
+                pipeline_group = PipelineGroup(group_element, self)
+            yield self._hand_out(Pipeline(pipeline_element, pipeline_group))
+
+    def __iter_pipeline_elements(self, group=None, name=None, template=None, material_url=None):
+        git_url = normalize_git_url(material_url) if material_url is not None else None
+        for group_element in self.__xml_root.findall('pipelines'):
+            if group is not None and group_element.attrib.get('group') != group:
+                continue
+            for pipeline_element in group_element.findall('pipeline'):
+                if name is not None and not fnmatchcase(pipeline_element.attrib['name'], name):
+                    continue
+                if template is not None and pipeline_element.attrib.get('template') != template:
+                    continue
+                if git_url is not None and not _has_git_url(pipeline_element, git_url):
+                    continue
+                yield group_element, pipeline_element
+
+    def iter_jobs(self, group=None, name=None, template=None, material_url=None, resource=None):
+        """
+        Yields the jobs of the pipelines iter_pipelines would yield for the same filters, optionally only those
+        that need the given resource. A pipeline based on a template runs the template's jobs, so those are
+        yielded for it, with the template as the pipeline of their stage.
+        """
+        templates = None
+        for pipeline in self.iter_pipelines(group, name, template, material_url):
+            stages_from = pipeline.element
+            if 'template' in pipeline.element.attrib:
+                if templates is None:
+                    templates = dict((e.attrib['name'], e) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('templates').findall('pipeline'))
+                stages_from = templates.get(pipeline.element.attrib['template'])
+                if stages_from is None:
+                    continue
+            parent = None
+            for stage_element in stages_from.findall('stage'):
+                stage = None
+                for job_element in PossiblyMissingElement(stage_element).possibly_missing_child('jobs').findall('job'):
+                    if resource is not None and not _needs_resource(job_element, resource):
+                        continue
+                    if stage is None:
+                        if parent is None:
+                            parent = pipeline if stages_from is pipeline.element else self._hand_out(Pipeline(stages_from, 'templates'))
+                        stage = Stage(stage_element, parent)
+                    yield Job(job_element, stage)
+
+    def iter_tasks(self, group=None, name=None, template=None, material_url=None, resource=None):
+        for job in self.iter_jobs(group, name, template, material_url, resource):
+            for task_element in PossiblyMissingElement(job.element).possibly_missing_child('tasks').iterator:
+                yield Task(task_element)
+
+    def __all_pipeline_elements(self):
+        return [e for group_element in self.__xml_root.findall('pipelines') for e in group_element.findall('pipeline')]
+
+    @property
+    def material_index(self):
+        """
+        A MaterialIndex of the git and package materials of all pipelines, built on first use.
+        """
+        return self._cached('material_index', lambda: MaterialIndex(self.__all_pipeline_elements()))
+
+    def __pipeline_elements_by_name(self):
+        return self._cached('pipeline_elements_by_name', lambda: dict(
+            (e.attrib['name'], (group_element, e)) for group_element in self.__xml_root.findall('pipelines')
+            for e in group_element.findall('pipeline')))
+
+    def __pipelines_named(self, names):
+        pipelines = []
+        for name in names:
+            found = self.__pipeline_elements_by_name().get(name)
+            if found is not None:
+                group_element, pipeline_element = found
+                pipelines.append(self._hand_out(Pipeline(pipeline_element, PipelineGroup(group_element, self))))
+        return pipelines
+
+    def pipelines_using_git(self, url, branch=None):
+        return self.__pipelines_named(self.material_index.pipelines_using_git(url, branch))
+
+    def pipelines_using_package(self, package_ref):
+        return self.__pipelines_named(self.material_index.pipelines_using_package(package_ref))
+
+    def git_polling_report(self):
+        return GitPollingReport(self.__all_pipeline_elements())
+
+    def disable_git_polling(self, urls):
+        """
+        Stops GoCD polling the git repositories at urls (e.g. because they notify GoCD with webhooks), for every
+        pipeline in one pass. Returns the names of the pipelines changed.
+        """
+        return disable_polling(self.__all_pipeline_elements(), urls, self._track)
+
+    def ensure_shallow_clones(self, url=None, group=None, template=None, dry_run=False):
+        """
+        Sets shallowClone on every git material whose url matches the shell style pattern url, of the pipelines
+        in group or based on template, keeping everything else about the materials. Returns (pipeline name, url)
+        for each material changed, or that would be changed if dry_run.
+        """
+        pipeline_elements = [e for _, e in self.__iter_pipeline_elements(group=group, template=template)]
+        return enable_shallow_clone(pipeline_elements, url, self._track, dry_run)
+
+    def resource_index(self):
+        """
+        A ResourceIndex of the resources the agents have and the jobs need, e.g. to find jobs no agent can run.
+        """
+        root = PossiblyMissingElement(self.__xml_root)
+        return ResourceIndex(root.possibly_missing_child('agents').findall('agent'), self.__all_pipeline_elements(),
+                             root.possibly_missing_child('templates').findall('pipeline'))
+
+    def capacity_simulator(self, default_duration=DEFAULT_JOB_DURATION, durations=None):
+        """
+        A CapacitySimulator of the pipelines and agents as they are now. durations maps a JobReference to how
+        many seconds the job takes, default_duration is used for the others.
+        """
+        root = PossiblyMissingElement(self.__xml_root)
+        return CapacitySimulator(self.__all_pipeline_elements(), root.possibly_missing_child('templates').findall('pipeline'),
+                                 root.possibly_missing_child('agents').findall('agent'), default_duration, durations)
+
+    def timer_histogram(self):
+        return TimerHistogram(self.__all_pipeline_elements())
+
+    def spread_timers(self, window, group=None, name=None, timer=None, base=None):
+        """
+        Spreads the starts of the timers of the pipelines in group, whose name matches the shell style pattern
+        name and whose timer spec is timer (if given), over the window seconds after base (the seconds, minutes and
+        hours fields of a timer spec, e.g. '0 0 2'; by default the start of timer). Only timers starting in that
+        window are moved, to a start that depends only on base and the pipeline name, so running this again
+        changes nothing. Returns {pipeline name: new timer spec} for the timers changed.
+        """
+        pipeline_elements = [e for _, e in self.__iter_pipeline_elements(group=group, name=name)]
+        return spread_timers(pipeline_elements, window, self._track, timer, base)
+
+    def commit_impact(self, url, branch, changed_paths):
+        """
+        The CommitImpact of a commit changing changed_paths on the branch of the git repository at url: which
+        pipelines GoCD schedules, directly or through pipeline materials, and how many jobs they run.
+        """
+        root = PossiblyMissingElement(self.__xml_root)
+        return impact_of_commit(self.__all_pipeline_elements(), root.possibly_missing_child('templates').findall('pipeline'),
+                                root.possibly_missing_child('agents').findall('agent'), self.material_index,
+                                url, branch, changed_paths)
+
+    @property
+    def dependency_graph(self):
+        """
+        A PipelineDependencyGraph of all pipelines, built on first use and then kept up to date as pipeline
+        materials are added and removed.
+        """
+        return self._cached('dependency_graph', lambda: PipelineDependencyGraph(self.__all_pipeline_elements()))
 
     @property
     def templates(self):
-        return [Pipeline(e, 'templates') for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('templates').findall('pipeline')]
+        return [self._hand_out(Pipeline(e, 'templates')) for e in PossiblyMissingElement(self.__xml_root).possibly_missing_child('templates').findall('pipeline')]
 
     def ensure_template(self, template_name):
         pipeline_element = Ensurance(self.__xml_root).ensure_child('templates').ensure_child_with_attribute('pipeline', 'name', template_name).element
-        return Pipeline(pipeline_element, 'templates')
+        return self._hand_out(Pipeline(pipeline_element, 'templates'))
 
     def ensure_replacement_of_template(self, template_name):
         template = self.ensure_template(template_name)
@@ -250,7 +643,7 @@ class GoCdConfigurator(object):
 
     def ensure_security(self):
         security_element = self.__server_element_ensurance().ensure_child('security').element
-        return Security(security_element)
+        return Security(security_element, self)
 
     def ensure_replacement_of_security(self):
         security = self.ensure_security()
@@ -259,16 +652,14 @@ class GoCdConfigurator(object):
 
     @property
     def security(self):
-        return Security(self.__server_element_ensurance().element.find('security'))
+        return Security(self.__server_element_ensurance().element.find('security'), self)
 
     def ensure_elastic(self):
-        gocd_version_with_elastic_outside_server_tag = 18
-        gocd_major_version = int(self.server_version.split('.')[0])
-        if gocd_major_version < gocd_version_with_elastic_outside_server_tag:
+        if not self.capabilities.elastic_outside_server:
             elastic_element = self.__server_element_ensurance().ensure_child('elastic').element
         else:
             elastic_element = Ensurance(self.__xml_root).ensure_child('elastic').element
-        return Elastic(elastic_element)
+        return Elastic(elastic_element, self)
 
     def ensure_replacement_of_elastic(self):
         elastic = self.ensure_elastic()
@@ -277,28 +668,40 @@ class GoCdConfigurator(object):
 
     @property
     def elastic(self):
-        gocd_version_with_elastic_outside_server_tag = 18
-        gocd_major_version = int(self.server_version.split('.')[0])
-        if gocd_major_version < gocd_version_with_elastic_outside_server_tag:
-            elastic_element = Elastic(self.__server_element_ensurance().element.find('elastic'))
+        if not self.capabilities.elastic_outside_server:
+            elastic_element = Elastic(self.__server_element_ensurance().element.find('elastic'), self)
         else:
-            elastic_element = Elastic(Ensurance(self.__xml_root).element.find('elastic'))
+            elastic_element = Elastic(Ensurance(self.__xml_root).element.find('elastic'), self)
         return elastic_element
 
     @property
     def git_urls(self):
-        return [pipeline.git_url for pipeline in self.pipelines if pipeline.has_single_git_material]
+        return self.material_index.git_urls
 
     @property
     def has_changes(self):
-        return prettify(self.__initial_config) != prettify(self.config)
-
-    def save_updated_config(self, save_config_locally=False, dry_run=False):
-        config_before = prettify(self.__initial_config)
-        config_after = prettify(self.config)
+        self.reorder_elements_to_please_go()
+        return canonical_digest(self.__xml_root) != self.__initial_digest
+
+    def save_updated_config(self, save_config_locally=False, dry_run=False, merge_on_conflict=False, use_pipeline_api=False,
+                            refresh='full'):
+        """
+        refresh says how the config is brought up to date after saving:
+        'full' fetches and parses the whole config again,
+        'verify' fetches it and keeps the config as it is here (along with any wrappers and indexes) if the server
+        stored the same config, however it is formatted, and otherwise uses the server's,
+        'adopt' only asks the server for its new md5 and keeps what was posted if the md5 is that of what was
+        posted, otherwise it carries on as 'verify'. GoCD normally writes the config out itself, so the md5 rarely
+        matches and 'adopt' usually costs what 'verify' does. After saving through the pipeline API nothing was
+        posted to compare an md5 with, so 'adopt' is 'verify' there.
+        """
+        if refresh not in REFRESH_MODES:
+            raise RuntimeError('Cannot refresh config with "%s" - it must be one of %s' % (refresh, REFRESH_MODES))
+        config_after = self.config
+        has_changes = canonical_digest(self.__xml_root) != self.__initial_digest
         if save_config_locally:
-            open('config-before.xml', 'w').write(config_before)
-            open('config-after.xml', 'w').write(config_after)
+            open('config-before.xml', 'w').write(prettify(self.__initial_config))
+            open('config-after.xml', 'w').write(prettify(config_after))
 
             def has_kdiff3():
                 try:
@@ -306,22 +709,123 @@ class GoCdConfigurator(object):
                 except:
                     return False
 
-            if dry_run and config_before != config_after and has_kdiff3():
+            if dry_run and has_changes and has_kdiff3():
                 subprocess.call(["kdiff3", "config-before.xml", "config-after.xml"])
 
+        if not dry_run and has_changes:
+            if use_pipeline_api:
+                try:
+                    saved_through_pipeline_api = self.__save_through_pipeline_api()
+                except Exception:
+                    self.__rebase_after_failed_api_save()
+                    raise
+                if saved_through_pipeline_api:
+                    if refresh == 'full':
+                        self.__set_initial_config_xml()
+                    else:
+                        self.__adopt_server_config(self.__current_config_response())
+                    return
+            merge_attempts = 0
+            while True:
+                try:
+                    self.__post_config(config_after)
+                    break
+                except ConfigConflictError:
+                    merge_attempts += 1
+                    if not merge_on_conflict or merge_attempts > MAX_MERGE_ATTEMPTS:
+                        raise
+                    self.__rebase_on_latest_config()
+                    config_after = self.config
+            self.__refresh_after_post(config_after, refresh)
+
+    def __refresh_after_post(self, posted_config, refresh):
+        if refresh == 'adopt':
+            md5 = self.__current_config_md5()
+            if md5 == hashlib.md5(posted_config).hexdigest():
+                self.__adopt_posted_config(posted_config, md5)
+                return
+        if refresh in ('verify', 'adopt'):
+            response = self.__current_config_response()
+            if hashlib.md5(response.content).hexdigest() == hashlib.md5(posted_config).hexdigest():
+                self.__adopt_posted_config(posted_config, response.headers['x-cruise-config-md5'])
+            else:
+                self.__adopt_server_config(response)
+            return
+        self.__set_initial_config_xml()
+
+    def __adopt_server_config(self, response):
+        # the server's copy usually only differs in how it is written out, in which case the tree is kept
+        server_root = ET.fromstring(response.content)
+        if canonical_digest(server_root) == canonical_digest(self.__xml_root):
+            self.__adopt_as_initial_config(response, server_root)
+            self.__savepoints = []
+        else:
+            self.__replace_root(self.__adopt_as_initial_config(response, server_root))
+
+    def __adopt_posted_config(self, posted_config, md5):
+        self.__initial_config = posted_config
+        self._initial_md5 = md5
+        self.__initial_digest = canonical_digest(self.__xml_root)
+        self.__savepoints = []
+
+    def __current_config_md5(self):
+        return _current_config_md5(self.__host_rest_client)
+
+    def __save_through_pipeline_api(self):
+        baseline = EntityDigests(ET.fromstring(self.__initial_config))
+        changes = ConfigChanges(baseline, EntityDigests(self.__xml_root))
+        if changes.has_other_changes:
+            return False
+        pipeline_names = set(changes.added_pipelines + changes.changed_pipelines)
+        template_names = set(changes.added_templates + changes.changed_templates)
+        pipelines = dict((p.name, p) for p in self.pipelines if p.name in pipeline_names)
+        templates = dict((t.name, t) for t in self.templates if t.name in template_names)
+        if [p for p in list(pipelines.values()) + list(templates.values()) if unrepresentable_parts(p.element, p.is_template)]:
+            return False
+        api = PipelineConfigApi(self.__host_rest_client)
+        etags = api.etags(changes)
+        self.__check_unchanged_on_server(changes, baseline)
+        api.save(changes, pipelines, templates, etags)
+        return True
+
+    def __check_unchanged_on_server(self, changes, baseline):
+        if self.__current_config_md5() == self._initial_md5:
+            return
+        current = EntityDigests(ET.fromstring(self.__current_config_response().content))
+        conflicts = changes.conflicts(baseline, current)
+        if conflicts:
+            raise ConfigConflictError("Changed on the server since the config was fetched: %s" % ", ".join(conflicts))
+
+    def __rebase_after_failed_api_save(self):
+        # some changes may have reached the server, so what is left to save is measured against what it has now
+        try:
+            self.__rebase_on_latest_config()
+        except MergeConflictError:
+            pass
+
+    def __post_config(self, config):
         data = {
-            'xmlFile': self.config,
+            'xmlFile': config,
             'md5': self._initial_md5
         }
+        headers = {
+            "Confirm": "true",
+        }
+        if self.__host_rest_client.access_token is not None:
+            headers["Authorization"] = "Bearer %s" % self.__host_rest_client.access_token
+        self.__host_rest_client.post('/go/api/admin/config.xml', data, headers)
+
+
+def _has_git_url(pipeline_element, normalized_url):
+    return any(normalize_git_url(e.attrib.get('url', '')) == normalized_url for e in PossiblyMissingElement(pipeline_element).possibly_missing_child('materials').findall('git'))
+
+
+def _needs_resource(job_element, resource):
+    return any(e.text == resource for e in PossiblyMissingElement(job_element).possibly_missing_child('resources').findall('resource'))
 
-        if not dry_run and config_before != config_after:
-            headers = {
-                "Confirm": "true",
-            }
-            if self.__host_rest_client.access_token is not None:
-                headers["Authorization"] = "Bearer %s" % self.__host_rest_client.access_token
-            self.__host_rest_client.post('/go/api/admin/config.xml', data, headers)
-            self.__set_initial_config_xml()
+
+class ConfigConflictError(RuntimeError):
+    pass
 
 
 class HostRestClient(object):
@@ -343,28 +847,54 @@ class HostRestClient(object):
     def __auth(self):
         return (self.__username, self.__password) if self.__username or self.__password else None
 
-    def get(self, path):
-        header = {'Accept': 'application/vnd.go.cd.v1+json'}
+    def __headers(self, headers):
+        result = dict(headers or {})
         if self.__access_token is not None:
-            header["Authorization"] = "Bearer %s" % self.__access_token
+            result["Authorization"] = "Bearer %s" % self.__access_token
+        return result
+
+    def get(self, path, headers=None):
+        header = {'Accept': 'application/vnd.go.cd.v1+json'}
+        header.update(headers or {})
+        header = self.__headers(header)
         result = requests.get(self.__path(path), auth=self.__auth(), verify=self.__verify_ssl, headers=header)
         count = 0
         while ((result.status_code == 503) or (result.status_code == 504)) and (count < 5):
-            result = requests.get(self.__path(path))
             time.sleep(1)
+            result = requests.get(self.__path(path), auth=self.__auth(), verify=self.__verify_ssl, headers=header)
             count += 1
         return result
 
     def post(self, path, data, headers=None):
         url = self.__path(path)
-        result = requests.post(url, data, auth=self.__auth(), verify=self.__verify_ssl, headers=headers)
+        result = requests.post(url, data, auth=self.__auth(), verify=self.__verify_ssl, headers=self.__headers(headers))
         if result.status_code != 200:
+            error_type = ConfigConflictError if result.status_code == 409 else RuntimeError
             try:
                 result_json = json.loads(result.text.replace("\\'", "'"))
                 message = result_json.get('result', result.text)
-                raise RuntimeError("Could not post config to Go server (%s) [status code=%s]:\n%s" % (url, result.status_code, message))
+                raise error_type("Could not post config to Go server (%s) [status code=%s]:\n%s" % (url, result.status_code, message))
             except ValueError:
-                raise RuntimeError("Could not post config to Go server (%s) [status code=%s] (and result was not json):\n%s" % (url, result.status_code, result))
+                raise error_type("Could not post config to Go server (%s) [status code=%s] (and result was not json):\n%s" % (url, result.status_code, result))
+
+    def head(self, path, headers=None):
+        return requests.head(self.__path(path), auth=self.__auth(), verify=self.__verify_ssl, headers=self.__headers(headers))
+
+    def put(self, path, data, headers=None):
+        return self.__checked('put', path, requests.put(self.__path(path), data, auth=self.__auth(), verify=self.__verify_ssl, headers=self.__headers(headers)))
+
+    def patch(self, path, data, headers=None):
+        return self.__checked('patch', path, requests.patch(self.__path(path), data, auth=self.__auth(), verify=self.__verify_ssl, headers=self.__headers(headers)))
+
+    def delete(self, path, headers=None):
+        return self.__checked('delete', path, requests.delete(self.__path(path), auth=self.__auth(), verify=self.__verify_ssl, headers=self.__headers(headers)))
+
+    def __checked(self, method, path, result):
+        if result.status_code == 409 or result.status_code == 412:
+            raise ConfigConflictError("Could not %s %s [status code=%s]:\n%s" % (method, path, result.status_code, result.text))
+        if result.status_code < 200 or result.status_code >= 300:
+            raise RuntimeError("Could not %s %s [status code=%s]:\n%s" % (method, path, result.status_code, result.text))
+        return result
 
     @property
     def access_token(self):
@@ -1,3 +1,5 @@
+from xml.etree import ElementTree as ET
+
 from gomatic.gocd.generic import ResourceMixin
 from gomatic.mixins import CommonEqualityMixin
 
@@ -9,3 +11,20 @@ class Agent(CommonEqualityMixin, ResourceMixin):
     @property
     def hostname(self):
         return self.element.attrib['hostname']
+
+    @property
+    def uuid(self):
+        return self.element.attrib.get('uuid')
+
+    def set_resources(self, resources):
+        """
+        Replaces all the agent's resources with resources.
+        """
+        resources_element = self.element.find('resources')
+        if resources_element is not None:
+            self.element.remove(resources_element)
+        if resources:
+            resources_element = ET.SubElement(self.element, 'resources')
+            for resource in sorted(resources):
+                ET.SubElement(resources_element, 'resource').text = resource
+        return self
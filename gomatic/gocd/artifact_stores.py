@@ -1,5 +1,6 @@
 import xml.etree.ElementTree as ET
 
+from gomatic.gocd.properties import PropertyBag
 from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import PossiblyMissingElement
 
@@ -18,10 +19,11 @@ class ArtifactStore(CommonEqualityMixin):
 
     @property
     def properties(self):
-        props = {}
-        for prop in self.element.findall('property'):
-            props[prop.find('key').text] = prop.find('value').text
-        return props
+        return dict(self.configuration)
+
+    @property
+    def configuration(self):
+        return PropertyBag(self.element)
 
     def __eq__(self, other):
         return self.id == other.id
@@ -36,9 +38,8 @@ class ArtifactStores(CommonEqualityMixin):
         return [ArtifactStore(e) for e in PossiblyMissingElement(self.element).findall('artifactStore')]
 
     def ensure_artifact_store(self, id, plugin_id, properties):
-        properties_xml = "".join(["<property><key>{}</key><value>{}</value></property>".format(k, str(v or '')) for k, v in properties.items()])
-        new_element = ET.fromstring('<artifactStore id="{}" pluginId="{}">{}</artifactStore>'.format(id, plugin_id, properties_xml))
-        self.element.append(new_element)
+        new_element = ET.SubElement(self.element, 'artifactStore', {'id': id, 'pluginId': plugin_id})
+        PropertyBag(new_element).update(properties)
         return ArtifactStore(new_element)
 
     def ensure_replacement_of_artifact_store(self, id, plugin_id, properties):
@@ -0,0 +1,26 @@
+import re
+
+DEFAULT_VERSION = '17.11.0'  # assumed for wrappers that are not attached to a configurator
+
+
+def version_tuple(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version))
+
+
+class ServerCapabilities(object):
+    """
+    What a GoCD server version supports, worked out once from its version string.
+    """
+    def __init__(self, version):
+        self.version = version
+        parsed = version_tuple(version)
+        self.elastic_outside_server = parsed >= (18,)
+        self.artifacts_have_type = parsed >= (18, 3)
+        self.config_repo_has_id = parsed >= (17, 8, 0)
+        self.config_repo_plugin_attribute = 'pluginId' if parsed >= (17, 9, 0) else 'plugin'
+
+    def __repr__(self):
+        return 'ServerCapabilities("%s")' % self.version
+
+
+DEFAULT_CAPABILITIES = ServerCapabilities(DEFAULT_VERSION)
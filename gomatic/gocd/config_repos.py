@@ -1,30 +1,29 @@
 import xml.etree.ElementTree as ET
 import uuid
 
-from distutils.version import LooseVersion
-
+from gomatic.gocd.capabilities import ServerCapabilities
+from gomatic.gocd.generic import SharedIndex
+from gomatic.gocd.properties import PropertyBag
 from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import PossiblyMissingElement
 
 
-ATTR_NAME_CHANGE_VERSION = LooseVersion("17.9.0")
-ID_INTRODUCED_VERSION = LooseVersion("17.8.0")
-
-
 def has_new_attr_name(version):
-    return LooseVersion(version) >= ATTR_NAME_CHANGE_VERSION
+    return ServerCapabilities(version).config_repo_plugin_attribute == 'pluginId'
 
 
 def has_id(version):
-    return LooseVersion(version) >= ID_INTRODUCED_VERSION
+    return ServerCapabilities(version).config_repo_has_id
 
 
 class ConfigRepo(CommonEqualityMixin):
     valid_cvs = ['git', 'svn', 'hg', 'p4', 'tfs']
 
     def __init__(self, element, version):
+        # version can be a version string or the ServerCapabilities of the server
         self.element = element
-        self.version = version
+        self.capabilities = version if isinstance(version, ServerCapabilities) else ServerCapabilities(version)
+        self.version = self.capabilities.version
 
     @property
     def url(self):
@@ -36,25 +35,24 @@ class ConfigRepo(CommonEqualityMixin):
 
     @property
     def cvs(self):
-        for c in self.element.getchildren():
+        for c in self.element:
             if c.tag in ConfigRepo.valid_cvs:
                 return c.tag
+        for c in self.element:
+            if 'url' in c.attrib:
+                return c.tag
 
     @property
     def configuration(self):
-        config = {}
-        for p in self.element.find('configuration').getchildren():
-            config[p.find('key').text] = p.find('value').text
-        return config
+        return PropertyBag(self.element, 'configuration')
 
     @property
     def plugin(self):
-        key = 'pluginId' if has_new_attr_name(self.version) else 'plugin'
-        return self.element.get(key)
+        return self.element.get(self.capabilities.config_repo_plugin_attribute)
 
     @property
     def repo_id(self):
-        if has_id(self.version):
+        if self.capabilities.config_repo_has_id:
             return self.element.get('id')
         else:
             return None
@@ -70,48 +68,116 @@ class ConfigRepo(CommonEqualityMixin):
         return self.url == other.url and self.plugin == other.plugin
 
 
+def _set_or_remove(element, name, value):
+    if element.get(name) == value:
+        return False
+    if value is None:
+        del element.attrib[name]
+    else:
+        element.set(name, value)
+    return True
+
+
+def _add_to_index(index, repo):
+    by_key, by_url, by_id = index
+    by_key.setdefault((repo.url, repo.plugin), repo.element)
+    by_url.setdefault(repo.url, []).append(repo.element)
+    if repo.repo_id is not None:
+        by_id[repo.repo_id] = repo.element
+
+
+def _remove_from_index(index, repo):
+    by_key, by_url, by_id = index
+    key = (repo.url, repo.plugin)
+    if by_key.get(key) is repo.element:
+        del by_key[key]
+        # as when the index is built, the first other config repo with the same url and plugin takes its place
+        for other in by_url.get(repo.url, []):
+            if other is not repo.element and ConfigRepo(other, repo.capabilities).plugin == repo.plugin:
+                by_key[key] = other
+                break
+    by_url[repo.url] = [e for e in by_url.get(repo.url, []) if e is not repo.element]
+    if not by_url[repo.url]:
+        del by_url[repo.url]
+    if repo.repo_id is not None and by_id.get(repo.repo_id) is repo.element:
+        del by_id[repo.repo_id]
+
+
 class ConfigRepos(CommonEqualityMixin):
+    """
+    The config repos, indexed by (url, plugin), by url and by id the first time they are looked up, so ensuring,
+    replacing and syncing config repos does not scan the others. The index is kept with the configurator's caches,
+    so it is shared by every ConfigRepos the configurator hands out.
+    """
 
     def __init__(self, element, configurator):
         self.element = element
         self.__configurator = configurator
+        self.__capabilities = None
+        self.__index_holder = SharedIndex(configurator, 'config_repos_index', element)
+
+    def __server_capabilities(self):
+        if self.__capabilities is None:
+            self.__capabilities = self.__configurator.capabilities
+        return self.__capabilities
 
     @property
     def config_repo(self):
-        return [ConfigRepo(e, self.__configurator.server_version) for e in self.element.findall('config-repo')]
+        capabilities = self.__server_capabilities()
+        return [ConfigRepo(e, capabilities) for e in self.element.findall('config-repo')]
+
+    def __build_index(self):
+        index = ({}, {}, {})
+        for repo in self.config_repo:
+            _add_to_index(index, repo)
+        return index
+
+    def __index(self):
+        return self.__index_holder.get(self.__build_index)
+
+    def __add(self, repo):
+        self.element.append(repo.element)
+        _add_to_index(self.__index(), repo)
+
+    def __remove(self, element):
+        self.element.remove(element)
+        _remove_from_index(self.__index(), ConfigRepo(element, self.__server_capabilities()))
 
     def make_empty(self):
         PossiblyMissingElement(self.element).remove_all_children()
-
-    def ensure_config_repo(self, url, plugin, cvs='git', configuration=None, repo_id=None, branch=None):
-        configuration_xml_string = ""
-        if configuration:
-            configuration_xml_string = '<configuration>{}</configuration>'.format(
-                "".join("<property><key>{0}</key><value>{1}</value></property>".format(k, v) for k, v in
-                        configuration.items()))
-        branch_entry = ''
+        self.__index_holder.forget()
+
+    def config_repo_with_id(self, repo_id):
+        element = self.__index()[2].get(repo_id)
+        return ConfigRepo(element, self.__server_capabilities()) if element is not None else None
+
+    def config_repos_with_url(self, url):
+        return [ConfigRepo(e, self.__server_capabilities()) for e in self.__index()[1].get(url, [])]
+
+    def __new_config_repo(self, url, plugin, cvs, configuration, repo_id, branch):
+        capabilities = self.__server_capabilities()
+        element = ET.Element('config-repo')
+        element.set(capabilities.config_repo_plugin_attribute, plugin)
+        if capabilities.config_repo_has_id:
+            element.set('id', repo_id or str(uuid.uuid4()))
+        material = ET.SubElement(element, cvs, {'url': url})
         if branch:
-            branch_entry = ' branch="{}"'.format(branch)
-        if has_id(self.__configurator.server_version):
-            if not repo_id:
-                repo_id = str(uuid.uuid4())
-            attr_name = 'pluginId' if has_new_attr_name(self.__configurator.server_version) else 'plugin'
-            element = ET.fromstring('<config-repo {5}="{0}" id="{4}"><{2} url="{1}"{6} />{3}</config-repo>'.format(
-                plugin, url, cvs, configuration_xml_string, repo_id, attr_name, branch_entry))
-        else:
-            element = ET.fromstring('<config-repo plugin="{0}"><{2} url="{1}"{4} />{3}</config-repo>'.format(
-                plugin, url, cvs, configuration_xml_string, branch_entry))
-
-        config_repo_element = ConfigRepo(element, self.__configurator.server_version)
+            material.set('branch', branch)
+        if configuration:
+            PropertyBag(element, 'configuration').update(configuration)
+        return ConfigRepo(element, capabilities)
 
-        if config_repo_element not in self.config_repo:
-            self.element.append(element)
+    def ensure_config_repo(self, url, plugin, cvs='git', configuration=None, repo_id=None, branch=None):
+        existing = self.__index()[0].get((url, plugin))
+        if existing is not None:
+            return ConfigRepo(existing, self.__server_capabilities())
+        config_repo_element = self.__new_config_repo(url, plugin, cvs, configuration, repo_id, branch)
+        self.__add(config_repo_element)
         return config_repo_element
 
     def ensure_replacement_of_config_repo(self, url, plugin, cvs='git', configuration=None):
-        for repo in self.config_repo:
-            if repo.url == url:
-                self.element.remove(repo.element)
+        for element in list(self.__index()[1].get(url, [])):
+            self.__remove(element)
 
         self.ensure_config_repo(url, plugin, cvs, configuration)
 
@@ -121,5 +187,57 @@ class ConfigRepos(CommonEqualityMixin):
     def ensure_json_config_repo(self, git_url):
         return self.ensure_config_repo(git_url, 'json.config.plugin', cvs='git', configuration=None)
 
+    def sync(self, config_repos):
+        """
+        Makes the config repos exactly config_repos, a list of dicts of ensure_config_repo's arguments, in one pass.
+        A config repo is matched by repo_id if given, otherwise by url and plugin. Matched config repos are only
+        rewritten where they differ, and config repos not matched are removed.
+        Returns the urls of the config repos added, changed or removed.
+        """
+        by_key, _, by_id = self.__index()
+        unmatched = set(self.element.findall('config-repo'))
+        updates, additions = [], []
+        for config_repo in config_repos:
+            repo_id = config_repo.get('repo_id')
+            element = by_id.get(repo_id) if repo_id else None
+            if element is None:
+                element = by_key.get((config_repo['url'], config_repo['plugin']))
+            if element is None or element not in unmatched:
+                additions.append(config_repo)
+            else:
+                unmatched.discard(element)
+                updates.append((element, config_repo))
+
+        capabilities = self.__server_capabilities()
+        changed = set(ConfigRepo(e, capabilities).url for e in unmatched)
+        for element in unmatched:
+            self.__remove(element)
+        for element, config_repo in updates:
+            repo = ConfigRepo(element, capabilities)
+            _remove_from_index(self.__index(), repo)
+            if self.__rewrite(repo, **config_repo):
+                changed.add(config_repo['url'])
+            _add_to_index(self.__index(), repo)
+        for config_repo in additions:
+            self.__add(self.__new_config_repo(config_repo['url'], config_repo['plugin'], config_repo.get('cvs', 'git'),
+                                              config_repo.get('configuration'), config_repo.get('repo_id'),
+                                              config_repo.get('branch')))
+            changed.add(config_repo['url'])
+        return sorted(changed)
+
+    def __rewrite(self, repo, url, plugin, cvs='git', configuration=None, repo_id=None, branch=None):
+        changed = _set_or_remove(repo.element, self.__server_capabilities().config_repo_plugin_attribute, plugin)
+        if repo_id and repo.repo_id is not None:
+            changed = _set_or_remove(repo.element, 'id', repo_id) or changed
+        material = repo.element.find(repo.cvs)
+        if material.tag != cvs:
+            repo.element.remove(material)
+            material = ET.Element(cvs)
+            repo.element.insert(0, material)
+            changed = True
+        changed = _set_or_remove(material, 'url', url) or changed
+        changed = _set_or_remove(material, 'branch', branch or None) or changed
+        return bool(PropertyBag(repo.element, 'configuration').replace(configuration or {})) or changed
+
     def __repr__(self):
         return 'ConfigRepos({})'.format(",".join(self.config_repo))
@@ -1,5 +1,7 @@
 import xml.etree.ElementTree as ET
 
+from gomatic.gocd.generic import SharedIndex
+from gomatic.gocd.properties import PropertyBag
 from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import PossiblyMissingElement, Ensurance
 
@@ -10,10 +12,11 @@ class Profile(CommonEqualityMixin):
 
     @property
     def properties(self):
-        props = {}
-        for prop in self.element.findall('property'):
-            props[prop.find('key').text] = prop.find('value').text
-        return props
+        return dict(self.configuration)
+
+    @property
+    def configuration(self):
+        return PropertyBag(self.element)
 
     @property
     def profile_id(self):
@@ -27,30 +30,68 @@ class Profile(CommonEqualityMixin):
         return self.profile_id == other.profile_id
 
 
+def _rewrite(profile_element, plugin_id, properties):
+    changed = profile_element.get('pluginId') != plugin_id
+    if changed:
+        profile_element.set('pluginId', plugin_id)
+    return bool(PropertyBag(profile_element).replace(properties)) or changed
+
+
 class Profiles(CommonEqualityMixin):
-    def __init__(self, element):
+    def __init__(self, element, configurator=None):
         self.element = element
+        self.__by_id = SharedIndex(configurator, 'profiles_by_id', element)
 
     @property
     def profile(self):
         return [Profile(e) for e in self.element.findall('profile')]
 
+    def __profiles_by_id(self):
+        return self.__by_id.get(lambda: dict((e.get('id'), e) for e in self.element.findall('profile')))
+
+    def find_profile(self, profile_id):
+        element = self.__profiles_by_id().get(profile_id)
+        return Profile(element) if element is not None else None
+
     def ensure_profile(self, profile_id, plugin_id, properties):
-        properties_xml = "".join(["<property><key>{}</key><value>{}</value></property>".format(k, v) for k, v in properties.items()])
-        profile = ET.fromstring('<profile id="{}" pluginId="{}">{}</profile>'.format(profile_id,
-            plugin_id,
-            properties_xml))
-        self.element.append(profile)
+        """
+        Adds the profile, or if there already is one with that id, makes its plugin and properties exactly the given
+        ones, changing only what differs.
+        """
+        existing = self.find_profile(profile_id)
+        if existing is not None:
+            _rewrite(existing.element, plugin_id, properties)
+            return existing
+        profile = ET.SubElement(self.element, 'profile', {'id': profile_id, 'pluginId': plugin_id})
+        PropertyBag(profile).update(properties)
+        self.__profiles_by_id()[profile_id] = profile
         return Profile(profile)
 
     def ensure_replacement_of_profile(self, profile_id, plugin_id, properties):
-        current_profile = [ac for ac in self.profile if ac.profile_id == profile_id]
-        if current_profile:
-            self.element.remove(current_profile[0].element)
         return self.ensure_profile(profile_id, plugin_id, properties)
 
+    def sync(self, profiles):
+        """
+        profiles is {profile id: (plugin id, properties)}. Adds the missing profiles, rewrites those whose plugin or
+        properties differ and removes the others, leaving unchanged profiles untouched.
+        Returns the ids of the profiles added, changed or removed.
+        """
+        changed = []
+        for profile_id in [i for i in self.__profiles_by_id() if i not in profiles]:
+            self.element.remove(self.__profiles_by_id().pop(profile_id))
+            changed.append(profile_id)
+        for profile_id, (plugin_id, properties) in profiles.items():
+            existing = self.find_profile(profile_id)
+            if existing is None:
+                self.ensure_profile(profile_id, plugin_id, properties)
+                changed.append(profile_id)
+            elif _rewrite(existing.element, plugin_id, properties):
+                changed.append(profile_id)
+        return sorted(changed)
+
     def make_empty(self):
         PossiblyMissingElement(self.element).remove_all_children()
+        self.__by_id.forget()
 
     def __getitem__(self, index):
         if not isinstance(index, int):
@@ -62,16 +103,17 @@ class Profiles(CommonEqualityMixin):
 
 
 class Elastic(CommonEqualityMixin):
-    def __init__(self, element):
+    def __init__(self, element, configurator=None):
         self.element = element
+        self.__configurator = configurator
 
     @property
     def profiles(self):
-        return Profiles(self.element.find('profiles'))
+        return Profiles(self.element.find('profiles'), self.__configurator)
 
     def ensure_profiles(self):
         profile = Ensurance(self.element).ensure_child('profiles')
-        return Profiles(profile.element)
+        return Profiles(profile.element, self.__configurator)
 
     def ensure_replacement_of_profiles(self):
         profiles = self.ensure_profiles()
@@ -4,6 +4,30 @@ from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import Ensurance, PossiblyMissingElement
 
 
+class SharedIndex(CommonEqualityMixin):
+    """
+    An index a wrapper builds of its element. It is kept with the configurator's caches when there is a
+    configurator, so that every wrapper of the element shares it, and otherwise with the wrapper.
+    """
+    def __init__(self, configurator, name, element):
+        self.__configurator = configurator
+        self.__name = name
+        self.__element = element
+        self.__own = None
+
+    def get(self, build):
+        if self.__configurator is not None:
+            return self.__configurator._element_index(self.__name, self.__element, build)
+        if self.__own is None:
+            self.__own = build()
+        return self.__own
+
+    def forget(self):
+        if self.__configurator is not None:
+            self.__configurator._invalidate_caches(self.__name)
+        self.__own = None
+
+
 class ResourceMixin(object):
     @property
     def resources(self):
@@ -79,6 +79,7 @@ class GitMaterial(CommonEqualityMixin):
 
     is_git = True
     is_package = False
+    is_pipeline = False
 
     @property
     def url(self):
@@ -168,6 +169,19 @@ class PipelineMaterial(CommonEqualityMixin):
 
     is_git = False
     is_package = False
+    is_pipeline = True
+
+    @property
+    def pipeline_name(self):
+        return self.__pipeline_name
+
+    @property
+    def stage_name(self):
+        return self.__stage_name
+
+    @property
+    def material_name(self):
+        return self.__material_name
 
     def append_to(self, element):
         if self.__material_name is None:
@@ -189,6 +203,7 @@ class PackageMaterial(CommonEqualityMixin):
 
     is_package = True
     is_git = False
+    is_pipeline = False
 
     def append_to(self, element):
         new_element = ET.fromstring(('<package ref="%s"' % self.__ref) + ' />')
@@ -1,7 +1,7 @@
-from functools import cmp_to_key
 from xml.etree import ElementTree as ET
 
 from gomatic.gocd.authorization import Authorization
+from gomatic.gocd.capabilities import DEFAULT_CAPABILITIES
 from gomatic.gocd.artifacts import Artifact
 from gomatic.gocd.generic import EnvironmentVariableMixin, ResourceMixin
 from gomatic.gocd.materials import GitMaterial, Materials, PackageMaterial
@@ -20,6 +20,14 @@ class Tab(CommonEqualityMixin):
     def __repr__(self):
         return 'Tab("%s", "%s")' % (self.__name, self.__path)
 
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def path(self):
+        return self.__path
+
     def append_to(self, element):
         element.append(ET.fromstring('<tab name="%s" path="%s" />' % (self.__name, self.__path)))
 
@@ -102,22 +110,10 @@ class Job(CommonEqualityMixin, EnvironmentVariableMixin, ResourceMixin):
         self.run_instance_count = run_instance_count
         return self         
 
-    def __get_gocd_version_string(self):
-        if self.parent_stage is not None \
-                and self.parent_stage.parent_pipeline is not None \
-                and self.parent_stage.parent_pipeline.parent is not None \
-                and type(self.parent_stage.parent_pipeline.parent) is not str \
-                and self.parent_stage.parent_pipeline.parent.configurator is not None:
-            return self.parent_stage.parent_pipeline.parent.configurator.server_version
-        return '17.11.0'
-
     def is_gocd_18_3_and_above(self):
-        version = self.__get_gocd_version_string()
-        gocd_major_version = int(version.split('.')[0])
-        gocd_minor_version = int(version.split('.')[1])
-
-        return (gocd_major_version == 18 and gocd_minor_version >= 3) or \
-               (gocd_major_version >= 19)
+        if self.parent_stage is not None and self.parent_stage.parent_pipeline is not None:
+            return self.parent_stage.parent_pipeline.capabilities.artifacts_have_type
+        return DEFAULT_CAPABILITIES.artifacts_have_type
 
     @property
     def artifacts(self):
@@ -128,8 +124,9 @@ class Job(CommonEqualityMixin, EnvironmentVariableMixin, ResourceMixin):
         if artifacts:
             artifacts_ensurance = Ensurance(self.element).ensure_child("artifacts")
             artifacts_to_add = artifacts.difference(self.artifacts)
+            gocd_18_3_and_above = self.is_gocd_18_3_and_above()
             for artifact in artifacts_to_add:
-                artifact.append_to(artifacts_ensurance, self.is_gocd_18_3_and_above())
+                artifact.append_to(artifacts_ensurance, gocd_18_3_and_above)
         return self
 
     @property
@@ -368,6 +365,25 @@ class Pipeline(CommonEqualityMixin, EnvironmentVariableMixin):
     def is_template(self):
         return self.parent == 'templates'  # but for a pipeline, parent is the pipeline group
 
+    @property
+    def __configurator(self):
+        if self.parent is not None and type(self.parent) is not str:
+            return self.parent.configurator
+        return None
+
+    @property
+    def capabilities(self):
+        if self.__configurator is not None:
+            return self.__configurator.capabilities
+        return DEFAULT_CAPABILITIES
+
+    def __materials_removed(self):
+        if self.__configurator is not None:
+            self.__configurator._invalidate_caches('material_index')
+            graph = self.__configurator._cache('dependency_graph')
+            if graph is not None:
+                graph.remove_dependencies(self.name)
+
     def __eq__(self, other):
         return isinstance(other, self.__class__) and ET.tostring(self.element, 'utf-8') == ET.tostring(other.element, 'utf-8') and self.parent == other.parent
 
@@ -443,6 +459,11 @@ class Pipeline(CommonEqualityMixin, EnvironmentVariableMixin):
 
     def __add_material(self, material):
         material.append_to(Ensurance(self.element).ensure_child('materials'))
+        if self.__configurator is not None:
+            self.__configurator._invalidate_caches('material_index')
+            graph = self.__configurator._cache('dependency_graph')
+            if material.is_pipeline and graph is not None:
+                graph.add_dependency(self.name, material.pipeline_name)
 
     def ensure_material(self, material):
         if self.materials.count(material) == 0:
@@ -566,10 +587,11 @@ class Pipeline(CommonEqualityMixin, EnvironmentVariableMixin):
         return stage
 
     def reorder_elements_to_please_go(self):
-        materials = self.materials
-        self.remove_materials()
-        for material in self.__reordered_materials_to_reduce_thrash(materials):
-            self.__add_material(material)
+        materials_element = self.element.find('materials')
+        if materials_element is not None:
+            # the elements are moved rather than rebuilt from material wrappers, so that what gomatic does not model
+            # (e.g. git credentials, or svn materials) is kept
+            materials_element[:] = self.__reordered_materials_to_reduce_thrash(list(materials_element))
 
         move_all_to_end(self.element, "params")
         move_all_to_end(self.element, "timer")
@@ -604,6 +626,7 @@ class Pipeline(CommonEqualityMixin, EnvironmentVariableMixin):
 
     def make_empty(self):
         PossiblyMissingElement(self.element).remove_all_children().remove_attribute('labeltemplate')
+        self.__materials_removed()
 
     @property
     def timer_triggers_only_on_changes(self):
@@ -612,25 +635,18 @@ class Pipeline(CommonEqualityMixin, EnvironmentVariableMixin):
 
     def remove_materials(self):
         PossiblyMissingElement(self.element).remove_all_children('materials')
+        self.__materials_removed()
 
     @staticmethod
-    def __reordered_materials_to_reduce_thrash(materials):
-        def _cmp(a, b):
-            return (a > b) - (a < b)
-
-        def cmp_materials(m1, m2):
-            if m1.is_git:
-                if m2.is_git:
-                    return _cmp(m1.url, m2.url)
-                else:
-                    return -1
-            else:
-                if m2.is_git:
-                    return 1
-                else:
-                    return _cmp(str(m1), str(m2))
+    def __reordered_materials_to_reduce_thrash(material_elements):
+        def order(element):
+            if element.tag == 'git':
+                return 0, element.attrib['url']
+            if element.tag in ('pipeline', 'package'):
+                return 1, str(Materials(element))
+            return 2, ''
 
-        return sorted(materials, key=cmp_to_key(cmp_materials))
+        return sorted(material_elements, key=order)
 
 
 class PipelineGroup(CommonEqualityMixin):
@@ -653,15 +669,18 @@ class PipelineGroup(CommonEqualityMixin):
     def authorization(self):
         return Authorization(self.element.find('authorization'))
 
+    def __hand_out(self, pipeline):
+        return self.configurator._hand_out(pipeline) if self.configurator is not None else pipeline
+
     @property
     def pipelines(self):
-        return [Pipeline(e, self) for e in self.element.findall('pipeline')]
+        return [self.__hand_out(Pipeline(e, self)) for e in self.element.findall('pipeline')]
 
     def reorder_elements_to_please_go(self):
         move_all_to_end(self.element, 'pipeline')
 
     def _matching_pipelines(self, name):
-        return [p for p in self.pipelines if p.name == name]
+        return [self.__hand_out(Pipeline(e, self)) for e in self.element.findall('pipeline') if e.attrib.get('name') == name]
 
     def has_pipeline(self, name):
         return len(self._matching_pipelines(name)) > 0
@@ -683,11 +702,20 @@ class PipelineGroup(CommonEqualityMixin):
 
     def ensure_pipeline(self, name):
         pipeline_element = Ensurance(self.element).ensure_child_with_attribute('pipeline', 'name', name).element
-        return Pipeline(pipeline_element, self)
+        if self.configurator is not None:
+            graph = self.configurator._cache('dependency_graph')
+            if graph is not None:
+                graph.add_pipeline(name)
+            by_name = self.configurator._cache('pipeline_elements_by_name')
+            if by_name is not None:
+                by_name.setdefault(name, (self.element, pipeline_element))
+        return self.__hand_out(Pipeline(pipeline_element, self))
 
     def ensure_removal_of_pipeline(self, name):
         for pipeline in self._matching_pipelines(name):
             self.element.remove(pipeline.element)
+        if self.configurator is not None:
+            self.configurator._invalidate_caches('material_index', 'dependency_graph', 'pipeline_elements_by_name')
         return self
 
     def ensure_replacement_of_pipeline(self, name):
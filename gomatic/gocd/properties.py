@@ -0,0 +1,99 @@
+import xml.etree.ElementTree as ET
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+def _as_text(value):
+    return '' if value is None else '%s' % value
+
+
+class PropertyBag(MutableMapping):
+    """
+    The <property><key/><value/></property> children of a plugin element (or of its container child, e.g.
+    'configuration', which is only added when the first property is set), as a dict of key to value.
+
+    The property elements are indexed by key the first time the bag is used, so reads and writes do not scan the
+    children. Values are set as element text, so they are escaped when the config is written out.
+    """
+    def __init__(self, element, container=None):
+        self.__element = element
+        self.__container = container
+        self.__index = None
+
+    def __parent(self, create=False):
+        if self.__container is None:
+            return self.__element
+        parent = self.__element.find(self.__container)
+        if parent is None and create:
+            parent = ET.SubElement(self.__element, self.__container)
+        return parent
+
+    def __properties(self):
+        if self.__index is None:
+            parent = self.__parent()
+            properties = parent.findall('property') if parent is not None else []
+            self.__index = dict((p.findtext('key'), p) for p in properties)
+        return self.__index
+
+    def __getitem__(self, key):
+        value_element = self.__properties()[key].find('value')
+        return value_element.text if value_element is not None else None
+
+    def __setitem__(self, key, value):
+        self.__set(key, _as_text(value))
+
+    def __delitem__(self, key):
+        self.__parent().remove(self.__properties().pop(key))
+
+    def __iter__(self):
+        parent = self.__parent()
+        properties = self.__properties()
+        keys = [p.findtext('key') for p in (parent.findall('property') if parent is not None else [])]
+        return iter([key for key in keys if key in properties])
+
+    def __len__(self):
+        return len(self.__properties())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def element_for(self, key):
+        return self.__properties()[key]
+
+    def __set(self, key, text):
+        property_element = self.__properties().get(key)
+        if property_element is None:
+            property_element = ET.SubElement(self.__parent(create=True), 'property')
+            ET.SubElement(property_element, 'key').text = key
+            self.__properties()[key] = property_element
+        value_element = property_element.find('value')
+        if value_element is None:
+            for encrypted in property_element.findall('encryptedValue'):
+                property_element.remove(encrypted)
+            value_element = ET.SubElement(property_element, 'value')
+        value_element.text = text or None
+
+    def update(self, properties):
+        """
+        Sets each of properties, leaving the properties whose value is already right untouched.
+        Returns the keys that changed.
+        """
+        changed = []
+        for key, value in properties.items():
+            text = _as_text(value)
+            if key not in self.__properties() or _as_text(self[key]) != text:
+                self.__set(key, text)
+                changed.append(key)
+        return sorted(changed)
+
+    def replace(self, properties):
+        """
+        Like update, but also removes the properties not in properties. Returns the keys that changed.
+        """
+        removed = [key for key in self if key not in properties]
+        for key in removed:
+            del self[key]
+        return sorted(removed + self.update(properties))
@@ -1,23 +1,57 @@
 from uuid import uuid4
 from xml.etree import ElementTree as ET
 
+from gomatic.gocd.generic import SharedIndex
+from gomatic.gocd.properties import PropertyBag
 from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import Ensurance
 
 
 class Repository(CommonEqualityMixin):
-    def __init__(self, element):
+    """
+    A package repository. Its properties and packages are only read when first used, and packages are then
+    indexed by name and id, in an index every Repository the configurator hands out for the element shares.
+    """
+    def __init__(self, element, configurator=None):
         self.__element = element
-        self.__properties = list(map((lambda e: Property(e)), element.findall("configuration/property")))
-        self.__packages = list(map((lambda e: Package(e)), element.findall("packages/package")))
+        self.__configuration = PropertyBag(element, 'configuration')
+        self.__packages = SharedIndex(configurator, 'packages_of_%s' % id(element), element)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.element is other.element
+
+    def __hash__(self):
+        return hash(self.element)
+
+    @property
+    def element(self):
+        return self.__element
 
     @property
     def properties(self):
-        return self.__properties
+        return [Property(self.__configuration.element_for(key)) for key in self.__configuration]
 
     @property
     def packages(self):
-        return self.__packages
+        return [Package(e) for e in self.__element.findall("packages/package")]
+
+    def __build_package_index(self):
+        package_elements = self.__element.findall("packages/package")
+        return dict((e.get('name'), e) for e in package_elements), dict((e.get('id'), e) for e in package_elements)
+
+    def __packages_by(self, attribute):
+        by_name, by_id = self.__packages.get(self.__build_package_index)
+        return by_name if attribute == 'name' else by_id
+
+    def find_package(self, name=None, id=None):
+        """
+        The package with the given name or id, or None.
+        """
+        if name is not None:
+            element = self.__packages_by('name').get(name)
+        else:
+            element = self.__packages_by('id').get(id)
+        return Package(element) if element is not None else None
 
     @property
     def name(self):
@@ -29,7 +63,7 @@ class Repository(CommonEqualityMixin):
 
     @property
     def repo_url(self):
-        return [p for p in self.__properties if p.key == 'REPO_URL'][0].value
+        return self.__configuration['REPO_URL']
 
     @property
     def type(self):
@@ -40,18 +74,51 @@ class Repository(CommonEqualityMixin):
         plugin_configuration.set('version', version)
         return plugin_configuration.element
 
+    @property
+    def configuration(self):
+        return self.__configuration
+
     def ensure_property(self, key, value):
-        config_element = Ensurance(self.__element).ensure_child('configuration').element
-        property_element = Ensurance(config_element).ensure_child_with_descendant('property', 'key', key).element
-        value_tag = Ensurance(property_element).ensure_child('value')
-        value_tag.set_text(value)
-        return Property(property_element)
+        self.__configuration[key] = value
+        return Property(self.__configuration.element_for(key))
 
     def ensure_package(self, name):
-        ens = Ensurance(self.__element).ensure_child('packages').ensure_child_with_attribute('package', 'name', name)
-        if not ens.has_attribute('id'):
-            ens.set('id', str(uuid4()))
-        return Package(ens.element)
+        element = self.__packages_by('name').get(name)
+        if element is None:
+            packages_element = Ensurance(self.__element).ensure_child('packages').element
+            element = ET.SubElement(packages_element, 'package', {'name': name})
+            self.__packages_by('name')[name] = element
+        if 'id' not in element.attrib:
+            element.set('id', str(uuid4()))
+            self.__packages_by('id')[element.get('id')] = element
+        return Package(element)
+
+    def ensure_packages(self, properties_by_name):
+        """
+        Ensures there is a package for each name in properties_by_name, with at least the given properties, setting
+        only the properties that differ. Returns the names of the packages added or changed.
+        """
+        changed = []
+        for name, properties in properties_by_name.items():
+            added = name not in self.__packages_by('name')
+            package = self.ensure_package(name)
+            if package.configuration.update(properties) or added:
+                changed.append(name)
+        return sorted(changed)
+
+    def ensure_removal_of_packages(self, names):
+        """
+        Removes the packages with the given names, if there are any. Returns the names of the packages removed.
+        """
+        removed = []
+        packages_element = self.__element.find('packages')
+        for name in set(names):
+            element = self.__packages_by('name').pop(name, None)
+            if element is not None:
+                packages_element.remove(element)
+                self.__packages_by('id').pop(element.get('id'), None)
+                removed.append(name)
+        return sorted(removed)
 
 
 class Property(CommonEqualityMixin):
@@ -70,7 +137,17 @@ class Property(CommonEqualityMixin):
 class Package(CommonEqualityMixin):
     def __init__(self, element):
         self.__element = element
-        self.__properties = list(map((lambda e: Property(e)), element.findall("configuration/property")))
+        self.__configuration = PropertyBag(element, 'configuration')
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.element is other.element
+
+    def __hash__(self):
+        return hash(self.element)
+
+    @property
+    def element(self):
+        return self.__element
 
     @property
     def name(self):
@@ -82,15 +159,16 @@ class Package(CommonEqualityMixin):
 
     @property
     def properties(self):
-        return self.__properties
+        return [Property(self.__configuration.element_for(key)) for key in self.__configuration]
 
     @property
     def package_spec(self):
-        return [p for p in self.__properties if p.key == 'PACKAGE_SPEC'][0].value
+        return self.__configuration['PACKAGE_SPEC']
+
+    @property
+    def configuration(self):
+        return self.__configuration
 
     def ensure_property(self, key, value):
-        config_element = Ensurance(self.__element).ensure_child('configuration').element
-        property_element = Ensurance(config_element).ensure_child_with_descendant('property', 'key', key).element
-        value_tag = Ensurance(property_element).ensure_child('value')
-        value_tag.set_text(value)
-        return Property(property_element)
+        self.__configuration[key] = value
+        return Property(self.__configuration.element_for(key))
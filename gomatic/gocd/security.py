@@ -1,5 +1,8 @@
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
 
+from gomatic.gocd.generic import SharedIndex
+from gomatic.gocd.properties import PropertyBag
 from gomatic.mixins import CommonEqualityMixin
 from gomatic.xml_operations import PossiblyMissingElement, Ensurance
 
@@ -14,7 +17,14 @@ class Role(CommonEqualityMixin):
 
     @property
     def users(self):
-        return [u.text for u in self.element.find('users').findall('user')]
+        return [u.text for u in PossiblyMissingElement(self.element).possibly_missing_child('users').findall('user')]
+
+    def set_users(self, users):
+        """
+        Makes the role's users exactly users, removing and adding only the users that differ.
+        Returns whether anything changed.
+        """
+        return _sync_children(Ensurance(self.element).ensure_child('users').element, 'user', users)
 
 
 class PluginRole(CommonEqualityMixin):
@@ -31,29 +41,59 @@ class PluginRole(CommonEqualityMixin):
 
     @property
     def properties(self):
-        props = {}
-        for prop in self.element.findall('property'):
-            props[prop.find('key').text] = prop.find('value').text
-        return props
+        return dict(self.configuration)
+
+    @property
+    def configuration(self):
+        return PropertyBag(self.element)
+
+
+def _sync_children(element, tag, texts):
+    texts = list(OrderedDict.fromkeys(texts))
+    wanted = set(texts)
+    present = set()
+    unwanted = []
+    for e in element.findall(tag):
+        if e.text in wanted and e.text not in present:
+            present.add(e.text)
+        else:
+            unwanted.append(e)
+    for e in unwanted:
+        element.remove(e)
+    missing = [text for text in texts if text not in present]
+    for text in missing:
+        ET.SubElement(element, tag).text = text
+    return bool(unwanted or missing)
 
 
 class Admins(CommonEqualityMixin):
     def __init__(self, element):
         self.element = element
 
+    @property
+    def users(self):
+        return [u.text for u in self.element.findall('user')]
+
     def add_user(self, name):
-        user_xml = '<user>{}</user>'.format(name)
-        user_element = ET.fromstring(user_xml)
-        self.element.append(user_element)
+        if name not in self.users:
+            ET.SubElement(self.element, 'user').text = name
         return self
 
+    def sync_users(self, users):
+        """
+        Makes the admin users exactly users (admin roles are left alone), touching only the users that differ.
+        Returns whether anything changed.
+        """
+        return _sync_children(self.element, 'user', users)
+
     def __getitem__(self, index):
-        return [u.text for u in self.element.findall('user')][index]
+        return self.users[index]
 
 
 class Roles(CommonEqualityMixin):
-    def __init__(self, element):
+    def __init__(self, element, configurator=None):
         self.element = element
+        self.__by_name = SharedIndex(configurator, 'roles_by_name', element)
 
     @property
     def role(self):
@@ -65,21 +105,56 @@ class Roles(CommonEqualityMixin):
 
     def make_empty(self):
         PossiblyMissingElement(self.element).remove_all_children()
+        self.__by_name.forget()
+
+    def __roles_by_name(self):
+        # the first role with a name is the one kept, as dict() keeps the last of reversed()
+        return self.__by_name.get(lambda: dict((r.get('name'), r) for r in reversed(self.element.findall('role'))))
+
+    def find_role(self, name):
+        element = self.__roles_by_name().get(name)
+        return Role(element) if element is not None else None
 
     def ensure_role(self, name, users):
-        users_xml = ''.join(['<user>{}</user>'.format(user) for user in users])
-        role_xml = '<role name="{}"><users>{}</users></role>'.format(name, users_xml)
-        role_element = ET.fromstring(role_xml)
-        self.element.append(role_element)
+        """
+        Adds the role, or if there already is one with that name, makes its users exactly users.
+        """
+        role = self.find_role(name)
+        if role is None:
+            role_element = ET.SubElement(self.element, 'role', {'name': name})
+            self.__roles_by_name()[name] = role_element
+            role = Role(role_element)
+        role.set_users(users)
         return self
 
+    def sync_roles(self, users_by_role):
+        """
+        Makes the (non plugin) roles exactly the roles in users_by_role, each with exactly its users, in one pass,
+        changing only the roles and users that differ. Returns the names of the roles added, changed or removed.
+        """
+        changed = self.__remove_duplicate_roles()
+        for name in [n for n in self.__roles_by_name() if n not in users_by_role]:
+            self.element.remove(self.__roles_by_name().pop(name))
+            changed.add(name)
+        for name, users in users_by_role.items():
+            role = self.find_role(name)
+            if role is None:
+                self.ensure_role(name, users)
+                changed.add(name)
+            elif role.set_users(users):
+                changed.add(name)
+        return sorted(changed)
+
+    def __remove_duplicate_roles(self):
+        kept = self.__roles_by_name()
+        duplicates = [r for r in self.element.findall('role') if kept.get(r.get('name')) is not r]
+        for r in duplicates:
+            self.element.remove(r)
+        return set(r.get('name') for r in duplicates)
+
     def ensure_plugin_role(self, name, auth_config_id, properties={}):
-        properties_xml = ''.join(['<property><key>{0}</key><value>{1}</value></property>'.format(k, v) for k,v in
-                                properties.items()])
-        plugin_role_xml = '<pluginRole name="{0}" authConfigId="{1}">{2}</pluginRole>'.format(name, auth_config_id,
-                                                                                              properties_xml)
-        plugin_role_element = ET.fromstring(plugin_role_xml)
-        self.element.append(plugin_role_element)
+        plugin_role_element = ET.SubElement(self.element, 'pluginRole', {'name': name, 'authConfigId': auth_config_id})
+        PropertyBag(plugin_role_element).update(properties)
         return self
 
     # deprecated, since this only returns "Role" and now we can have both "Role" and "PluginRole"
@@ -98,10 +173,11 @@ class AuthConfig(CommonEqualityMixin):
 
     @property
     def properties(self):
-        props = {}
-        for prop in self.element.findall('property'):
-            props[prop.find('key').text] = prop.find('value').text
-        return props
+        return dict(self.configuration)
+
+    @property
+    def configuration(self):
+        return PropertyBag(self.element)
 
     @property
     def auth_config_id(self):
@@ -124,11 +200,8 @@ class AuthConfigs(CommonEqualityMixin):
         return [AuthConfig(e) for e in self.element.findall('authConfig')]
 
     def ensure_auth_config(self, auth_config_id, plugin_id, properties):
-        properties_xml = "".join(["<property><key>{}</key><value>{}</value></property>".format(k, v) for k, v in properties.items()])
-        auth_config = ET.fromstring('<authConfig id="{}" pluginId="{}">{}</authConfig>'.format(auth_config_id,
-                                                                                               plugin_id,
-                                                                                               properties_xml))
-        self.element.append(auth_config)
+        auth_config = ET.SubElement(self.element, 'authConfig', {'id': auth_config_id, 'pluginId': plugin_id})
+        PropertyBag(auth_config).update(properties)
         return self
 
     def ensure_replacement_of_auth_config(self, auth_config_id, plugin_id, properties):
@@ -150,12 +223,13 @@ class AuthConfigs(CommonEqualityMixin):
 
 
 class Security(CommonEqualityMixin):
-    def __init__(self, element):
+    def __init__(self, element, configurator=None):
         self.element = element
+        self.__configurator = configurator
 
     @property
     def roles(self):
-        return Roles(self.element.find('roles'))
+        return Roles(self.element.find('roles'), self.__configurator)
 
     @property
     def auth_configs(self):
@@ -171,7 +245,7 @@ class Security(CommonEqualityMixin):
 
     def ensure_roles(self):
         roles = Ensurance(self.element).ensure_child('roles')
-        return Roles(roles.element)
+        return Roles(roles.element, self.__configurator)
 
     def ensure_auth_configs(self):
         auth_config = Ensurance(self.element).ensure_child('authConfigs')
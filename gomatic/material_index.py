@@ -0,0 +1,85 @@
+import re
+
+from gomatic.xml_operations import PossiblyMissingElement
+
+_SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+
+
+def normalize_git_url(url):
+    """
+    The same string for the different ways of writing the url of one repository, e.g.
+    git@github.com:org/repo.git, ssh://git@github.com/org/repo and https://github.com/org/repo/ all give
+    github.com/org/repo.
+    """
+    url = url.strip()
+    scheme = _SCHEME.match(url)
+    if scheme:
+        host, _, path = url[scheme.end():].partition('/')
+    elif ':' in url and not url.startswith('/'):
+        host, _, path = url.partition(':')
+    else:
+        host, path = '', url
+    host = host.rpartition('@')[2].lower()
+    path = path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return host + '/' + path.lstrip('/') if host else path
+
+
+class MaterialIndex(object):
+    """
+    Which pipelines use which git repositories (by normalized url and branch) and which packages, read in one pass
+    over the config without decoding any materials.
+    """
+    def __init__(self, pipeline_elements):
+        self.__git = {}
+        self.__packages = {}
+        self.__single_git_urls = []
+        for pipeline_element in pipeline_elements:
+            name = pipeline_element.attrib['name']
+            gits = []
+            for material in PossiblyMissingElement(pipeline_element).possibly_missing_child('materials').iterator:
+                if material.tag == 'git':
+                    gits.append(material)
+                    key = normalize_git_url(material.attrib['url'])
+                    branch = material.attrib.get('branch') or 'master'
+                    self.__git.setdefault(key, {}).setdefault(branch, []).append((name, material))
+                elif material.tag == 'package':
+                    self.__packages.setdefault(material.attrib.get('ref'), []).append(name)
+            if len(gits) == 1:
+                self.__single_git_urls.append(gits[0].attrib['url'])
+
+    @property
+    def git_urls(self):
+        """
+        The url of each pipeline that has exactly one git material, as GoCdConfigurator.git_urls.
+        """
+        return list(self.__single_git_urls)
+
+    def git_materials(self, url, branch=None):
+        """
+        (pipeline name, git material element) for each git material on the repository (on branch if given).
+        """
+        branches = self.__git.get(normalize_git_url(url), {})
+        if branch is not None:
+            return list(branches.get(branch, []))
+        return [entry for branch_name in sorted(branches) for entry in branches[branch_name]]
+
+    def pipelines_using_git(self, url, branch=None):
+        result = []
+        seen = set()
+        for name, _ in self.git_materials(url, branch):
+            if name not in seen:
+                seen.add(name)
+                result.append(name)
+        return result
+
+    def branches_of(self, url):
+        """
+        The names of the pipelines using each branch of the repository.
+        """
+        branches = self.__git.get(normalize_git_url(url), {})
+        return dict((branch, self.pipelines_using_git(url, branch)) for branch in branches)
+
+    def pipelines_using_package(self, package_ref):
+        return list(self.__packages.get(package_ref, []))
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from xml.etree import ElementTree as ET
+
+from gomatic.xml_operations import subtree_digests
+
+IDENTITY_ATTRIBUTES = ['name', 'group', 'id', 'uuid', 'hostname', 'url', 'ref', 'pipelineName']
+
+
+class MergeConflictError(RuntimeError):
+    def __init__(self, conflicts):
+        super(MergeConflictError, self).__init__(
+            "Could not merge config changes because both sides changed:\n%s" % "\n".join(conflicts))
+        self.conflicts = conflicts
+
+
+def identity_of(element):
+    for attribute_name in IDENTITY_ATTRIBUTES:
+        if attribute_name in element.attrib:
+            return element.tag, attribute_name, element.attrib[attribute_name]
+    return element.tag, None, None
+
+
+def three_way_merge(base, ours, theirs):
+    """
+    Merges the changes made between base and ours into theirs.
+    Elements are matched by tag and identifying attribute (group, name, id...) and only an element
+    changed on both sides is a conflict. Returns the merged root and a list of conflicting paths.
+    """
+    return _ThreeWayMerge(base, ours, theirs).merge()
+
+
+class _ThreeWayMerge(object):
+    def __init__(self, base, ours, theirs):
+        self.__base = base
+        self.__ours = ours
+        self.__theirs = theirs
+        self.__digests = {}
+        for root in (base, ours, theirs):
+            self.__digests.update(subtree_digests(root))
+        self.conflicts = []
+
+    def merge(self):
+        merged = self.__merge(self.__base, self.__ours, self.__theirs, '/' + self.__ours.tag)
+        return merged, self.conflicts
+
+    def __digest(self, element):
+        return None if element is None else self.__digests[id(element)]
+
+    def __merge(self, base, ours, theirs, path):
+        if self.__digest(ours) == self.__digest(base):
+            return theirs
+        if self.__digest(theirs) == self.__digest(base) or self.__digest(ours) == self.__digest(theirs):
+            return ours
+        if base is None or ours is None or theirs is None:
+            return self.__conflict(path, ours)
+
+        base_children, our_children, their_children = [_keyed_children(e) for e in (base, ours, theirs)]
+        if base_children is None or our_children is None or their_children is None:
+            return self.__conflict(path, ours)
+
+        attributes = self.__merged_values(base.attrib, ours.attrib, theirs.attrib, path)
+        text = self.__merged_values({'': _text(base)}, {'': _text(ours)}, {'': _text(theirs)}, path + '/text()')
+
+        result = ET.Element(ours.tag, attributes)
+        result.text = ours.text if text.get('') == _text(ours) else theirs.text
+        result.tail = ours.tail
+        keys = list(our_children.keys()) + [k for k in their_children.keys() if k not in our_children]
+        for key in keys:
+            child = self.__merge(base_children.get(key), our_children.get(key), their_children.get(key),
+                                 path + '/' + _describe(key))
+            if child is not None:
+                result.append(child)
+        return result
+
+    def __merged_values(self, base, ours, theirs, path):
+        result = {}
+        for key in set(ours.keys()) | set(theirs.keys()) | set(base.keys()):
+            base_value, our_value, their_value = base.get(key), ours.get(key), theirs.get(key)
+            if our_value == base_value:
+                value = their_value
+            elif their_value == base_value or our_value == their_value:
+                value = our_value
+            else:
+                self.__conflict(path + ('/@' + key if key else ''), None)
+                value = our_value
+            if value is not None:
+                result[key] = value
+        return result
+
+    def __conflict(self, path, ours):
+        self.conflicts.append(path)
+        return ours
+
+
+def _keyed_children(element):
+    result = OrderedDict()
+    for child in element:
+        key = identity_of(child)
+        if key in result:
+            return None
+        result[key] = child
+    return result
+
+
+def _text(element):
+    return (element.text or '').strip() or None
+
+
+def _describe(key):
+    tag, attribute_name, value = key
+    if attribute_name is None:
+        return tag
+    return '%s[@%s="%s"]' % (tag, attribute_name, value)
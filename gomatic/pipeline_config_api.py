@@ -0,0 +1,361 @@
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+
+from gomatic.xml_operations import subtree_digests
+
+PIPELINE_API_ACCEPT = 'application/vnd.go.cd.v6+json'
+TEMPLATE_API_ACCEPT = 'application/vnd.go.cd.v4+json'
+
+
+class EntityDigests(object):
+    """
+    Digests of each pipeline and template in a config, plus one digest of everything else
+    (server, groups' own settings, agents, environments...).
+    """
+    def __init__(self, root):
+        digests = subtree_digests(root)
+        self.pipelines = {}
+        self.templates = {}
+        rest = []
+        for child in root:
+            if child.tag == 'pipelines':
+                group_name = child.attrib['group']
+                group_parts = [group_name]
+                for e in child:
+                    if e.tag == 'pipeline':
+                        self.pipelines[e.attrib['name']] = (group_name, digests[id(e)])
+                    else:
+                        group_parts.append(digests[id(e)])
+                rest.append('\x00'.join(sorted(group_parts)))
+            elif child.tag == 'templates':
+                for e in child:
+                    if e.tag == 'pipeline':
+                        self.templates[e.attrib['name']] = digests[id(e)]
+                    else:
+                        rest.append(digests[id(e)])
+            else:
+                rest.append(digests[id(child)])
+        rest.extend('%s=%s' % item for item in root.attrib.items())
+        self.rest = hashlib.md5('\x01'.join(sorted(rest)).encode('utf-8')).hexdigest()
+
+
+class ConfigChanges(object):
+    def __init__(self, before, after):
+        self.added_pipelines = _added(before.pipelines, after.pipelines)
+        self.removed_pipelines = _added(after.pipelines, before.pipelines)
+        self.changed_pipelines = _changed(before.pipelines, after.pipelines)
+        self.added_templates = _added(before.templates, after.templates)
+        self.removed_templates = _added(after.templates, before.templates)
+        self.changed_templates = _changed(before.templates, after.templates)
+        moved_pipelines = [name for name in self.changed_pipelines
+                           if before.pipelines[name][0] != after.pipelines[name][0]]
+        self.has_other_changes = before.rest != after.rest or len(moved_pipelines) > 0
+
+    def conflicts(self, baseline, current):
+        """
+        The pipelines and templates these changes would add, update or remove that are no longer as they were in
+        baseline (the EntityDigests the changes were worked out from) in current (those of the server's config now).
+        """
+        conflicts = ['pipeline %s' % name for name in self.changed_pipelines + self.removed_pipelines
+                     if current.pipelines.get(name) != baseline.pipelines.get(name)]
+        conflicts += ['pipeline %s' % name for name in self.added_pipelines if name in current.pipelines]
+        conflicts += ['template %s' % name for name in self.changed_templates + self.removed_templates
+                      if current.templates.get(name) != baseline.templates.get(name)]
+        conflicts += ['template %s' % name for name in self.added_templates if name in current.templates]
+        return conflicts
+
+    @property
+    def is_empty(self):
+        return not (self.added_pipelines or self.removed_pipelines or self.changed_pipelines or
+                    self.added_templates or self.removed_templates or self.changed_templates or
+                    self.has_other_changes)
+
+
+def _added(before, after):
+    return sorted(name for name in after if name not in before)
+
+
+def _changed(before, after):
+    return sorted(name for name in after if name in before and before[name] != after[name])
+
+
+class PipelineConfigApi(object):
+    """
+    Saves changed pipelines and templates through GoCD's per-entity config API rather than posting the whole config.xml.
+    """
+    def __init__(self, host_rest_client, max_workers=8):
+        self.__host_rest_client = host_rest_client
+        self.__max_workers = max_workers
+
+    def etags(self, changes):
+        """
+        {path: ETag} of each pipeline and template that changes would update, as the server has it now.
+        Fetch these before checking that the entities are unchanged since the config was read, so that a change
+        made after the check is caught by the If-Match of the update.
+        """
+        etags = {}
+
+        def fetch(path, accept):
+            etags[path] = self.__etag(path, accept)
+
+        self.__run([(fetch, _template_path(n), TEMPLATE_API_ACCEPT) for n in changes.changed_templates] +
+                   [(fetch, _pipeline_path(n), PIPELINE_API_ACCEPT) for n in changes.changed_pipelines])
+        return etags
+
+    def save(self, changes, pipelines, templates, etags):
+        """
+        pipelines and templates are dicts from name to the (wrapped) pipeline or template to send, and etags is
+        what etags returned for the changes.
+        """
+        self.__run([(self.__create_template, templates[n]) for n in changes.added_templates] +
+                   [(self.__update_template, templates[n], etags[_template_path(n)]) for n in changes.changed_templates])
+
+        pipelines_to_create = [pipelines[n] for n in changes.added_pipelines]
+        self.__run([(self.__update_pipeline, pipelines[n], etags[_pipeline_path(n)]) for n in changes.changed_pipelines])
+        while pipelines_to_create:
+            # pipelines depending on other new pipelines have to wait for those to be created first
+            names_to_create = set(p.name for p in pipelines_to_create)
+            ready = [p for p in pipelines_to_create
+                     if not [m for m in p.materials if not m.is_git and not m.is_package and m.pipeline_name in names_to_create]]
+            if not ready:
+                ready = pipelines_to_create
+            self.__run([(self.__create_pipeline, p) for p in ready])
+            ready_names = set(p.name for p in ready)
+            pipelines_to_create = [p for p in pipelines_to_create if p.name not in ready_names]
+
+        self.__run([(self.__delete, _pipeline_path(n), PIPELINE_API_ACCEPT) for n in changes.removed_pipelines])
+        self.__run([(self.__delete, _template_path(n), TEMPLATE_API_ACCEPT) for n in changes.removed_templates])
+
+    def __run(self, calls):
+        if not calls:
+            return
+        pool = ThreadPool(min(self.__max_workers, len(calls)))
+        try:
+            results = pool.map(_call_capturing_error, calls)
+        finally:
+            pool.close()
+        errors = [r for r in results if r is not None]
+        if errors:
+            raise RuntimeError("Could not save %s of %s changes through the config API:\n%s" % (len(errors), len(calls), "\n".join(errors)))
+
+    def __etag(self, path, accept):
+        response = self.__host_rest_client.get(path, headers={'Accept': accept})
+        if response.status_code != 200:
+            raise RuntimeError("Failed to get {} status {}\n:{}".format(path, response.status_code, response.text))
+        return response.headers['ETag']
+
+    def __update_pipeline(self, pipeline, etag):
+        body = pipeline_as_json(pipeline)
+        body['group'] = pipeline.parent.name
+        self.__host_rest_client.put(_pipeline_path(pipeline.name), json.dumps(body), _headers(PIPELINE_API_ACCEPT, etag))
+
+    def __create_pipeline(self, pipeline):
+        body = {'group': pipeline.parent.name, 'pipeline': pipeline_as_json(pipeline)}
+        self.__host_rest_client.post('/go/api/admin/pipelines', json.dumps(body), _headers(PIPELINE_API_ACCEPT))
+
+    def __update_template(self, template, etag):
+        self.__host_rest_client.put(_template_path(template.name), json.dumps(template_as_json(template)), _headers(TEMPLATE_API_ACCEPT, etag))
+
+    def __create_template(self, template):
+        self.__host_rest_client.post('/go/api/admin/templates', json.dumps(template_as_json(template)), _headers(TEMPLATE_API_ACCEPT))
+
+    def __delete(self, path, accept):
+        self.__host_rest_client.delete(path, _headers(accept))
+
+
+def _pipeline_path(name):
+    return '/go/api/admin/pipelines/%s' % name
+
+
+def _template_path(name):
+    return '/go/api/admin/templates/%s' % name
+
+
+def _call_capturing_error(call):
+    try:
+        call[0](*call[1:])
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _headers(accept, etag=None):
+    headers = {'Accept': accept, 'Content-Type': 'application/json'}
+    if etag is not None:
+        headers['If-Match'] = etag
+    return headers
+
+
+def _schema(attributes='', children=None):
+    return frozenset(attributes.split()), children or {}
+
+
+_RUNIF = _schema('status')
+_PROPERTIES = _schema('', {'property': _schema('', {'key': _schema(), 'value': _schema()})})
+_VARIABLES = _schema('', {'variable': _schema('name secure', {'value': _schema(), 'encryptedValue': _schema()})})
+_STAGE = _schema('name cleanWorkingDir fetchMaterials', {
+    'approval': _schema('type', {'authorization': _schema('', {'user': _schema(), 'role': _schema()})}),
+    'environmentvariables': _VARIABLES,
+    'jobs': _schema('', {'job': _schema('name runInstanceCount runOnAllAgents timeout elasticProfileId', {
+        'environmentvariables': _VARIABLES,
+        'resources': _schema('', {'resource': _schema()}),
+        'tabs': _schema('', {'tab': _schema('name path')}),
+        'artifacts': _schema('', {'artifact': _schema('src dest type id storeId', {'configuration': _PROPERTIES}),
+                                  'test': _schema('src dest')}),
+        'tasks': _schema('', {
+            'exec': _schema('command workingdir', {'arg': _schema(), 'runif': _RUNIF}),
+            'rake': _schema('target', {'runif': _RUNIF}),
+            'fetchartifact': _schema('pipeline stage job srcfile srcdir dest artifactId artifactOrigin',
+                                     {'runif': _RUNIF, 'configuration': _PROPERTIES})})})})})
+_PIPELINE = _schema('name labeltemplate lockBehavior isLocked template', {
+    'params': _schema('', {'param': _schema('name')}),
+    'environmentvariables': _VARIABLES,
+    'materials': _schema('', {
+        'git': _schema('url branch materialName autoUpdate dest invertFilter shallowClone',
+                       {'filter': _schema('', {'ignore': _schema('pattern')})}),
+        'pipeline': _schema('pipelineName stageName materialName'),
+        'package': _schema('ref')}),
+    'stage': _STAGE,
+    'timer': _schema('onlyOnChanges')})
+_TEMPLATE = _schema('name', {'stage': _STAGE})
+
+
+def unrepresentable_parts(element, is_template=False):
+    """
+    The paths of the attributes and elements of a pipeline (or template) that pipeline_as_json (or template_as_json)
+    leaves out, e.g. a tracking tool or an svn material. Sending such a pipeline through the config API would remove
+    them from the server.
+    """
+    return _unrepresentable_parts(element, _TEMPLATE if is_template else _PIPELINE, element.tag)
+
+
+def _unrepresentable_parts(element, schema, path):
+    attributes, children = schema
+    result = ['%s/@%s' % (path, name) for name in sorted(element.attrib) if name not in attributes]
+    for child in element:
+        child_path = '%s/%s' % (path, child.tag)
+        if child.tag in children:
+            result.extend(_unrepresentable_parts(child, children[child.tag], child_path))
+        else:
+            result.append(child_path)
+    return result
+
+
+def pipeline_as_json(pipeline):
+    template_name = pipeline.element.attrib.get('template', None)
+    if pipeline.has_lock_behavior:
+        lock_behavior = pipeline.lock_behavior
+    else:
+        lock_behavior = 'lockOnFailure' if pipeline.has_automatic_pipeline_locking else 'none'
+    timer = None
+    if pipeline.has_timer:
+        timer = {'spec': pipeline.timer, 'only_on_changes': pipeline.timer_triggers_only_on_changes}
+    return {
+        'name': pipeline.name,
+        'label_template': pipeline.label_template if pipeline.has_label_template else '${COUNT}',
+        'lock_behavior': lock_behavior,
+        'template': template_name,
+        'parameters': [{'name': k, 'value': v} for k, v in sorted(pipeline.parameters.items())],
+        'environment_variables': _environment_variables_as_json(pipeline),
+        'materials': [_material_as_json(m) for m in pipeline.materials],
+        'stages': None if template_name else [_stage_as_json(s) for s in pipeline.stages],
+        'timer': timer
+    }
+
+
+def template_as_json(template):
+    return {
+        'name': template.name,
+        'stages': [_stage_as_json(s) for s in template.stages]
+    }
+
+
+def _environment_variables_as_json(thing):
+    result = [{'name': k, 'value': v, 'secure': False} for k, v in sorted(thing.environment_variables.items())]
+    result += [{'name': k, 'value': v, 'secure': True} for k, v in sorted(thing.unencrypted_secure_environment_variables.items())]
+    result += [{'name': k, 'encrypted_value': v, 'secure': True} for k, v in sorted(thing.encrypted_environment_variables.items())]
+    return result
+
+
+def _material_as_json(material):
+    if material.is_git:
+        return {'type': 'git', 'attributes': {
+            'url': material.url,
+            'branch': material.branch,
+            'name': material.material_name,
+            'auto_update': material.polling,
+            'destination': material.destination_directory,
+            'filter': {'ignore': sorted(material.ignore_patterns)} if material.ignore_patterns else None,
+            'invert_filter': material.invert_filter,
+            'shallow_clone': material.shallow
+        }}
+    if material.is_package:
+        return {'type': 'package', 'attributes': {'ref': material.ref}}
+    return {'type': 'dependency', 'attributes': {
+        'pipeline': material.pipeline_name,
+        'stage': material.stage_name,
+        'name': material.material_name,
+        'auto_update': True
+    }}
+
+
+def _stage_as_json(stage):
+    approval_type = 'manual' if stage.has_manual_approval else 'success'
+    return {
+        'name': stage.name,
+        'fetch_materials': stage.fetch_materials,
+        'clean_working_directory': stage.clean_working_dir,
+        'approval': {'type': approval_type, 'authorization': {'users': stage.authorized_users, 'roles': stage.authorized_roles}},
+        'environment_variables': _environment_variables_as_json(stage),
+        'jobs': [_job_as_json(j) for j in stage.jobs]
+    }
+
+
+def _job_as_json(job):
+    run_instance_count = None
+    if job.runs_on_all_agents:
+        run_instance_count = 'all'
+    elif job.has_run_instance_count:
+        run_instance_count = int(job.run_instance_count)
+    return {
+        'name': job.name,
+        'run_instance_count': run_instance_count,
+        'timeout': job.timeout if job.has_timeout else None,
+        'elastic_profile_id': job.elastic_profile_id if job.has_elastic_profile_id else None,
+        'environment_variables': _environment_variables_as_json(job),
+        'resources': sorted(job.resources),
+        'tasks': [_task_as_json(t) for t in job.tasks],
+        'tabs': [{'name': t.name, 'path': t.path} for t in job.tabs],
+        'artifacts': [_artifact_as_json(e) for e in job.element.findall('artifacts/*')]
+    }
+
+
+def _task_as_json(task):
+    task_type = task.type
+    if task.type == 'exec':
+        attributes = {'command': task.command_and_args[0], 'arguments': task.command_and_args[1:],
+                      'working_directory': task.working_dir}
+    elif task.type == 'rake':
+        attributes = {'target': task.target}
+    else:
+        task_type = 'fetch'
+        attributes = {'pipeline': task.pipeline, 'stage': task.stage, 'job': task.job}
+        if task.artifact_origin == 'external':
+            attributes.update({'artifact_origin': 'external', 'artifact_id': task.artifact_id,
+                               'configuration': [{'key': k, 'value': v} for k, v in sorted((task.config or {}).items())]})
+        else:
+            src_type, src_value = task.src.as_xml_type_and_value
+            attributes.update({'artifact_origin': 'gocd', 'source': src_value,
+                               'is_source_a_file': src_type == 'srcfile', 'destination': task.dest})
+    attributes['run_if'] = ['passed', 'failed'] if task.runif == 'any' else [task.runif]
+    return {'type': task_type, 'attributes': attributes}
+
+
+def _artifact_as_json(element):
+    artifact_type = element.attrib.get('type', 'build' if element.tag == 'artifact' else 'test')
+    if artifact_type == 'external':
+        configuration = [{'key': p.find('key').text, 'value': p.find('value').text} for p in element.iter('property')]
+        return {'type': 'external', 'artifact_id': element.attrib['id'], 'store_id': element.attrib['storeId'],
+                'configuration': configuration}
+    return {'type': artifact_type, 'source': element.attrib.get('src'), 'destination': element.attrib.get('dest')}
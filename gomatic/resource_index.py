@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+from gomatic.xml_operations import PossiblyMissingElement
+
+JobReference = namedtuple('JobReference', ['pipeline', 'stage', 'job'])
+
+
+def _resources_of(element):
+    return [e.text for e in PossiblyMissingElement(element).possibly_missing_child('resources').findall('resource')]
+
+
+def is_disabled_agent(agent_element):
+    return agent_element.attrib.get('isDisabled') == 'true'
+
+
+class ResourceIndex(object):
+    """
+    Which agents have and which jobs need each resource, read in one pass over the agents and pipelines.
+
+    Resources are numbered and each agent's and job's resources kept as a bit mask, so checking whether any agent
+    has all the resources a job needs is a few integer operations per distinct set of agent resources. Jobs of
+    pipelines based on templates are listed under each such pipeline. Jobs that run on elastic agents need no
+    resources from the agents in the config, so they are never unsatisfiable. Disabled agents run no jobs, so they
+    are left out and only listed in disabled_agents.
+    """
+    def __init__(self, agent_elements, pipeline_elements, template_elements):
+        self.__bits = {}
+        self.__agents = {}
+        self.__jobs = {}
+        self.__elastic_jobs = set()
+        self.__agents_with = {}
+        self.__jobs_needing = {}
+        self.__disabled_agents = []
+        for agent_element in agent_elements:
+            hostname = agent_element.attrib['hostname']
+            if is_disabled_agent(agent_element):
+                self.__disabled_agents.append(hostname)
+                continue
+            resources = _resources_of(agent_element)
+            self.__agents[hostname] = self.__mask(resources)
+            for resource in set(resources):
+                self.__agents_with.setdefault(resource, []).append(hostname)
+        templates = dict((e.attrib['name'], e) for e in template_elements)
+        for pipeline_element in pipeline_elements:
+            stages_from = templates.get(pipeline_element.attrib.get('template'), pipeline_element)
+            for stage_element in stages_from.findall('stage'):
+                for job_element in PossiblyMissingElement(stage_element).possibly_missing_child('jobs').findall('job'):
+                    job = JobReference(pipeline_element.attrib['name'], stage_element.attrib['name'], job_element.attrib['name'])
+                    resources = _resources_of(job_element)
+                    self.__jobs[job] = self.__mask(resources)
+                    for resource in set(resources):
+                        self.__jobs_needing.setdefault(resource, []).append(job)
+                    if 'elasticProfileId' in job_element.attrib:
+                        self.__elastic_jobs.add(job)
+        self.__agent_masks = set(self.__agents.values())
+        self.__satisfiable = {}
+
+    def __mask(self, resources):
+        mask = 0
+        for resource in resources:
+            if resource not in self.__bits:
+                self.__bits[resource] = 1 << len(self.__bits)
+            mask |= self.__bits[resource]
+        return mask
+
+    def __required(self, resources):
+        mask = 0
+        for resource in resources:
+            if resource not in self.__bits:
+                return None
+            mask |= self.__bits[resource]
+        return mask
+
+    def __is_satisfiable(self, mask):
+        if mask not in self.__satisfiable:
+            self.__satisfiable[mask] = any(agent_mask & mask == mask for agent_mask in self.__agent_masks)
+        return self.__satisfiable[mask]
+
+    @property
+    def resources(self):
+        return sorted(self.__bits)
+
+    @property
+    def disabled_agents(self):
+        return sorted(self.__disabled_agents)
+
+    def agents_with(self, resource):
+        return sorted(self.__agents_with.get(resource, []))
+
+    def jobs_needing(self, resource):
+        return sorted(self.__jobs_needing.get(resource, []))
+
+    def agents_for(self, resources):
+        """
+        The hostnames of the agents that have all of resources.
+        """
+        mask = self.__required(resources)
+        if mask is None:
+            return []
+        return sorted(hostname for hostname, agent_mask in self.__agents.items() if agent_mask & mask == mask)
+
+    @property
+    def unsatisfiable_jobs(self):
+        """
+        The jobs that no agent has all the resources for, which GoCD would leave scheduled forever.
+        """
+        return sorted(job for job, mask in self.__jobs.items()
+                      if job not in self.__elastic_jobs and not self.__is_satisfiable(mask))
+
+    def supply_and_demand(self):
+        """
+        {resource: (number of agents that have it, number of jobs that need it)}
+        """
+        return dict((resource, (len(self.__agents_with.get(resource, [])), len(self.__jobs_needing.get(resource, []))))
+                    for resource in self.__bits)
@@ -0,0 +1,67 @@
+# top level sections that can be large, so are only remembered once the configurator hands them out
+LAZY_SECTIONS = ('pipelines', 'templates', 'agents', 'environments', 'config-repos', 'repositories')
+
+
+class Savepoint(object):
+    """
+    Remembers enough of the config to roll back to it later.
+
+    The structure (which groups, pipelines and templates exist, in what order) and the small top level sections
+    are remembered straight away, as is what the wrappers still in use were handed (handed_out maps each wrapper's id
+    to a weak reference to it and its element), so that wrappers obtained before the savepoint are rolled back too.
+    Any other pipeline, template or large section is only remembered the first time it is handed out or changed
+    after the savepoint was taken, so a savepoint costs the size of what is held or touched, not the size of the
+    config.
+    """
+    def __init__(self, root, handed_out):
+        self.__root = root
+        self.__handed_out = handed_out
+        self.__capture()
+
+    def __capture(self):
+        self.__structure = [(self.__root, dict(self.__root.attrib), list(self.__root))]
+        self.__copies = {}
+        for child in self.__root:
+            if child.tag in ('pipelines', 'templates'):
+                self.__structure.append((child, dict(child.attrib), list(child)))
+                for e in child:
+                    if e.tag != 'pipeline':
+                        self.record(e)
+            elif child.tag not in LAZY_SECTIONS:
+                self.record(child)
+        for wrapper, element in list(self.__handed_out.values()):
+            if wrapper() is not None:
+                self.record(element)
+
+    def __len__(self):
+        """
+        The number of elements remembered, each with everything under it.
+        """
+        return len(self.__copies)
+
+    def record(self, element):
+        if id(element) not in self.__copies:
+            self.__copies[id(element)] = [_state_of(e) for e in element.iter()]
+
+    def rollback(self):
+        for states in self.__copies.values():
+            for state in states:
+                _restore(*state)
+        for element, attributes, children in self.__structure:
+            element.attrib.clear()
+            element.attrib.update(attributes)
+            element[:] = children
+        self.__capture()
+
+
+def _state_of(element):
+    # the elements themselves are kept (rather than copies of them), so wrappers held across a rollback stay in the tree
+    return element, dict(element.attrib), element.text, element.tail, list(element)
+
+
+def _restore(element, attributes, text, tail, children):
+    element.clear()
+    element.attrib.update(attributes)
+    element.text = text
+    element.tail = tail
+    element.extend(children)
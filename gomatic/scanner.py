@@ -0,0 +1,95 @@
+import io
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from gomatic.gocd.artifacts import Artifact
+from gomatic.gocd.materials import Materials
+from gomatic.gocd.tasks import Task
+
+ScannedPipelineGroup = namedtuple('ScannedPipelineGroup', ['name'])
+ScannedPipeline = namedtuple('ScannedPipeline', ['group', 'name', 'template', 'materials', 'timer'])
+ScannedStage = namedtuple('ScannedStage', ['group', 'pipeline', 'name'])
+ScannedJob = namedtuple('ScannedJob', ['group', 'pipeline', 'stage', 'name', 'resources', 'tasks', 'artifacts'])
+
+_PIPELINE_DEPTH = 3
+
+
+def scan(source):
+    """
+    Reads a config (a file name, a file object or the config bytes) without building a tree of it, yielding a
+    ScannedPipelineGroup, ScannedPipeline, ScannedStage or ScannedJob for each pipeline group, pipeline, stage and job
+    in document order. Only the pipeline being read is held in memory, so memory use does not grow with the
+    config. Materials, tasks and artifacts are the same objects Pipeline.materials, Job.tasks and Job.artifacts return.
+    Templates are not scanned.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    stack = []
+    group = None
+    pipeline = None
+    stage = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            if len(stack) < 2 or stack[1].tag != 'pipelines':
+                continue
+            depth = len(stack)
+            if depth == 2:
+                group = element.attrib.get('group')
+                yield ScannedPipelineGroup(group)
+            elif depth == _PIPELINE_DEPTH:
+                pipeline = _PendingPipeline(group, element)
+            elif depth == _PIPELINE_DEPTH + 1 and element.tag == 'stage':
+                for record in pipeline.emit():
+                    yield record
+                stage = element.attrib['name']
+                yield ScannedStage(group, pipeline.name, stage)
+            continue
+
+        depth = len(stack)
+        in_pipeline_group = depth >= 2 and stack[1].tag == 'pipelines'
+        stack.pop()
+        if in_pipeline_group:
+            if depth == _PIPELINE_DEPTH:
+                for record in pipeline.emit():
+                    yield record
+            elif depth == _PIPELINE_DEPTH + 1:
+                pipeline.read(element)
+            elif depth == _PIPELINE_DEPTH + 3 and element.tag == 'job':
+                yield _scanned_job(group, pipeline.name, stage, element)
+        if depth <= _PIPELINE_DEPTH + 1 or element.tag == 'job':
+            element.clear()
+            if stack:
+                stack[-1].remove(element)
+
+
+class _PendingPipeline(object):
+    def __init__(self, group, element):
+        self.group = group
+        self.name = element.attrib['name']
+        self.template = element.attrib.get('template')
+        self.materials = []
+        self.timer = None
+        self.__emitted = False
+
+    def read(self, element):
+        if element.tag == 'materials':
+            self.materials = [Materials(e) for e in element]
+        elif element.tag == 'timer':
+            self.timer = element.text
+
+    def emit(self):
+        if self.__emitted:
+            return []
+        self.__emitted = True
+        return [ScannedPipeline(self.group, self.name, self.template, self.materials, self.timer)]
+
+
+def _scanned_job(group, pipeline_name, stage_name, element):
+    resources = element.find('resources')
+    tasks = element.find('tasks')
+    artifacts = element.find('artifacts')
+    return ScannedJob(group, pipeline_name, stage_name, element.attrib['name'],
+                      set(e.text for e in resources.findall('resource')) if resources is not None else set(),
+                      [Task(e) for e in tasks] if tasks is not None else [],
+                      set(Artifact.get_artifact_for(e) for e in artifacts) if artifacts is not None else set())
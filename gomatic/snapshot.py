@@ -0,0 +1,71 @@
+import hashlib
+import json
+import struct
+import time
+import zlib
+
+MAGIC = b'GOMATIC-SNAPSHOT'
+FORMAT_VERSION = 1
+_HEADER_LAYOUT = '>HI'
+
+
+class ConfigSnapshot(object):
+    """
+    The config as last fetched from (or saved to) a GoCD server, with its md5 and the server version, in a compact
+    binary file: a small JSON header followed by the zlib compressed config XML.
+
+    Loading one skips fetching the config and server version and recomputing the config digest. The XML itself is
+    still parsed with expat because nothing in the standard library builds an ElementTree faster than that.
+    """
+    def __init__(self, config, md5, digest, server_version, host, created=None):
+        self.config = config
+        self.md5 = md5
+        self.digest = digest
+        self.server_version = server_version
+        self.host = host
+        self.created = time.time() if created is None else created
+
+    def save(self, path):
+        payload = zlib.compress(self.config)
+        header = json.dumps({
+            'md5': self.md5,
+            'digest': self.digest,
+            'server_version': self.server_version,
+            'host': self.host,
+            'created': self.created,
+            'payload_md5': hashlib.md5(payload).hexdigest()
+        }).encode('utf-8')
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(MAGIC)
+            snapshot_file.write(struct.pack(_HEADER_LAYOUT, FORMAT_VERSION, len(header)))
+            snapshot_file.write(header)
+            snapshot_file.write(payload)
+
+    @classmethod
+    def load(cls, path, host, max_age=None):
+        """
+        Returns None if there is no usable snapshot at path for host: missing, unknown format version,
+        corrupt, taken from another server or older than max_age seconds.
+        """
+        try:
+            with open(path, 'rb') as snapshot_file:
+                data = snapshot_file.read()
+        except IOError:
+            return None
+        prefix_length = len(MAGIC) + struct.calcsize(_HEADER_LAYOUT)
+        if not data.startswith(MAGIC) or len(data) < prefix_length:
+            return None
+        format_version, header_length = struct.unpack(_HEADER_LAYOUT, data[len(MAGIC):prefix_length])
+        if format_version != FORMAT_VERSION:
+            return None
+        try:
+            header = json.loads(data[prefix_length:prefix_length + header_length].decode('utf-8'))
+        except ValueError:
+            return None
+        payload = data[prefix_length + header_length:]
+        if hashlib.md5(payload).hexdigest() != header['payload_md5'] or header['host'] != host:
+            return None
+        if max_age is not None and time.time() - header['created'] > max_age:
+            return None
+        return cls(zlib.decompress(payload), header['md5'], header['digest'], header['server_version'],
+                   header['host'], header['created'])
@@ -0,0 +1,118 @@
+import hashlib
+import re
+
+SECONDS_PER_DAY = 24 * 60 * 60
+_FIELD_PART = re.compile(r'^(\*|\?|\d+(?:-\d+)?)(?:/(\d+))?$')
+
+
+def _field_values(field, lowest, highest):
+    values = set()
+    for part in field.split(','):
+        match = _FIELD_PART.match(part)
+        if match is None:
+            return None
+        value_range, step = match.groups()
+        if value_range in ('*', '?'):
+            first, last = lowest, highest
+        elif '-' in value_range:
+            first, last = [int(v) for v in value_range.split('-')]
+        else:
+            first = int(value_range)
+            last = highest if step else first
+        if first < lowest or last > highest:
+            return None
+        values.update(range(first, last + 1, int(step) if step else 1))
+    return values
+
+
+def start_times(timer_spec):
+    """
+    The seconds of the day at which a GoCD (Quartz cron) timer spec starts a pipeline on the days it runs, or None
+    if the seconds, minutes or hours fields use syntax this does not understand. The day, month and year fields
+    are not looked at.
+    """
+    fields = timer_spec.split()
+    if len(fields) < 6:
+        return None
+    seconds = _field_values(fields[0], 0, 59)
+    minutes = _field_values(fields[1], 0, 59)
+    hours = _field_values(fields[2], 0, 23)
+    if seconds is None or minutes is None or hours is None:
+        return None
+    return sorted(h * 3600 + m * 60 + s for h in hours for m in minutes for s in seconds)
+
+
+def _timer_elements(pipeline_elements):
+    for pipeline_element in pipeline_elements:
+        timer_element = pipeline_element.find('timer')
+        if timer_element is not None and timer_element.text:
+            yield pipeline_element, timer_element
+
+
+class TimerHistogram(object):
+    """
+    How many pipeline starts timers schedule in each minute of the day (0 is 00:00, 1439 is 23:59).
+    """
+    def __init__(self, pipeline_elements):
+        self.starts_per_minute = {}
+        self.unparsed = []
+        for pipeline_element, timer_element in _timer_elements(pipeline_elements):
+            times = start_times(timer_element.text)
+            if times is None:
+                self.unparsed.append(pipeline_element.attrib['name'])
+                continue
+            for start in times:
+                minute = start // 60
+                self.starts_per_minute[minute] = self.starts_per_minute.get(minute, 0) + 1
+
+    def __repr__(self):
+        return 'TimerHistogram(%s starts in %s minutes)' % (sum(self.starts_per_minute.values()), len(self.starts_per_minute))
+
+    def busiest(self, count=10):
+        """
+        (minute of the day, number of starts) for the count minutes with most starts, busiest first.
+        """
+        return sorted(self.starts_per_minute.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+def spread_offset(pipeline_name, window):
+    """
+    A number of seconds in [0, window) that depends only on the pipeline name.
+    """
+    return int(hashlib.md5(pipeline_name.encode('utf-8')).hexdigest(), 16) % window
+
+
+def spread_timers(pipeline_elements, window, track, timer_spec=None, base=None):
+    """
+    Moves each timer that starts once a day in the window seconds from base (the seconds, minutes and hours
+    fields of a timer spec, e.g. '0 0 2') to base plus spread_offset(pipeline name, window) seconds, keeping the
+    day fields and onlyOnChanges. base defaults to the start of timer_spec, and when timer_spec is given only timers
+    that are timer_spec are moved. The new start depends only on base and the pipeline name, so spreading again
+    changes nothing. Starts pushed past midnight wrap around to the start of the same day. track is called with
+    each pipeline element before it is changed. Returns {pipeline name: new timer spec} for the timers changed.
+    """
+    if base is None and timer_spec is None:
+        raise RuntimeError("Need a base start or the timer spec to spread, so that spreading again does not move the timers further")
+    base_times = start_times(timer_spec if base is None else base + ' * * ?')
+    if base_times is None or len(base_times) != 1:
+        if base is not None:
+            raise RuntimeError('Base "%s" is not a single start time' % base)
+        return {}
+    base_start = base_times[0]
+    changed = {}
+    for pipeline_element, timer_element in _timer_elements(pipeline_elements):
+        if timer_spec is not None and timer_element.text.strip() != timer_spec.strip():
+            continue
+        times = start_times(timer_element.text)
+        if times is None or len(times) != 1 or (times[0] - base_start) % SECONDS_PER_DAY >= window:
+            continue
+        start = (base_start + spread_offset(pipeline_element.attrib['name'], window)) % SECONDS_PER_DAY
+        fields = timer_element.text.split()
+        fields[0:3] = [str(start % 60), str(start // 60 % 60), str(start // 3600)]
+        spec = ' '.join(fields)
+        if spec == timer_element.text:
+            continue
+        track(pipeline_element)
+        timer_element.text = spec
+        changed[pipeline_element.attrib['name']] = spec
+    return changed
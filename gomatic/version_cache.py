@@ -0,0 +1,42 @@
+import json
+import os
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.gomatic', 'server-versions.json')
+DEFAULT_TTL = 24 * 60 * 60
+
+
+class VersionCache(object):
+    """
+    Remembers GoCD server versions per host in a small JSON file so that short scripts can skip asking for them.
+    """
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def __repr__(self):
+        return 'VersionCache("%s", ttl=%s)' % (self.path, self.ttl)
+
+    def __entries(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, host):
+        entry = self.__entries().get(host)
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry['version']
+
+    def put(self, host, version):
+        entries = self.__entries()
+        entries[host] = {'version': version, 'fetched': time.time()}
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.rename(temporary_path, self.path)
@@ -1,3 +1,4 @@
+import hashlib
 from xml.dom.minidom import parseString
 from xml.etree import ElementTree as ET
 
@@ -135,6 +136,42 @@ def ignore_patterns_in(element):
     return set([e.attrib['pattern'] for e in children])
 
 
+def _content(text):
+    # whitespace only text is formatting; any other text is content, compared exactly as written
+    return text if text and text.strip() else ''
+
+
+def canonical_digest(element):
+    # ignores formatting whitespace and attribute order, like comparing prettified config does,
+    # but without building any strings the size of the config
+    digest = hashlib.md5()
+    for e in element.iter():
+        parts = [e.tag, str(len(e)), _content(e.text), _content(e.tail)]
+        parts.extend('%s=%s' % item for item in sorted(e.attrib.items()))
+        digest.update(u'\x00'.join(parts).encode('utf-8'))
+        digest.update(b'\x01')
+    return digest.hexdigest()
+
+
+def subtree_digests(root):
+    # digest of every element, keyed by id(element), built bottom up in one pass
+    digests = {}
+
+    def visit(element):
+        digest = hashlib.md5()
+        parts = [element.tag, _content(element.text)]
+        parts.extend('%s=%s' % item for item in sorted(element.attrib.items()))
+        digest.update(u'\x00'.join(parts).encode('utf-8'))
+        for child in element:
+            digest.update(b'\x01')
+            digest.update(visit(child).encode('ascii'))
+        digests[id(element)] = digest.hexdigest()
+        return digests[id(element)]
+
+    visit(root)
+    return digests
+
+
 def prettify(xml_string):
     xml = parseString(xml_string)
     formatted_but_with_blank_lines = xml.toprettyxml()
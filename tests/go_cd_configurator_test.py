@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
 import unittest
 import xml.etree.ElementTree as ET
 import os
 from decimal import Decimal
 from xml.dom.minidom import parseString
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 from gomatic import (
     ExecTask,
     FetchArtifactDir,
@@ -14,6 +24,7 @@ from gomatic import (
     FetchArtifactTask,
     GitMaterial,
     GoCdConfigurator,
+    HostRestClient,
     Pipeline,
     PipelineMaterial,
     RakeTask,
@@ -23,7 +34,19 @@ from gomatic import (
 from gomatic.fake import FakeHostRestClient, config, config_18_3_0, empty_config, empty_config_xml, load_file
 from gomatic.gocd.artifacts import Artifact, ArtifactFor, BuildArtifact, TestArtifact, ExternalArtifact
 from gomatic.gocd.artifact_stores import ArtifactStores, ArtifactStore
+from gomatic.gocd.capabilities import ServerCapabilities
 from gomatic.gocd.pipelines import DEFAULT_LABEL_TEMPLATE
+from gomatic.gocd.properties import PropertyBag
+from gomatic.go_cd_configurator import ConfigConflictError
+from gomatic.agents_api import AgentsApi, RateLimiter
+from gomatic.commit_impact import ant_glob_matches
+from gomatic.material_index import normalize_git_url
+from gomatic.merge import MergeConflictError, three_way_merge
+from gomatic.pipeline_config_api import pipeline_as_json, unrepresentable_parts
+from gomatic.resource_index import JobReference
+from gomatic.timers import start_times
+from gomatic.scanner import ScannedJob, ScannedPipeline, ScannedPipelineGroup, ScannedStage, scan
+from gomatic.version_cache import VersionCache
 from gomatic.xml_operations import prettify
 
 
@@ -806,6 +829,62 @@ class TestConfigRepo(unittest.TestCase):
         configurator.ensure_config_repos().ensure_config_repo('git://url', 'yml.config.plugin')
         self.assertIsNotNone(configurator.config_repos.config_repo[0].repo_id)
 
+    def test_can_find_config_repos_by_id_and_url(self):
+        configurator = GoCdConfigurator(FakeHostRestClient(empty_config_xml, version='17.9.0'))
+        config_repos = configurator.ensure_config_repos()
+        config_repos.ensure_config_repo('git://url', 'yaml.config.plugin', repo_id='yaml')
+        config_repos.ensure_config_repo('git://url', 'json.config.plugin', repo_id='json')
+
+        self.assertEqual(config_repos.config_repo_with_id('json').plugin, 'json.config.plugin')
+        self.assertEqual(config_repos.config_repo_with_id('missing'), None)
+        self.assertEqual(sorted(r.repo_id for r in configurator.config_repos.config_repos_with_url('git://url')), ['json', 'yaml'])
+        self.assertEqual(configurator.config_repos.config_repos_with_url('git://other'), [])
+
+    def test_sync_adds_updates_and_removes_config_repos(self):
+        configurator = GoCdConfigurator(FakeHostRestClient(empty_config_xml, version='17.9.0'))
+        config_repos = configurator.ensure_config_repos()
+        config_repos.ensure_config_repo('git://same', 'yaml.config.plugin', repo_id='same')
+        config_repos.ensure_config_repo('git://changed', 'yaml.config.plugin', repo_id='changed')
+        config_repos.ensure_config_repo('git://gone', 'yaml.config.plugin', repo_id='gone')
+        same_element = config_repos.config_repo_with_id('same').element
+        desired = [{'url': 'git://same', 'plugin': 'yaml.config.plugin', 'repo_id': 'same'},
+                   {'url': 'git://moved', 'plugin': 'json.config.plugin', 'repo_id': 'changed', 'branch': 'release',
+                    'configuration': {'file_pattern': '*.json'}},
+                   {'url': 'svn://new', 'plugin': 'yaml.config.plugin', 'cvs': 'svn', 'repo_id': 'new'}]
+
+        self.assertEqual(configurator.config_repos.sync(desired), ['git://gone', 'git://moved', 'svn://new'])
+
+        config_repos = configurator.config_repos
+        self.assertEqual(sorted(r.repo_id for r in config_repos.config_repo), ['changed', 'new', 'same'])
+        changed = config_repos.config_repo_with_id('changed')
+        self.assertEqual((changed.url, changed.plugin, changed.branch), ('git://moved', 'json.config.plugin', 'release'))
+        self.assertEqual(changed.configuration, {'file_pattern': '*.json'})
+        self.assertEqual(config_repos.config_repo_with_id('new').cvs, 'svn')
+        self.assertTrue(config_repos.config_repo_with_id('same').element is same_element)
+        self.assertEqual(config_repos.sync(desired), [])
+
+    def test_config_repos_index_is_shared_and_kept_up_to_date(self):
+        configurator = GoCdConfigurator(FakeHostRestClient(empty_config_xml, version='17.9.0'))
+        configurator.ensure_config_repos().ensure_config_repo('git://a', 'yaml.config.plugin', repo_id='a')
+        configurator.ensure_config_repos().ensure_config_repo('git://b', 'yaml.config.plugin', repo_id='b')
+        index = configurator._cache('config_repos_index')
+
+        configurator.ensure_config_repos().ensure_replacement_of_config_repo('git://a', 'json.config.plugin')
+        configurator.ensure_config_repos().sync([{'url': 'git://b', 'plugin': 'yaml.config.plugin', 'repo_id': 'b', 'branch': 'x'},
+                                                 {'url': 'git://a', 'plugin': 'json.config.plugin'}])
+
+        self.assertTrue(configurator._cache('config_repos_index') is index)
+        self.assertEqual(configurator.config_repos.config_repo_with_id('a'), None)
+        self.assertEqual(configurator.config_repos.config_repo_with_id('b').branch, 'x')
+        self.assertEqual([r.plugin for r in configurator.config_repos.config_repos_with_url('git://a')], ['json.config.plugin'])
+        self.assertEqual(len(configurator.config_repos.config_repo), 2)
+
+    def test_ensure_config_repo_returns_the_existing_config_repo(self):
+        config_repos = self.configurator.ensure_config_repos()
+        first = config_repos.ensure_yaml_config_repo('git://url')
+
+        self.assertTrue(config_repos.ensure_yaml_config_repo('git://url').element is first.element)
+
 class TestPipeline(unittest.TestCase):
     def test_pipelines_have_names(self):
         pipeline = typical_pipeline()
@@ -1427,6 +1506,73 @@ class TestSecurity(unittest.TestCase):
         self.assertEqual(self.configurator.security.roles.role[0].name, 'role_name')
         self.assertEqual(self.configurator.security.roles.role[0].users, ['user1', 'user2'])
 
+    def test_adding_an_admin_user_twice_adds_it_once(self):
+        self.configurator.ensure_security().ensure_admins().add_user(name='admin').add_user(name='admin')
+
+        self.assertEqual(self.configurator.security.admins.users, ['admin'])
+
+    def test_can_sync_admin_users_leaving_admin_roles_alone(self):
+        admins = self.configurator.ensure_security().ensure_admins().add_user('alice').add_user('bob')
+        ET.SubElement(admins.element, 'role').text = 'admin_role'
+
+        self.assertTrue(admins.sync_users(['bob', 'carol & dave']))
+        self.assertFalse(admins.sync_users(['carol & dave', 'bob']))
+
+        self.assertEqual(self.configurator.security.admins.users, ['bob', 'carol & dave'])
+        self.assertEqual(admins.element.find('role').text, 'admin_role')
+
+    def test_ensuring_an_existing_role_updates_its_users_in_place(self):
+        roles = self.configurator.ensure_security().ensure_roles()
+        roles.ensure_role(name='role_name', users=['user1', 'user2'])
+        roles.ensure_role(name='role_name', users=['user2', 'user3'])
+
+        self.assertEqual(len(self.configurator.security.roles), 1)
+        self.assertEqual(self.configurator.security.roles.role[0].users, ['user2', 'user3'])
+
+    def test_can_find_role(self):
+        roles = self.configurator.ensure_security().ensure_roles().ensure_role(name='role_name', users=['user1'])
+
+        self.assertEqual(roles.find_role('role_name').users, ['user1'])
+        self.assertEqual(roles.find_role('missing'), None)
+
+    def test_sync_roles_changes_only_what_differs(self):
+        roles = self.configurator.ensure_security().ensure_roles()
+        roles.ensure_role(name='same', users=['user1']).ensure_role(name='changed', users=['user1']).ensure_role(name='gone', users=['user1'])
+        roles.ensure_plugin_role(name='plugin_role', auth_config_id='auth')
+        same_element = roles.find_role('same').element
+
+        changed = self.configurator.ensure_security().ensure_roles().sync_roles({'same': ['user1'], 'changed': ['user2'], 'new': ['user3']})
+
+        self.assertEqual(changed, ['changed', 'gone', 'new'])
+        roles = self.configurator.security.roles
+        self.assertEqual(sorted(r.name for r in roles.role), ['changed', 'new', 'same'])
+        self.assertEqual(roles.find_role('changed').users, ['user2'])
+        self.assertTrue(roles.find_role('same').element is same_element)
+        self.assertEqual([r.name for r in roles.plugin_role], ['plugin_role'])
+        self.assertEqual(roles.sync_roles({'same': ['user1'], 'changed': ['user2'], 'new': ['user3']}), [])
+
+    def test_sync_roles_removes_duplicate_roles_and_users(self):
+        roles = self.configurator.ensure_security().ensure_roles()
+        for users in (['a'], ['b']):
+            role = ET.SubElement(roles.element, 'role', {'name': 'dev'})
+            ET.SubElement(ET.SubElement(role, 'users'), 'user').text = users[0]
+
+        self.assertEqual(roles.sync_roles({'dev': ['a']}), ['dev'])
+        self.assertEqual([(r.name, r.users) for r in roles.role], [('dev', ['a'])])
+
+        self.assertTrue(roles.find_role('dev').set_users(['b', 'b']))
+        self.assertEqual(roles.find_role('dev').users, ['b'])
+
+    def test_roles_index_is_shared_by_every_roles_wrapper(self):
+        self.configurator.ensure_security().ensure_roles().ensure_role(name='a', users=['user1'])
+        index = self.configurator._cache('roles_by_name')
+
+        self.configurator.security.roles.ensure_role(name='b', users=['user2'])
+
+        self.assertTrue(self.configurator._cache('roles_by_name') is index)
+        self.assertEqual(self.configurator.ensure_security().ensure_roles().find_role('b').users, ['user2'])
+        self.assertEqual(self.configurator.ensure_security().ensure_replacement_of_roles().find_role('a'), None)
+
     def test_can_ensure_plugin_roles(self):
         self.configurator.ensure_security().ensure_roles().ensure_plugin_role(name='role_name',
                                                                               auth_config_id='id-for-auth-plugin',
@@ -1565,7 +1711,7 @@ class TestElastic(unittest.TestCase):
 
         self.assertEqual(len(self.configurator.elastic.profiles), 1)
 
-    def test_doesnt_add_same_plugin_twice_and_equality_is_only_by_id(self):
+    def test_ensuring_a_profile_twice_keeps_one_profile_with_the_latest_plugin(self):
         self.configurator.ensure_elastic(). \
             ensure_profiles(). \
             ensure_profile(profile_id='unit-test', plugin_id='cd.go.contrib.elastic-agent.docker', properties={})
@@ -1574,8 +1720,59 @@ class TestElastic(unittest.TestCase):
             ensure_profile(profile_id='unit-test', plugin_id='cd.go.contrib.elastic-agent.docker-swarm', properties={})
 
         self.assertEqual(self.configurator.elastic.profiles[0].profile_id, 'unit-test')
-        self.assertEqual(self.configurator.elastic.profiles[0].plugin_id, 'cd.go.contrib.elastic-agent.docker')
+        self.assertEqual(self.configurator.elastic.profiles[0].plugin_id, 'cd.go.contrib.elastic-agent.docker-swarm')
         self.assertEqual(self.configurator.elastic.profiles[0].properties, {})
+        self.assertEqual(len(self.configurator.elastic.profiles), 1)
+
+    def test_ensure_profile_updates_an_existing_profile_in_place(self):
+        profiles = self.configurator.ensure_elastic().ensure_profiles()
+        profile = profiles.ensure_profile(profile_id='a', plugin_id='docker', properties={'Image': 'alpine', 'Memory': '1G'})
+        image = profile.element.find('property')
+
+        profiles.ensure_profile(profile_id='a', plugin_id='docker', properties={'Image': 'alpine'})
+
+        self.assertEqual(self.configurator.elastic.profiles.find_profile('a').properties, {'Image': 'alpine'})
+        self.assertTrue(profile.element.find('property') is image)
+
+    def test_replacement_of_profile_updates_it_in_place(self):
+        profiles = self.configurator.ensure_elastic().ensure_profiles()
+        profiles.ensure_profile(profile_id='a', plugin_id='docker', properties={'Image': 'alpine', 'Memory': '1G'})
+        profiles.ensure_profile(profile_id='b', plugin_id='docker', properties={})
+
+        profiles.ensure_replacement_of_profile(profile_id='a', plugin_id='swarm', properties={'Image': 'ubuntu'})
+
+        self.assertEqual([p.profile_id for p in self.configurator.elastic.profiles], ['a', 'b'])
+        self.assertEqual(self.configurator.elastic.profiles.find_profile('a').plugin_id, 'swarm')
+        self.assertEqual(self.configurator.elastic.profiles.find_profile('a').properties, {'Image': 'ubuntu'})
+
+    def test_profiles_index_is_shared_by_every_profiles_wrapper(self):
+        self.configurator.ensure_elastic().ensure_profiles().ensure_profile(profile_id='a', plugin_id='docker', properties={})
+        index = self.configurator._cache('profiles_by_id')
+
+        self.configurator.elastic.profiles.ensure_profile(profile_id='b', plugin_id='docker', properties={})
+
+        self.assertTrue(self.configurator._cache('profiles_by_id') is index)
+        self.assertEqual(self.configurator.ensure_elastic().ensure_profiles().find_profile('b').profile_id, 'b')
+        self.assertEqual(self.configurator.ensure_elastic().ensure_replacement_of_profiles().find_profile('a'), None)
+
+    def test_sync_adds_updates_and_removes_profiles(self):
+        profiles = self.configurator.ensure_elastic().ensure_profiles()
+        profiles.ensure_profile(profile_id='same', plugin_id='docker', properties={'Image': 'alpine'})
+        profiles.ensure_profile(profile_id='changed', plugin_id='docker', properties={'Image': 'alpine'})
+        profiles.ensure_profile(profile_id='gone', plugin_id='docker', properties={})
+        same_property = profiles.find_profile('same').element.find('property')
+        desired = {'same': ('docker', {'Image': 'alpine'}),
+                   'changed': ('docker', {'Image': 'ubuntu'}),
+                   'new': ('swarm', {'Image': 'alpine'})}
+
+        self.assertEqual(self.configurator.elastic.profiles.sync(desired), ['changed', 'gone', 'new'])
+
+        profiles = self.configurator.elastic.profiles
+        self.assertEqual(sorted(p.profile_id for p in profiles.profile), ['changed', 'new', 'same'])
+        self.assertEqual(profiles.find_profile('changed').properties, {'Image': 'ubuntu'})
+        self.assertEqual(profiles.find_profile('new').plugin_id, 'swarm')
+        self.assertTrue(profiles.find_profile('same').element.find('property') is same_property)
+        self.assertEqual(profiles.sync(desired), [])
 
 
 class TestGoCdConfigurator(unittest.TestCase):
@@ -1645,6 +1842,154 @@ class TestGoCdConfigurator(unittest.TestCase):
     def test_gets_all_pipeline_groups(self):
         self.assertEqual(2, len(GoCdConfigurator(config('config-with-two-pipeline-groups')).pipeline_groups))
 
+    def test_has_no_changes_when_only_formatting_differs(self):
+        configurator = GoCdConfigurator(FakeHostRestClient(load_file('config-unformatted')))
+        self.assertFalse(configurator.has_changes)
+
+    def test_has_changes_when_only_whitespace_in_a_value_differs(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        job = configurator.ensure_pipeline_group('Second.Group').find_pipeline('smoke-tests').stages[0].jobs[0]
+        arg = next(job.element.iter('arg'))
+        arg.text += '  '
+        self.assertTrue(configurator.has_changes)
+
+    def test_parses_non_ascii_config_from_response_bytes(self):
+        configurator = GoCdConfigurator(config('config-with-unencrypted-secure-variable-unicode'))
+        configurator.ensure_pipeline_group("defaultGroup").find_pipeline("example").ensure_stage("new")
+        self.assertTrue(configurator.has_changes)
+        self.assertIn(u'hunter2\u00aa'.encode('utf-8'), configurator.config)
+
+    def test_save_posts_serialized_bytes_only_when_there_are_changes(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.save_updated_config()
+        self.assertEqual([], host_rest_client.posts)
+
+        configurator.ensure_pipeline_group('new-group')
+        configurator.save_updated_config()
+        self.assertEqual(1, len(host_rest_client.posts))
+        path, data = host_rest_client.posts[0]
+        self.assertEqual('/go/api/admin/config.xml', path)
+        self.assertIsInstance(data['xmlFile'], bytes)
+        self.assertEqual('42', data['md5'])
+        self.assertFalse(configurator.has_changes)
+
+    def test_adopting_posted_config_after_save_only_asks_for_new_md5(self):
+        class ContentMd5HostRestClient(FakeHostRestClient):
+            def update_config(self, config_string):
+                self.config_string = config_string
+                self.md5 = hashlib.md5(config_string).hexdigest()
+
+        host_rest_client = ContentMd5HostRestClient(load_file('config-with-two-pipeline-groups'))
+        configurator = GoCdConfigurator(host_rest_client)
+        pipeline = configurator.ensure_pipeline_group('new-group').ensure_pipeline('new-pipeline')
+        configurator.save_updated_config(refresh='adopt')
+        self.assertEqual(1, host_rest_client.config_requests)
+        self.assertEqual(host_rest_client.md5, configurator._initial_md5)
+        self.assertFalse(configurator.has_changes)
+
+        first_md5 = host_rest_client.md5
+        pipeline.set_git_url('git@bitbucket.org:org/repo.git')
+        configurator.save_updated_config(refresh='adopt')
+        self.assertEqual(first_md5, host_rest_client.posts[1][1]['md5'])
+        self.assertEqual(host_rest_client.md5, configurator._initial_md5)
+        self.assertEqual(1, host_rest_client.config_requests)
+
+    def test_adopting_after_save_keeps_config_when_server_only_reformatted_it(self):
+        class NormalizingHostRestClient(FakeHostRestClient):
+            def update_config(self, config_string):
+                FakeHostRestClient.update_config(self, prettify(config_string))
+
+        host_rest_client = NormalizingHostRestClient(load_file('config-with-two-pipeline-groups'))
+        configurator = GoCdConfigurator(host_rest_client)
+        group = configurator.ensure_pipeline_group('new-group')
+        group.ensure_pipeline('new-pipeline')
+        configurator.save_updated_config(refresh='adopt')
+        self.assertEqual(2, host_rest_client.config_requests)
+        self.assertIs(group.element, configurator.ensure_pipeline_group('new-group').element)
+        self.assertEqual('43', configurator._initial_md5)
+        self.assertFalse(configurator.has_changes)
+
+    def test_verifying_after_save_keeps_posted_config_when_server_returns_it_unchanged(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        pipeline = configurator.ensure_pipeline_group('new-group').ensure_pipeline('new-pipeline')
+        configurator.save_updated_config(refresh='verify')
+        self.assertEqual(2, host_rest_client.config_requests)
+        self.assertEqual('43', configurator._initial_md5)
+        pipeline.set_git_url('git@bitbucket.org:org/repo.git')
+        self.assertTrue(configurator.has_changes)
+
+    def test_verifying_after_save_reloads_config_when_server_changed_it(self):
+        class NormalizingHostRestClient(FakeHostRestClient):
+            def update_config(self, config_string):
+                FakeHostRestClient.update_config(self, config_string.replace(b'<pipeline name="new-pipeline"', b'<pipeline isLocked="false" name="new-pipeline"'))
+
+        host_rest_client = NormalizingHostRestClient(load_file('config-with-two-pipeline-groups'))
+        configurator = GoCdConfigurator(host_rest_client)
+        group = configurator.ensure_pipeline_group('new-group')
+        group.ensure_pipeline('new-pipeline')
+        configurator.save_updated_config(refresh='verify')
+        self.assertEqual(2, host_rest_client.config_requests)
+        self.assertIsNot(group.element, configurator.ensure_pipeline_group('new-group').element)
+        self.assertFalse(configurator.has_changes)
+        self.assertEqual(['new-pipeline'], [p.name for p in configurator.ensure_pipeline_group('new-group').pipelines])
+
+    def test_rejects_unknown_refresh_mode(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        self.assertRaises(RuntimeError, configurator.save_updated_config, refresh='sometimes')
+
+    def test_iterates_pipelines_matching_filters(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        self.assertEqual(['typical', 'smoke-tests'], [p.name for p in configurator.iter_pipelines()])
+        self.assertEqual(['smoke-tests'], [p.name for p in configurator.iter_pipelines(group='Second.Group')])
+        self.assertEqual(['smoke-tests'], [p.name for p in configurator.iter_pipelines(name='smoke-*')])
+        self.assertEqual(['typical', 'smoke-tests'], [p.name for p in configurator.iter_pipelines(material_url='git@bitbucket.org:springersbm/gomatic.git')])
+        self.assertEqual([], list(configurator.iter_pipelines(material_url='git@bitbucket.org:someone/else.git')))
+        self.assertEqual(['typical', 'smoke-tests'], [p.name for p in configurator.iter_pipelines(material_url='ssh://git@bitbucket.org/springersbm/gomatic/')])
+        self.assertEqual('Second.Group', next(configurator.iter_pipelines(name='smoke-tests')).parent.name)
+
+    def test_iterates_pipelines_based_on_template(self):
+        configurator = GoCdConfigurator(config('pipeline-based-on-template'))
+        self.assertEqual(['siberian'], [p.name for p in configurator.iter_pipelines(template='a-template')])
+
+    def test_iterates_jobs_and_tasks_needing_resource(self):
+        configurator = GoCdConfigurator(config('config-with-typical-pipeline'))
+        self.assertEqual(['compile', 'docker', 'upload'], [j.name for j in configurator.iter_jobs()])
+        jobs = list(configurator.iter_jobs(resource='a-resource'))
+        self.assertEqual(['compile'], [j.name for j in jobs])
+        self.assertEqual('build', jobs[0].parent_stage.name)
+        self.assertEqual(jobs[0].tasks, list(configurator.iter_tasks(resource='a-resource')))
+        self.assertEqual(3, len(list(configurator.iter_tasks(name='typical'))))
+
+    def test_iterates_jobs_of_the_template_a_pipeline_is_based_on(self):
+        configurator = GoCdConfigurator(config('pipeline-based-on-template'))
+        jobs = list(configurator.iter_jobs(name='siberian'))
+        self.assertEqual(['defaultJob'], [j.name for j in jobs])
+        self.assertEqual('a-template', jobs[0].parent_stage.parent_pipeline.name)
+        configurator.templates[0].stages[0].jobs[0].ensure_resource('a-resource')
+        self.assertEqual(['defaultJob'], [j.name for j in configurator.iter_jobs(resource='a-resource')])
+
+    def test_can_remove_agents_in_bulk(self):
+        configurator = GoCdConfigurator(config('config-with-just-agents'))
+        configurator.ensure_removal_of_agents(set(['go-agent-1', 'go-agent-2', 'not-an-agent']))
+        self.assertEqual([], configurator.agents)
+        self.assertEqual(None, configurator.find_agent('go-agent-1'))
+
+    def test_can_find_agent_by_hostname_or_uuid(self):
+        configurator = GoCdConfigurator(config('config-with-just-agents'))
+        self.assertEqual('5991eba9-a714-49b6-8fa7-fd8e09a05441', configurator.find_agent('go-agent-1').uuid)
+        self.assertEqual('go-agent-2', configurator.find_agent(uuid='1000eba9-a714-49b6-8fa7-fd8e09a00001').hostname)
+        self.assertEqual(None, configurator.find_agent('go-agent-3'))
+
+    def test_can_sync_agent_resources(self):
+        configurator = GoCdConfigurator(config('config-with-just-agents'))
+        changed = configurator.sync_agent_resources({'go-agent-1': ['b-resource', 'a-resource'], 'go-agent-2': ['linux', 'x&y'], 'gone': ['linux']})
+        self.assertEqual(['go-agent-2'], changed)
+        self.assertEqual(set(['linux', 'x&y']), configurator.find_agent('go-agent-2').resources)
+        self.assertEqual(['go-agent-1'], configurator.sync_agent_resources({'go-agent-1': []}))
+        self.assertEqual(set(), configurator.agents[0].resources)
+
     def test_can_get_initial_config_md5(self):
         configurator = GoCdConfigurator(empty_config())
         self.assertEqual("42", configurator._initial_md5)
@@ -1848,6 +2193,873 @@ class TestGoCdConfigurator(unittest.TestCase):
         job.ensure_environment_variables({'j': 'j'})
 
 
+class TestConfigMerge(unittest.TestCase):
+    def _someone_else_changes(self, host_rest_client, change):
+        other_configurator = GoCdConfigurator(FakeHostRestClient(host_rest_client.config_string))
+        change(other_configurator)
+        host_rest_client.update_config(other_configurator.config)
+
+    def test_conflicting_save_is_rejected_without_merge(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        self._someone_else_changes(host_rest_client, lambda c: c.ensure_pipeline_group('their-group'))
+        configurator.ensure_pipeline_group('our-group')
+        self.assertRaises(ConfigConflictError, configurator.save_updated_config)
+
+    def test_merges_changes_to_different_elements_and_reposts(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        self._someone_else_changes(host_rest_client, lambda c: c.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_stage('deploy').ensure_job('deploy'))
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').set_timer('0 0 2 * * ?')
+        configurator.ensure_pipeline_group('our-group')
+
+        configurator.save_updated_config(merge_on_conflict=True)
+
+        self.assertEqual(2, len(host_rest_client.posts))
+        saved = GoCdConfigurator(FakeHostRestClient(host_rest_client.config_string))
+        typical = saved.ensure_pipeline_group('P.Group').find_pipeline('typical')
+        self.assertEqual(['build', 'deploy'], [s.name for s in typical.stages])
+        self.assertEqual('0 0 2 * * ?', typical.timer)
+        self.assertEqual(['P.Group', 'Second.Group', 'our-group'], [g.name for g in saved.pipeline_groups])
+        self.assertFalse(configurator.has_changes)
+
+    def test_reports_elements_changed_on_both_sides(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        self._someone_else_changes(host_rest_client, lambda c: c.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0].set_timeout('10'))
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0].set_timeout('20')
+
+        try:
+            configurator.save_updated_config(merge_on_conflict=True)
+            self.fail("expected a merge conflict")
+        except MergeConflictError as e:
+            self.assertEqual(['/cruise/pipelines[@group="P.Group"]/pipeline[@name="typical"]/stage[@name="build"]/jobs/job[@name="compile"]/@timeout'], e.conflicts)
+
+    def test_saving_again_after_a_merge_conflict_does_not_overwrite_their_changes(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+
+        def their_change(c):
+            c.ensure_pipeline_group('other-team')
+            c.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0].set_timeout('10')
+        self._someone_else_changes(host_rest_client, their_change)
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0].set_timeout('20')
+        self.assertRaises(MergeConflictError, configurator.save_updated_config, merge_on_conflict=True)
+
+        self.assertRaises(ConfigConflictError, configurator.save_updated_config)
+
+        saved = GoCdConfigurator(FakeHostRestClient(host_rest_client.config_string))
+        self.assertTrue('other-team' in [g.name for g in saved.pipeline_groups])
+        self.assertEqual('10', saved.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0].timeout)
+
+    def test_unkeyed_children_changed_on_both_sides_conflict_as_a_whole(self):
+        base = ET.fromstring('<r><tasks><exec command="a"/></tasks></r>')
+        ours = ET.fromstring('<r><tasks><exec command="a"/><exec command="b"/></tasks></r>')
+        theirs = ET.fromstring('<r><tasks><exec command="c"/></tasks></r>')
+        merged, conflicts = three_way_merge(base, ours, theirs)
+        self.assertEqual(['/r/tasks'], conflicts)
+
+
+class TestServerCapabilities(unittest.TestCase):
+    def test_works_out_version_dependent_behaviour_from_version(self):
+        old = ServerCapabilities('17.7.0')
+        self.assertFalse(old.elastic_outside_server)
+        self.assertFalse(old.artifacts_have_type)
+        self.assertFalse(old.config_repo_has_id)
+        self.assertEqual('plugin', old.config_repo_plugin_attribute)
+
+        new = ServerCapabilities('18.3.0-6540')
+        self.assertTrue(new.elastic_outside_server)
+        self.assertTrue(new.artifacts_have_type)
+        self.assertTrue(new.config_repo_has_id)
+        self.assertEqual('pluginId', new.config_repo_plugin_attribute)
+
+    def test_compares_version_parts_numerically(self):
+        self.assertEqual('pluginId', ServerCapabilities('17.10.0').config_repo_plugin_attribute)
+        self.assertFalse(ServerCapabilities('18.2.0').artifacts_have_type)
+        self.assertTrue(ServerCapabilities('19.1.0').artifacts_have_type)
+
+    def test_configurator_parses_version_once(self):
+        configurator = GoCdConfigurator(config_18_3_0('config-with-two-pipeline-groups'))
+        self.assertIs(configurator.capabilities, configurator.capabilities)
+        job = configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').stages[0].jobs[0]
+        self.assertTrue(job.is_gocd_18_3_and_above())
+
+
+class TestSavepoints(unittest.TestCase):
+    def test_transaction_rolls_back_when_an_exception_is_raised(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+
+        def failing_change():
+            with configurator.transaction():
+                configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_stage('deploy')
+                configurator.ensure_pipeline_group('new-group')
+                configurator.ensure_removal_of_pipeline_group('Second.Group')
+                raise ValueError("validation failed")
+
+        self.assertRaises(ValueError, failing_change)
+        self.assertEqual(['P.Group', 'Second.Group'], [g.name for g in configurator.pipeline_groups])
+        self.assertEqual(['build'], [s.name for s in configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').stages])
+        self.assertFalse(configurator.has_changes)
+
+    def test_can_roll_back_explicitly_and_keep_changes_made_before_the_savepoint(self):
+        configurator = GoCdConfigurator(config('config-with-just-templates'))
+        configurator.site_url = 'http://before'
+        savepoint = configurator.savepoint()
+        configurator.site_url = 'http://after'
+        configurator.ensure_template('api-component').ensure_stage('extra')
+        configurator.ensure_removal_of_template('api-component')
+        configurator.ensure_removal_of_template('deploy-stack')
+
+        configurator.rollback_to(savepoint)
+
+        self.assertEqual('http://before', configurator.site_url)
+        self.assertEqual(['api-component', 'deploy-stack'], [t.name for t in configurator.templates])
+        self.assertEqual(['build'], [s.name for s in configurator.templates[0].stages])
+
+    def test_rolling_back_to_an_outer_savepoint_discards_inner_ones(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        outer = configurator.savepoint()
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').set_timer('0 0 1 * * ?')
+        inner = configurator.savepoint()
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').set_label_template('x-${COUNT}')
+
+        configurator.rollback_to(inner)
+        typical = configurator.ensure_pipeline_group('P.Group').find_pipeline('typical')
+        self.assertEqual('0 0 1 * * ?', typical.timer)
+        self.assertEqual('something-${COUNT}', typical.label_template)
+
+        configurator.rollback_to(outer)
+        self.assertFalse(configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').has_timer)
+        self.assertRaises(RuntimeError, configurator.rollback_to, inner)
+
+    def test_rolls_back_changes_made_through_wrappers_obtained_before_the_savepoint(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        typical = configurator.ensure_pipeline_group('P.Group').find_pipeline('typical')
+        build = typical.ensure_stage('build')
+
+        def failing_change():
+            with configurator.transaction():
+                typical.ensure_stage('deploy')
+                build.ensure_job('extra')
+                raise ValueError("validation failed")
+
+        self.assertRaises(ValueError, failing_change)
+        self.assertEqual(['build'], [s.name for s in typical.stages])
+        self.assertEqual(['compile'], [j.name for j in build.jobs])
+        self.assertFalse(configurator.has_changes)
+
+    def test_rolls_back_agents_found_before_the_savepoint(self):
+        configurator = GoCdConfigurator(config('config-with-just-agents'))
+        agent = configurator.find_agent('go-agent-1')
+        resources = agent.resources
+        savepoint = configurator.savepoint()
+        agent.set_resources(['changed'])
+        configurator.ensure_removal_of_agent('go-agent-2')
+
+        configurator.rollback_to(savepoint)
+
+        self.assertEqual(resources, configurator.find_agent('go-agent-1').resources)
+        self.assertEqual(['go-agent-1', 'go-agent-2'], [a.hostname for a in configurator.agents])
+        self.assertFalse(configurator.has_changes)
+
+    def test_only_remembers_what_is_held_or_touched_and_not_everything_ever_handed_out(self):
+        configurator = GoCdConfigurator(config('config-with-two-pipeline-groups'))
+        untouched = len(configurator.savepoint())
+        [p.name for p in configurator.pipelines]
+        configurator.pipelines_using_git('git@bitbucket.org:springersbm/gomatic.git')
+        [a.hostname for a in configurator.agents]
+        self.assertEqual(untouched, len(configurator.savepoint()))
+
+        typical = configurator.ensure_pipeline_group('P.Group').find_pipeline('typical')
+        build = typical.ensure_stage('build')
+        del typical
+        savepoint = configurator.savepoint()
+        self.assertEqual(untouched + 1, len(savepoint))
+        build.ensure_job('extra')
+        configurator.rollback_to(savepoint)
+        self.assertEqual(['compile'], [j.name for j in build.jobs])
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'config.snapshot')
+        GoCdConfigurator(config_18_3_0('config-with-two-pipeline-groups')).save_snapshot(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_builds_configurator_from_snapshot_without_fetching_config(self):
+        host_rest_client = FakeHostRestClient(empty_config_xml)
+        configurator = GoCdConfigurator.from_snapshot(self.path, host_rest_client)
+        self.assertEqual(['P.Group', 'Second.Group'], [g.name for g in configurator.pipeline_groups])
+        self.assertEqual('18.3.0', configurator.server_version)
+        self.assertEqual('42', configurator._initial_md5)
+        self.assertEqual(0, host_rest_client.config_requests)
+        self.assertFalse(configurator.has_changes)
+
+    def test_saves_through_the_given_rest_client(self):
+        host_rest_client = FakeHostRestClient(empty_config_xml)
+        configurator = GoCdConfigurator.from_snapshot(self.path, host_rest_client)
+        configurator.ensure_pipeline_group('new-group')
+        configurator.save_updated_config()
+        self.assertEqual(1, len(host_rest_client.posts))
+
+    def test_falls_back_to_fetching_config_when_snapshot_is_too_old(self):
+        configurator = GoCdConfigurator.from_snapshot(self.path, FakeHostRestClient(empty_config_xml), max_age=-1)
+        self.assertEqual(0, len(configurator.pipeline_groups))
+
+    def test_falls_back_to_fetching_config_when_snapshot_is_corrupt_or_from_another_format_version(self):
+        with open(self.path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        for corrupted in [data[:-10], data.replace(b'GOMATIC-SNAPSHOT\x00\x01', b'GOMATIC-SNAPSHOT\x00\x02'), b'']:
+            with open(self.path, 'wb') as snapshot_file:
+                snapshot_file.write(corrupted)
+            configurator = GoCdConfigurator.from_snapshot(self.path, FakeHostRestClient(empty_config_xml))
+            self.assertEqual(0, len(configurator.pipeline_groups))
+
+    def test_falls_back_to_fetching_config_when_server_config_changed_since_the_snapshot(self):
+        host_rest_client = FakeHostRestClient(empty_config_xml)
+        host_rest_client.update_config(empty_config_xml)
+        configurator = GoCdConfigurator.from_snapshot(self.path, host_rest_client)
+        self.assertEqual(0, len(configurator.pipeline_groups))
+        self.assertEqual(1, host_rest_client.config_requests)
+        self.assertEqual('43', configurator._initial_md5)
+
+    def test_falls_back_to_fetching_config_when_snapshot_is_for_another_server(self):
+        configurator = GoCdConfigurator.from_snapshot(self.path, FakeHostRestClient(empty_config_xml, 'another_server()'))
+        self.assertEqual(0, len(configurator.pipeline_groups))
+
+
+class TestServerVersionLookup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = VersionCache(os.path.join(self.directory, 'versions.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_does_not_ask_for_version_until_it_is_needed(self):
+        host_rest_client = config_18_3_0('config-with-two-pipelines')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.ensure_pipeline_group('new-group')
+        self.assertEqual(0, host_rest_client.version_requests)
+        self.assertEqual('18.3.0', configurator.server_version)
+        self.assertEqual('18.3.0', configurator.server_version)
+        self.assertEqual(1, host_rest_client.version_requests)
+
+    def test_uses_explicitly_given_version(self):
+        host_rest_client = config_18_3_0('config-with-two-pipelines')
+        configurator = GoCdConfigurator(host_rest_client, server_version='17.11.0')
+        self.assertFalse(configurator.capabilities.artifacts_have_type)
+        self.assertEqual(0, host_rest_client.version_requests)
+
+    def test_remembers_version_per_host_in_cache(self):
+        GoCdConfigurator(config_18_3_0('config-with-two-pipelines'), version_cache=self.cache).server_version
+        host_rest_client = config_18_3_0('config-with-two-pipelines')
+        configurator = GoCdConfigurator(host_rest_client, version_cache=self.cache)
+        self.assertEqual('18.3.0', configurator.server_version)
+        self.assertEqual(0, host_rest_client.version_requests)
+        self.assertEqual(None, self.cache.get('some-other-host'))
+
+    def test_asks_again_when_cached_version_is_too_old(self):
+        self.cache.put(repr(config_18_3_0('config-with-two-pipelines')), '16.1.0')
+        stale_cache = VersionCache(self.cache.path, ttl=-1)
+        host_rest_client = config_18_3_0('config-with-two-pipelines')
+        self.assertEqual('18.3.0', GoCdConfigurator(host_rest_client, version_cache=stale_cache).server_version)
+        self.assertEqual(1, host_rest_client.version_requests)
+
+
+class TestScanner(unittest.TestCase):
+    def test_yields_records_in_document_order(self):
+        records = list(scan(load_file('config-with-typical-pipeline').encode('utf-8')))
+        self.assertEqual([ScannedPipelineGroup, ScannedPipeline, ScannedStage, ScannedJob, ScannedStage, ScannedJob, ScannedStage, ScannedJob],
+                         [type(r) for r in records])
+        self.assertEqual(['build', 'package', 'deploy'], [r.name for r in records if isinstance(r, ScannedStage)])
+        self.assertEqual(set(['typical']), set(r.pipeline for r in records if isinstance(r, ScannedJob)))
+
+    def test_decodes_materials_tasks_and_artifacts_like_the_wrappers(self):
+        configurator = GoCdConfigurator(config('config-with-typical-pipeline'))
+        pipeline = configurator.pipelines[0]
+        records = list(scan(load_file('config-with-typical-pipeline').encode('utf-8')))
+        scanned_pipeline = next(r for r in records if isinstance(r, ScannedPipeline))
+        self.assertEqual(pipeline.materials, scanned_pipeline.materials)
+        scanned_jobs = [r for r in records if isinstance(r, ScannedJob)]
+        jobs = [job for stage in pipeline.stages for job in stage.jobs]
+        self.assertEqual([j.tasks for j in jobs], [r.tasks for r in scanned_jobs])
+        self.assertEqual([j.artifacts for j in jobs], [r.artifacts for r in scanned_jobs])
+        self.assertEqual([j.resources for j in jobs], [r.resources for r in scanned_jobs])
+
+    def test_yields_pipelines_based_on_templates_without_stages(self):
+        records = list(scan(load_file('pipeline-based-on-template').encode('utf-8')))
+        pipelines = [r for r in records if isinstance(r, ScannedPipeline)]
+        self.assertEqual(1, len(pipelines))
+        self.assertTrue(pipelines[0].template is not None)
+        self.assertEqual([], [r for r in records if isinstance(r, ScannedStage)])
+
+    def test_ignores_templates_and_reads_from_file(self):
+        records = list(scan('test-data/config-with-just-templates.xml'))
+        self.assertEqual([], records)
+
+
+class TestMaterialIndex(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(empty_config())
+        group = self.configurator.ensure_pipeline_group('g')
+        group.ensure_pipeline('one').set_git_url('git@github.com:org/repo.git')
+        group.ensure_pipeline('two').set_git_material(GitMaterial('https://github.com/org/repo', branch='release'))
+        group.ensure_pipeline('multi') \
+            .ensure_material(GitMaterial('ssh://git@github.com/org/repo/', material_name='a')) \
+            .ensure_material(GitMaterial('git@github.com:org/other.git', material_name='b')) \
+            .set_package_ref('pkg-id')
+
+    def test_normalizes_git_urls(self):
+        self.assertEqual('github.com/org/repo', normalize_git_url('git@github.com:org/repo.git'))
+        self.assertEqual('github.com/org/repo', normalize_git_url('https://user@GitHub.com/org/repo/'))
+        self.assertEqual('/srv/repo', normalize_git_url('/srv/repo.git'))
+
+    def test_finds_pipelines_by_repository_and_branch(self):
+        index = self.configurator.material_index
+        self.assertEqual(['one', 'multi', 'two'], index.pipelines_using_git('https://github.com/org/repo.git'))
+        self.assertEqual(['two'], index.pipelines_using_git('git@github.com:org/repo.git', branch='release'))
+        self.assertEqual({'master': ['one', 'multi'], 'release': ['two']}, index.branches_of('github.com:org/repo'))
+        self.assertEqual(['multi'], [p.name for p in self.configurator.pipelines_using_git('git@github.com:org/other.git')])
+
+    def test_finds_pipelines_added_and_not_those_removed_after_looking_up(self):
+        self.assertEqual(['one', 'multi'], [p.name for p in self.configurator.pipelines_using_git('git@github.com:org/repo.git', 'master')])
+        self.configurator.ensure_pipeline_group('h').ensure_pipeline('three').set_git_url('git@github.com:org/repo.git')
+        self.configurator.ensure_pipeline_group('g').ensure_removal_of_pipeline('one')
+
+        pipelines = self.configurator.pipelines_using_git('git@github.com:org/repo.git', 'master')
+        self.assertEqual([('multi', 'g'), ('three', 'h')], [(p.name, p.parent.name) for p in pipelines])
+
+    def test_finds_pipelines_by_package(self):
+        self.assertEqual(['multi'], [p.name for p in self.configurator.pipelines_using_package('pkg-id')])
+        self.assertEqual([], self.configurator.pipelines_using_package('other-id'))
+
+    def test_is_rebuilt_when_materials_change(self):
+        self.assertEqual(['git@github.com:org/repo.git', 'https://github.com/org/repo'], self.configurator.git_urls)
+        self.configurator.ensure_pipeline_group('g').find_pipeline('one').set_git_url('git@github.com:org/moved.git')
+        self.assertEqual(['git@github.com:org/moved.git', 'https://github.com/org/repo'], self.configurator.git_urls)
+        self.assertEqual(['two'], self.configurator.material_index.pipelines_using_git('git@github.com:org/repo.git', 'release'))
+
+
+class TestCommitImpact(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(empty_config())
+        group = self.configurator.ensure_pipeline_group('g')
+        app = group.ensure_pipeline('app').set_git_material(GitMaterial('git@github.com:org/mono.git', ignore_patterns={'docs/**/*'}))
+        app.ensure_stage('build').ensure_job('compile').set_run_instance_count('3')
+        app.ensure_stage('test').ensure_job('unit')
+        web = group.ensure_pipeline('web').set_git_material(GitMaterial('git@github.com:org/mono.git', ignore_patterns={'web/**/*'}, invert_filter=True))
+        web.ensure_stage('build').ensure_job('bundle')
+        deploy = group.ensure_pipeline('deploy').ensure_material(PipelineMaterial('app', 'test'))
+        deploy.ensure_stage('deploy').ensure_job('push')
+        release = group.ensure_pipeline('release').ensure_material(PipelineMaterial('deploy', 'deploy'))
+        release.ensure_stage('release').set_has_manual_approval().ensure_job('tag')
+
+    def test_matches_ant_globs(self):
+        self.assertTrue(ant_glob_matches('docs/**/*', 'docs/a/b.md'))
+        self.assertTrue(ant_glob_matches('docs/**/*', 'docs/b.md'))
+        self.assertTrue(ant_glob_matches('**/*.md', 'README.md'))
+        self.assertFalse(ant_glob_matches('docs/*.md', 'docs/a/b.md'))
+        self.assertTrue(ant_glob_matches('src/?.py', 'src/a.py'))
+
+    def test_follows_pipeline_materials_from_triggered_git_materials(self):
+        impact = self.configurator.commit_impact('https://github.com/org/mono', 'master', ['src/main.py'])
+        self.assertEqual(['app', 'deploy'], impact.triggered)
+        self.assertEqual({'app': 0, 'deploy': 1}, impact.depths)
+        self.assertEqual(5, impact.total_jobs)
+        self.assertEqual(1, impact.max_depth)
+        self.assertEqual(['release'], impact.awaiting_approval)
+
+    def test_respects_ignore_patterns_and_inverted_filters(self):
+        self.assertEqual([], self.configurator.commit_impact('git@github.com:org/mono.git', 'master', ['docs/a/b.md']).triggered)
+        impact = self.configurator.commit_impact('git@github.com:org/mono.git', 'master', ['web/index.html'])
+        self.assertEqual(['app', 'web', 'deploy'], impact.triggered)
+        self.assertEqual([], self.configurator.commit_impact('git@github.com:org/mono.git', 'other-branch', ['web/index.html']).triggered)
+
+    def test_runs_stages_up_to_a_manual_approval_and_triggers_through_the_stages_run(self):
+        configurator = GoCdConfigurator(config('config-with-just-agents'))
+        group = configurator.ensure_pipeline_group('g')
+        a = group.ensure_pipeline('a').set_git_material(GitMaterial('git@github.com:org/a.git'))
+        a.ensure_stage('build').ensure_job('compile')
+        a.ensure_stage('deploy').set_has_manual_approval().ensure_job('push')
+        group.ensure_pipeline('b').ensure_material(PipelineMaterial('a', 'deploy')).ensure_stage('s').ensure_job('j')
+        group.ensure_pipeline('c').ensure_material(PipelineMaterial('a', 'build')).ensure_stage('s').ensure_job('everywhere').set_runs_on_all_agents()
+        group.ensure_pipeline('c').ensure_stage('s').ensure_job('some').set_runs_on_all_agents().ensure_resource('a-resource')
+
+        impact = configurator.commit_impact('git@github.com:org/a.git', 'master', ['src/main.py'])
+
+        self.assertEqual({'a': 0, 'c': 1}, impact.depths)
+        self.assertEqual({'a': 1, 'c': 3}, impact.jobs)
+
+
+class TestGitPolling(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(empty_config())
+        group = self.configurator.ensure_pipeline_group('g')
+        group.ensure_pipeline('a').set_git_url('git@github.com:org/busy.git')
+        group.ensure_pipeline('b').set_git_url('https://github.com/org/busy')
+        group.ensure_pipeline('c').set_git_material(GitMaterial('git@github.com:org/busy.git', branch='release'))
+        group.ensure_pipeline('d').set_git_material(GitMaterial('git@github.com:org/quiet.git', polling=False))
+        group.ensure_pipeline('e').set_git_material(GitMaterial('git@github.com:org/quiet.git'))
+
+    def test_groups_git_materials_by_fingerprint(self):
+        report = self.configurator.git_polling_report()
+        self.assertEqual(['github.com/org/busy', 'github.com/org/quiet'], report.repositories)
+        self.assertEqual({'github.com/org/busy': 3, 'github.com/org/quiet': 2}, report.polling_materials_by_repository())
+        self.assertEqual({'github.com/org/busy': 2.0, 'github.com/org/quiet': 1.0}, report.estimated_polls_by_repository())
+        self.assertEqual(30.0, report.estimated_polls(period=600))
+        self.assertEqual(['d', 'e'], report.pipelines[report.inconsistent_fingerprints[0]])
+
+    def test_disables_polling_of_repositories(self):
+        savepoint = self.configurator.savepoint()
+        self.assertEqual(['a', 'b', 'c', 'e'], self.configurator.disable_git_polling(['github.com/org/busy', 'git@github.com:org/quiet.git']))
+        self.assertEqual([], self.configurator.git_polling_report().polling_fingerprints)
+        self.assertFalse(self.configurator.ensure_pipeline_group('g').find_pipeline('b').git_material.polling)
+        self.configurator.rollback_to(savepoint)
+        self.assertTrue(self.configurator.ensure_pipeline_group('g').find_pipeline('b').git_material.polling)
+
+    def test_enables_shallow_clones_matching_url_and_group(self):
+        self.configurator.ensure_pipeline_group('other').ensure_pipeline('f').set_git_url('git@github.com:org/busy.git')
+        self.assertEqual([('f', 'git@github.com:org/busy.git')], self.configurator.ensure_shallow_clones(url='*/busy', group='other', dry_run=True))
+        self.assertFalse(self.configurator.ensure_pipeline_group('other').find_pipeline('f').git_material.shallow)
+
+        changed = self.configurator.ensure_shallow_clones(url='github.com/org/busy')
+        self.assertEqual(['a', 'b', 'c', 'f'], [name for name, _ in changed])
+        material = self.configurator.ensure_pipeline_group('g').find_pipeline('c').git_material
+        self.assertEqual(GitMaterial('git@github.com:org/busy.git', branch='release', shallow=True), material)
+        self.assertEqual([], self.configurator.ensure_shallow_clones(url='github.com/org/busy'))
+
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(empty_config())
+        group = self.configurator.ensure_pipeline_group('g')
+        for i in range(20):
+            group.ensure_pipeline('nightly-%s' % i).set_timer('0 0 2 * * ?', only_on_changes=(i % 2 == 0))
+        group.ensure_pipeline('hourly').set_timer('0 0/30 * ? * MON-FRI')
+        group.ensure_pipeline('odd').set_timer('0 0 2 L * ?')
+        group.ensure_pipeline('weird').set_timer('0 0 2W * * ?')
+
+    def test_parses_start_times_of_cron_specs(self):
+        self.assertEqual([2 * 3600], start_times('0 0 2 * * ?'))
+        self.assertEqual([0, 15, 30, 45], start_times('0/15 0 0 * * ?'))
+        self.assertEqual([3600, 5400, 7200, 9000, 10800, 12600], start_times('0 0,30 1-3 * * ?'))
+        self.assertEqual(None, start_times('0 0 2W * * ?'))
+        self.assertEqual(None, start_times('0 0 2'))
+
+    def test_builds_histogram_of_starts_per_minute(self):
+        histogram = self.configurator.timer_histogram()
+        self.assertEqual([(120, 22), (0, 1)], histogram.busiest(2))
+        self.assertEqual(20 + 48 + 1, sum(histogram.starts_per_minute.values()))
+        self.assertEqual(['weird'], histogram.unparsed)
+
+    def test_spreads_timers_deterministically_keeping_only_on_changes(self):
+        changed = self.configurator.spread_timers(15 * 60, name='nightly-*', timer='0 0 2 * * ?')
+        self.assertEqual(20, len(changed))
+        self.assertTrue(all(spec.endswith(' * * ?') for spec in changed.values()))
+        self.assertTrue(max(count for _, count in self.configurator.timer_histogram().busiest()) < 20)
+        pipeline = self.configurator.ensure_pipeline_group('g').find_pipeline('nightly-0')
+        self.assertTrue(pipeline.timer_triggers_only_on_changes)
+        self.assertTrue(2 * 3600 <= start_times(pipeline.timer)[0] < 2 * 3600 + 15 * 60)
+
+        again = GoCdConfigurator(empty_config())
+        again.ensure_pipeline_group('g').ensure_pipeline('nightly-0').set_timer('0 0 2 * * ?')
+        self.assertEqual(changed['nightly-0'], again.spread_timers(15 * 60, base='0 0 2')['nightly-0'])
+
+    def test_spreading_timers_again_does_not_move_them(self):
+        changed = self.configurator.spread_timers(15 * 60, base='0 0 2')
+        timers = dict((p.name, p.timer) for p in self.configurator.pipelines if p.has_timer)
+
+        self.assertEqual({}, self.configurator.spread_timers(15 * 60, base='0 0 2'))
+        self.assertEqual({}, self.configurator.spread_timers(15 * 60, timer='0 0 2 * * ?'))
+        self.assertEqual(timers, dict((p.name, p.timer) for p in self.configurator.pipelines if p.has_timer))
+        self.assertEqual(sorted(['nightly-%s' % i for i in range(20)] + ['odd']), sorted(changed))
+        self.assertEqual('0 0/30 * ? * MON-FRI', timers['hourly'])
+
+    def test_spreading_timers_needs_a_base_or_a_timer(self):
+        self.assertRaises(RuntimeError, self.configurator.spread_timers, 15 * 60)
+
+
+class TestResourceIndex(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(config('config-with-just-agents'))
+        pipeline = self.configurator.ensure_pipeline_group('g').ensure_pipeline('p')
+        pipeline.ensure_stage('s').ensure_job('fine').ensure_resource('a-resource').ensure_resource('b-resource')
+        pipeline.ensure_stage('s').ensure_job('anywhere')
+        pipeline.ensure_stage('s').ensure_job('stuck').ensure_resource('a-resource').ensure_resource('c-resource')
+        pipeline.ensure_stage('s').ensure_job('elastic').ensure_resource('c-resource').set_elastic_profile_id('docker')
+
+    def test_finds_agents_and_jobs_by_resource(self):
+        index = self.configurator.resource_index()
+        self.assertEqual(['a-resource', 'b-resource', 'c-resource'], index.resources)
+        self.assertEqual(['go-agent-1'], index.agents_with('a-resource'))
+        self.assertEqual([JobReference('p', 's', 'elastic'), JobReference('p', 's', 'stuck')], index.jobs_needing('c-resource'))
+        self.assertEqual(['go-agent-1', 'go-agent-2'], index.agents_for([]))
+        self.assertEqual(['go-agent-1'], index.agents_for(['b-resource', 'a-resource']))
+        self.assertEqual([], index.agents_for(['a-resource', 'unknown']))
+
+    def test_disabled_agents_run_no_jobs(self):
+        self.configurator.find_agent('go-agent-1').element.set('isDisabled', 'true')
+        index = self.configurator.resource_index()
+        self.assertEqual(['go-agent-1'], index.disabled_agents)
+        self.assertEqual(['go-agent-2'], index.agents_for([]))
+        self.assertEqual([], index.agents_with('a-resource'))
+        self.assertEqual([JobReference('p', 's', 'fine'), JobReference('p', 's', 'stuck')], index.unsatisfiable_jobs)
+
+    def test_reports_unsatisfiable_jobs_and_supply_and_demand(self):
+        index = self.configurator.resource_index()
+        self.assertEqual([JobReference('p', 's', 'stuck')], index.unsatisfiable_jobs)
+        self.assertEqual({'a-resource': (1, 2), 'b-resource': (1, 1), 'c-resource': (0, 2)}, index.supply_and_demand())
+
+
+class TestCapacitySimulator(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(config('config-with-just-agents'))
+        group = self.configurator.ensure_pipeline_group('g')
+        build = group.ensure_pipeline('build')
+        build.ensure_stage('compile').ensure_job('compile').ensure_resource('a-resource')
+        build.ensure_stage('test').ensure_job('test').set_run_instance_count('2')
+        deploy = group.ensure_pipeline('deploy').ensure_material(PipelineMaterial('build', 'test'))
+        deploy.ensure_stage('deploy').ensure_job('deploy').set_elastic_profile_id('docker')
+        deploy.ensure_stage('approve').set_has_manual_approval().ensure_job('never')
+        group.ensure_pipeline('stuck').ensure_stage('s').ensure_job('j').ensure_resource('missing')
+
+    def test_simulates_stages_dependencies_and_agents(self):
+        durations = {JobReference('build', 'compile', 'compile'): 100}
+        report = self.configurator.capacity_simulator(default_duration=10, durations=durations).run([(0, 'build'), (5, 'build')])
+        self.assertEqual(2 * 100 + 10 + 10, report.makespan)
+        self.assertEqual(95, report.max_wait)
+        self.assertEqual(2, report.elastic_jobs)
+        self.assertEqual(4, report.pipeline_runs)
+        self.assertEqual({'go-agent-1': 210.0 / 220, 'go-agent-2': 30.0 / 220}, report.utilization)
+        self.assertEqual([], report.stuck)
+
+    def test_sweeps_fleet_sizes_and_reports_stuck_jobs(self):
+        simulator = self.configurator.capacity_simulator(default_duration=10)
+        triggers = [(0, 'build')] * 4 + [(0, 'stuck')]
+        makespans = [simulator.run(triggers, agents=[['a-resource']] * size).makespan for size in (1, 2, 4)]
+        self.assertEqual([130, 70, 40], makespans)
+        self.assertEqual([JobReference('stuck', 's', 'j')], simulator.run(triggers, agents=[['a-resource']]).stuck)
+
+    def test_leaves_out_disabled_agents(self):
+        self.configurator.find_agent('go-agent-1').element.set('isDisabled', 'true')
+        report = self.configurator.capacity_simulator(default_duration=10).run([(0, 'build')])
+        self.assertEqual(['go-agent-2'], list(report.utilization))
+        self.assertEqual([JobReference('build', 'compile', 'compile')], report.stuck)
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def setUp(self):
+        self.configurator = GoCdConfigurator(empty_config())
+        group = self.configurator.ensure_pipeline_group('g')
+        self.build = group.ensure_pipeline('build')
+        self.test = group.ensure_pipeline('test').ensure_material(PipelineMaterial('build', 'compile'))
+        self.lint = group.ensure_pipeline('lint').ensure_material(PipelineMaterial('build', 'compile'))
+        self.deploy = group.ensure_pipeline('deploy').ensure_material(PipelineMaterial('test', 'run')).ensure_material(PipelineMaterial('lint', 'run'))
+
+    def test_finds_upstream_and_downstream_closures(self):
+        graph = self.configurator.dependency_graph
+        self.assertEqual(['build', 'test', 'lint'], graph.upstream_of('deploy'))
+        self.assertEqual(['test', 'lint'], graph.upstream_of('deploy', transitive=False))
+        self.assertEqual(['test', 'lint', 'deploy'], graph.downstream_of('build'))
+        self.assertEqual([], graph.downstream_of('no-such-pipeline'))
+
+    def test_orders_pipelines_topologically_and_finds_longest_chain(self):
+        graph = self.configurator.dependency_graph
+        self.assertEqual(['build', 'test', 'lint', 'deploy'], graph.topological_order())
+        self.assertEqual(['build', 'test', 'deploy'], graph.longest_chain())
+        self.assertEqual(2, graph.depth_of('deploy'))
+        self.assertEqual([], graph.cycles())
+
+    def test_is_updated_when_pipeline_materials_change(self):
+        graph = self.configurator.dependency_graph
+        self.build.ensure_material(PipelineMaterial('deploy', 'release'))
+        self.assertIs(graph, self.configurator.dependency_graph)
+        self.assertEqual([['build', 'test', 'lint', 'deploy']], graph.cycles())
+        self.assertRaises(RuntimeError, graph.topological_order)
+        self.build.remove_materials()
+        self.assertEqual([], graph.cycles())
+        self.configurator.ensure_pipeline_group('g').ensure_removal_of_pipeline('test')
+        self.assertEqual(['lint', 'deploy'], self.configurator.dependency_graph.downstream_of('build'))
+
+    def test_has_every_pipeline_as_pipelines_are_added_and_removed(self):
+        graph = self.configurator.dependency_graph
+        self.configurator.ensure_pipeline_group('g').ensure_pipeline('docs').set_git_url('git@bitbucket.org:org/docs.git')
+        self.assertIs(graph, self.configurator.dependency_graph)
+        self.assertEqual(['build', 'docs', 'test', 'lint', 'deploy'], graph.topological_order())
+
+        self.configurator.ensure_pipeline_group('g').ensure_removal_of_pipeline('docs')
+        self.configurator.ensure_pipeline_group('g').ensure_removal_of_pipeline('deploy')
+        self.assertEqual(['build', 'test', 'lint'], self.configurator.dependency_graph.topological_order())
+        self.assertEqual(['build', 'test'], self.configurator.dependency_graph.longest_chain())
+
+    def test_is_rebuilt_after_rollback(self):
+        graph = self.configurator.dependency_graph
+        savepoint = self.configurator.savepoint()
+        self.configurator.ensure_pipeline_group('g').find_pipeline('build').ensure_material(PipelineMaterial('deploy', 'release'))
+        self.configurator.rollback_to(savepoint)
+        self.assertIsNot(graph, self.configurator.dependency_graph)
+        self.assertEqual([], self.configurator.dependency_graph.cycles())
+
+
+class TestAgentsApi(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.host_rest_client = empty_config()
+        self.host_rest_client.api_agents = [
+            {'uuid': 'uuid-%s' % i, 'hostname': 'agent-%s' % i, 'resources': ['linux'], 'environments': [], 'agent_config_state': 'Enabled'}
+            for i in range(5)]
+        self.api = AgentsApi(self.host_rest_client, ttl=60, clock=lambda: self.now)
+
+    def agent_list_requests(self):
+        return len([c for c in self.host_rest_client.api_calls if c[0] == 'get' and c[1] == '/go/api/agents'])
+
+    def test_caches_agents_for_ttl(self):
+        self.assertEqual(5, len(self.api.agents()))
+        self.now += 30
+        self.api.agents()
+        self.assertEqual(1, self.agent_list_requests())
+        self.now += 31
+        self.api.agents()
+        self.assertEqual(2, self.agent_list_requests())
+
+    def test_fetches_single_agents_concurrently(self):
+        agents = self.api.agents_by_uuid(['uuid-1', 'uuid-3'])
+        self.assertEqual({'uuid-1': 'agent-1', 'uuid-3': 'agent-3'}, dict((u, a['hostname']) for u, a in agents.items()))
+        self.assertRaises(RuntimeError, self.api.agents_by_uuid, ['no-such-uuid'])
+
+    def test_updates_agents_in_bulk(self):
+        self.api.agents()
+        self.api.update_agents(['uuid-0', 'uuid-1'], add_resources=['docker'], remove_resources=['linux'], enabled=False)
+        agents = dict((a['uuid'], a) for a in self.api.agents())
+        self.assertEqual(['docker'], agents['uuid-0']['resources'])
+        self.assertEqual('Disabled', agents['uuid-1']['agent_config_state'])
+        self.assertEqual(['linux'], agents['uuid-2']['resources'])
+        self.assertEqual(2, self.agent_list_requests())
+
+    def test_updates_each_agent(self):
+        self.api.update_each(dict(('uuid-%s' % i, {'environments': ['env-%s' % i]}) for i in range(5)))
+        self.assertEqual(['env-4'], self.api.agents_by_uuid(['uuid-4'])['uuid-4']['environments'])
+        self.assertEqual(5, len([c for c in self.host_rest_client.api_calls if c[0] == 'patch']))
+
+    def test_rate_limiter_spaces_requests(self):
+        sleeps = []
+        limiter = RateLimiter(4, clock=lambda: 10.0, sleep=sleeps.append)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual([0.25, 0.5], sleeps)
+
+
+class TestPipelineConfigApiSave(unittest.TestCase):
+    def test_only_changed_pipeline_is_sent_with_its_etag(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        configurator.save_updated_config(use_pipeline_api=True)
+
+        self.assertEqual([], [p for p in host_rest_client.posts if p[0] == '/go/api/admin/config.xml'])
+        self.assertEqual([('get', '/go/api/admin/pipelines/typical'), ('put', '/go/api/admin/pipelines/typical')],
+                         [(c[0], c[1]) for c in host_rest_client.api_calls])
+        method, path, body, headers = host_rest_client.api_calls[1]
+        self.assertEqual('"etag-of-typical"', headers['If-Match'])
+        sent = json.loads(body)
+        self.assertEqual('P.Group', sent['group'])
+        self.assertEqual([{'name': 'A', 'value': 'b', 'secure': False}], sent['environment_variables'])
+
+    def test_new_pipelines_are_created_and_removed_pipelines_deleted(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.ensure_pipeline_group('P.Group').ensure_pipeline('new-one').set_git_url('git://x').ensure_stage('s').ensure_job('j')
+        configurator.ensure_pipeline_group('Second.Group').ensure_removal_of_pipeline('smoke-tests')
+
+        configurator.save_updated_config(use_pipeline_api=True)
+
+        calls = sorted((c[0], c[1]) for c in host_rest_client.api_calls)
+        self.assertEqual([('delete', '/go/api/admin/pipelines/smoke-tests'), ('post', '/go/api/admin/pipelines')], calls)
+        created = json.loads([c for c in host_rest_client.api_calls if c[0] == 'post'][0][2])
+        self.assertEqual('P.Group', created['group'])
+        self.assertEqual('new-one', created['pipeline']['name'])
+
+    def test_refresh_after_saving_keeps_the_config_when_the_server_stored_the_same(self):
+        class StoringHostRestClient(FakeHostRestClient):
+            def put(self, path, data, headers=None):
+                self.update_config(prettify(self.configurator.config))
+                return FakeHostRestClient.put(self, path, data, headers)
+
+        host_rest_client = StoringHostRestClient(load_file('config-with-two-pipeline-groups'))
+        configurator = GoCdConfigurator(host_rest_client)
+        host_rest_client.configurator = configurator
+        group = configurator.ensure_pipeline_group('P.Group')
+        group.find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        configurator.save_updated_config(use_pipeline_api=True, refresh='adopt')
+
+        self.assertEqual(2, host_rest_client.config_requests)
+        self.assertIs(group.element, configurator.ensure_pipeline_group('P.Group').element)
+        self.assertEqual('43', configurator._initial_md5)
+        self.assertFalse(configurator.has_changes)
+
+    def test_refresh_after_saving_uses_the_servers_config_when_it_differs(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        group = configurator.ensure_pipeline_group('P.Group')
+        group.find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        configurator.save_updated_config(use_pipeline_api=True, refresh='verify')
+
+        self.assertEqual(2, host_rest_client.config_requests)
+        self.assertIsNot(group.element, configurator.ensure_pipeline_group('P.Group').element)
+        self.assertFalse(configurator.has_changes)
+
+    def test_falls_back_to_posting_whole_config_when_something_other_than_pipelines_changed(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').set_timer('0 0 1 * * ?')
+        configurator.site_url = 'http://somewhere'
+
+        configurator.save_updated_config(use_pipeline_api=True)
+
+        self.assertEqual([], host_rest_client.api_calls)
+        self.assertEqual(['/go/api/admin/config.xml'], [p[0] for p in host_rest_client.posts])
+
+    def test_pipeline_changed_on_the_server_since_the_config_was_fetched_is_not_overwritten(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        TestConfigMerge()._someone_else_changes(host_rest_client, lambda c: c.ensure_pipeline_group('P.Group').find_pipeline('typical').set_timer('0 0 1 * * ?'))
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        self.assertRaises(ConfigConflictError, configurator.save_updated_config, use_pipeline_api=True)
+
+        self.assertEqual([], [c for c in host_rest_client.api_calls if c[0] == 'put'])
+
+    def test_pipeline_is_sent_when_only_other_pipelines_changed_on_the_server(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        TestConfigMerge()._someone_else_changes(host_rest_client, lambda c: c.ensure_pipeline_group('Second.Group').find_pipeline('smoke-tests').set_timer('0 0 1 * * ?'))
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        configurator.save_updated_config(use_pipeline_api=True)
+
+        self.assertEqual(['/go/api/admin/pipelines/typical'], [c[1] for c in host_rest_client.api_calls if c[0] == 'put'])
+
+    def test_falls_back_to_posting_whole_config_for_pipelines_the_api_json_cannot_describe(self):
+        for change in [lambda p: p.ensure_material(GitMaterial('git://x')).element.find('materials/git[@url="git://x"]').set('username', 'u'),
+                       lambda p: p.stages[0].element.set('artifactCleanupProhibited', 'true'),
+                       lambda p: ET.SubElement(p.element.find('materials'), 'svn', {'url': 'svn://x'}),
+                       lambda p: ET.SubElement(p.element, 'trackingtool', {'link': 'http://x/${ID}', 'regex': '#(\\d+)'})]:
+            host_rest_client = config('config-with-two-pipeline-groups')
+            configurator = GoCdConfigurator(host_rest_client)
+            change(configurator.ensure_pipeline_group('P.Group').find_pipeline('typical'))
+
+            configurator.save_updated_config(use_pipeline_api=True)
+
+            self.assertEqual([], host_rest_client.api_calls)
+            self.assertEqual(['/go/api/admin/config.xml'], [p[0] for p in host_rest_client.posts])
+
+    def test_lists_what_the_api_json_leaves_out(self):
+        pipeline = ET.fromstring('<pipeline name="p"><trackingtool link="l" regex="r"/><materials><git url="u" username="me"/></materials>'
+                                 '<stage name="s" artifactCleanupProhibited="true"><jobs><job name="j"/></jobs></stage></pipeline>')
+        self.assertEqual(['pipeline/trackingtool', 'pipeline/materials/git/@username', 'pipeline/stage/@artifactCleanupProhibited'],
+                         unrepresentable_parts(pipeline))
+        self.assertEqual([], unrepresentable_parts(typical_pipeline().element))
+
+    def test_refetches_the_config_when_saving_through_the_api_fails(self):
+        host_rest_client = config('config-with-two-pipeline-groups')
+        configurator = GoCdConfigurator(host_rest_client)
+        configurator.ensure_pipeline_group('P.Group').find_pipeline('typical').ensure_environment_variables({'A': 'b'})
+
+        def failing_put(path, data, headers=None):
+            raise RuntimeError("Could not put %s [status code=500]" % path)
+        host_rest_client.put = failing_put
+        config_requests = host_rest_client.config_requests
+
+        self.assertRaises(RuntimeError, configurator.save_updated_config, use_pipeline_api=True)
+
+        self.assertTrue(host_rest_client.config_requests > config_requests)
+        self.assertTrue(configurator.has_changes)
+
+    def test_pipeline_json_describes_materials_stages_jobs_and_tasks(self):
+        pipeline = typical_pipeline()
+        sent = pipeline_as_json(pipeline)
+        self.assertEqual('typical', sent['name'])
+        self.assertEqual('git', sent['materials'][0]['type'])
+        self.assertEqual(['build', 'package', 'deploy'], [s['name'] for s in sent['stages']])
+        job = sent['stages'][0]['jobs'][0]
+        self.assertEqual('compile', job['name'])
+        self.assertEqual('exec', job['tasks'][0]['type'])
+        self.assertEqual(['passed'], job['tasks'][0]['attributes']['run_if'])
+
+
+class TestPropertyBag(unittest.TestCase):
+    def test_reads_properties_as_a_dict(self):
+        element = ET.fromstring('<profile><property><key>a</key><value>1</value></property><property><key>b</key><value /></property></profile>')
+        bag = PropertyBag(element)
+
+        self.assertEqual(bag, {'a': '1', 'b': None})
+        self.assertEqual(list(bag), ['a', 'b'])
+        self.assertTrue('a' in bag)
+        self.assertFalse('c' in bag)
+
+    def test_adds_the_container_only_when_a_property_is_set(self):
+        element = ET.fromstring('<config-repo />')
+        bag = PropertyBag(element, 'configuration')
+        self.assertEqual(len(bag), 0)
+        self.assertEqual(element.find('configuration'), None)
+
+        bag['url'] = 'http://example.com/?a=1&b=<2>'
+
+        self.assertEqual(PropertyBag(element, 'configuration')['url'], 'http://example.com/?a=1&b=<2>')
+        self.assertTrue('&amp;b=&lt;2&gt;' in ET.tostring(element).decode('utf-8'))
+
+    def test_update_only_touches_changed_keys(self):
+        element = ET.fromstring('<profile><property><key>a</key><value>1</value></property><property><key>b</key><value>2</value></property></profile>')
+        unchanged = element.find('property')
+        bag = PropertyBag(element)
+
+        self.assertEqual(bag.update({'a': '1', 'b': '3', 'c': 4}), ['b', 'c'])
+        self.assertEqual(bag.update({'a': '1', 'b': '3', 'c': 4}), [])
+
+        self.assertEqual(dict(PropertyBag(element)), {'a': '1', 'b': '3', 'c': '4'})
+        self.assertTrue(element.find('property') is unchanged)
+
+    def test_replace_removes_other_properties(self):
+        element = ET.fromstring('<profile><property><key>a</key><value>1</value></property><property><key>b</key><value>2</value></property></profile>')
+
+        self.assertEqual(PropertyBag(element).replace({'b': '2', 'c': '3'}), ['a', 'c'])
+        self.assertEqual(dict(PropertyBag(element)), {'b': '2', 'c': '3'})
+
+    def test_can_remove_property(self):
+        element = ET.fromstring('<profile><property><key>a</key><value>1</value></property></profile>')
+        del PropertyBag(element)['a']
+
+        self.assertEqual(len(element.findall('property')), 0)
+
+    def test_setting_a_value_replaces_an_encrypted_value(self):
+        element = ET.fromstring('<authConfig><property><key>password</key><encryptedValue>xyz</encryptedValue></property></authConfig>')
+        PropertyBag(element)['password'] = 'secret'
+
+        self.assertEqual(element.find('property/encryptedValue'), None)
+        self.assertEqual(PropertyBag(element)['password'], 'secret')
+
+    def test_plugin_elements_share_property_bags(self):
+        configurator = GoCdConfigurator(empty_config())
+        configurator.ensure_elastic().ensure_profiles().ensure_profile('docker', 'cd.go.docker', {'Image': 'alpine'})
+        configurator.elastic.profiles[0].configuration.update({'Image': 'ubuntu'})
+        self.assertEqual(configurator.elastic.profiles[0].properties, {'Image': 'ubuntu'})
+        self.assertEqual(type(configurator.elastic.profiles[0].properties), dict)
+
+        repository = configurator.ensure_repository('repo')
+        repository.ensure_property('REPO_URL', 'http://a')
+        repository.ensure_property('REPO_URL', 'http://b')
+        self.assertEqual(repository.repo_url, 'http://b')
+        self.assertEqual(len(repository.properties), 1)
+
+
 class TestRepository(unittest.TestCase):
     def test_can_read_yum_repo_from_xml(self):
         configurator = GoCdConfigurator(config('config-with-pipeline-and-yum-repo'))
@@ -1917,6 +3129,57 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(prop.key, 'PACKAGE_SPEC')
         self.assertEqual(prop.value, 'component-name.*')
 
+    def test_can_find_repositories_and_packages_by_name_and_id(self):
+        configurator = GoCdConfigurator(config('config-with-pipeline-and-yum-repo'))
+        repository = configurator.find_repository(name='ts-yum-repo')
+
+        self.assertEqual(repository, configurator.find_repository(repository_id='ee6a8a7b-96d0-452e-aa99-26e4af46d646'))
+        self.assertEqual(configurator.find_repository(name='missing'), None)
+        self.assertEqual(repository.find_package(name='yum-component-name').id, 'eca7f187-73c2-4f62-971a-d15233937256')
+        self.assertEqual(repository.find_package(id='eca7f187-73c2-4f62-971a-d15233937256').name, 'yum-component-name')
+
+    def test_ensuring_a_repository_twice_adds_it_once(self):
+        configurator = GoCdConfigurator(empty_config())
+        first = configurator.ensure_repository('repo')
+
+        self.assertEqual(configurator.ensure_repository('repo'), first)
+        self.assertEqual(len(configurator.repositories), 1)
+        self.assertEqual(configurator.find_repository(repository_id=first.id), first)
+
+    def test_can_ensure_and_remove_packages_in_bulk(self):
+        repository = GoCdConfigurator(empty_config()).ensure_repository('repo')
+        repository.ensure_package('same').ensure_property('PACKAGE_SPEC', 'same.*')
+        repository.ensure_package('changed').ensure_property('PACKAGE_SPEC', 'old.*')
+
+        self.assertEqual(repository.ensure_packages({'same': {'PACKAGE_SPEC': 'same.*'},
+                                                     'changed': {'PACKAGE_SPEC': 'new.*'},
+                                                     'new': {'PACKAGE_SPEC': 'new.*'}}), ['changed', 'new'])
+        self.assertEqual(repository.find_package(name='changed').package_spec, 'new.*')
+        self.assertEqual(repository.ensure_removal_of_packages(['same', 'missing']), ['same'])
+        self.assertEqual(sorted(p.name for p in repository.packages), ['changed', 'new'])
+        self.assertEqual(repository.find_package(name='same'), None)
+
+    def test_package_index_is_shared_by_every_wrapper_of_a_repository(self):
+        configurator = GoCdConfigurator(empty_config())
+        first = configurator.ensure_repository('repo')
+        first.ensure_package('p')
+        index = configurator._cache('packages_of_%s' % id(first.element))
+
+        self.assertEqual(configurator.find_repository('repo').ensure_removal_of_packages(['p']), ['p'])
+        package = first.ensure_package('p')
+
+        self.assertTrue(configurator._cache('packages_of_%s' % id(first.element)) is index)
+        self.assertEqual([p.element for p in configurator.find_repository('repo').packages], [package.element])
+
+    def test_knows_which_pipelines_use_each_package(self):
+        configurator = GoCdConfigurator(empty_config())
+        repository = configurator.ensure_repository('repo')
+        used = repository.ensure_package('used')
+        unused = repository.ensure_package('unused')
+        configurator.ensure_pipeline_group('g').ensure_pipeline('p').set_package_ref(used.id)
+
+        self.assertEqual(configurator.package_usage(), {used.id: ['p'], unused.id: []})
+
 
 def simplified(s):
     return s.strip().replace("\t", "").replace("\n", "").replace("\\", "").replace(" ", "")
@@ -2307,3 +3570,70 @@ class TestArtifactStores(unittest.TestCase):
         self.assertEqual(len(self.configurator.artifact_stores), 2)
         self.configurator.artifact_stores.make_empty()
         self.assertEqual(len(self.configurator.artifact_stores), 0)
+
+
+class _RecordingHandler(BaseHTTPRequestHandler):
+    def __respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('x-cruise-config-md5', '42')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(b'{}')
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = __respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHostRestClient(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _RecordingHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.host = '127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_unavailable_get_with_the_same_headers_and_auth(self):
+        self.server.statuses = [503]
+        result = HostRestClient(self.host, 'user', 'secret').get('/go/api/version', headers={'X-Extra': 'yes'})
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(2, len(self.server.requests))
+        for method, path, headers, _ in self.server.requests:
+            self.assertEqual(('GET', '/go/api/version'), (method, path))
+            self.assertTrue(headers['Authorization'].startswith('Basic '))
+            self.assertEqual('yes', headers['X-Extra'])
+            self.assertEqual('application/vnd.go.cd.v1+json', headers['Accept'])
+
+    def test_sends_put_patch_delete_and_head_with_token_and_headers(self):
+        client = HostRestClient(self.host, access_token='token')
+        client.put('/go/api/admin/pipelines/p', '{"name": "p"}', headers={'If-Match': '"etag"'})
+        client.patch('/go/api/agents', '{"uuids": []}')
+        client.delete('/go/api/admin/templates/t')
+        self.assertEqual('42', client.head('/go/api/admin/config.xml').headers['x-cruise-config-md5'])
+
+        self.assertEqual([('PUT', '/go/api/admin/pipelines/p', b'{"name": "p"}'),
+                          ('PATCH', '/go/api/agents', b'{"uuids": []}'),
+                          ('DELETE', '/go/api/admin/templates/t', b''),
+                          ('HEAD', '/go/api/admin/config.xml', b'')],
+                         [(method, path, body) for method, path, _, body in self.server.requests])
+        self.assertTrue(all(headers['Authorization'] == 'Bearer token' for _, _, headers, _ in self.server.requests))
+        self.assertEqual('"etag"', self.server.requests[0][2]['If-Match'])
+
+    def test_raises_conflict_when_the_server_rejects_a_stale_etag(self):
+        self.server.statuses = [412, 500]
+        client = HostRestClient(self.host)
+        self.assertRaises(ConfigConflictError, client.put, '/go/api/admin/pipelines/p', '{}', headers={'If-Match': '"old"'})
+        self.assertRaises(RuntimeError, client.delete, '/go/api/admin/pipelines/p')